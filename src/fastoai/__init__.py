@@ -1,8 +1,9 @@
 import importlib.metadata
-from contextlib import asynccontextmanager
+from contextlib import AsyncExitStack, asynccontextmanager
 
 from fastapi import FastAPI, status
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
+from openai import APIStatusError
 from sqlalchemy.exc import NoResultFound
 
 try:
@@ -10,12 +11,77 @@ try:
 except importlib.metadata.PackageNotFoundError:
     __version__ = "1.0.0"
 
+from ._client import AsyncOpenAI
+from .auth import key_cache
+from .batching import EmbeddingBatcher
+from .cache import create_valkey
+from .database import create_engine, prepare_schema
+from .executor import RunExecutor
+from .metrics import registry
+from .queueing import EndpointBusy
+from .ratelimit import RateLimiter, RateLimitExceeded, retry_after
+from .registry import ModelRegistry
+from .response_cache import ResponseCache
+from .retry import RetryPolicy
 from .routers import router
+from .run_events import RunEvents
+from .run_queue import RunQueue
+from .settings import get_settings
+from .usage import UsageRecorder
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    yield
+    settings = app.dependency_overrides.get(get_settings, get_settings)()
+    async with AsyncExitStack() as stack:
+        app.state.engine = create_engine(settings)
+        stack.push_async_callback(app.state.engine.dispose)
+        await prepare_schema(app.state.engine, settings)
+        app.state.usage_recorder = UsageRecorder(
+            app.state.engine,
+            interval=settings.usage_flush_interval,
+            max_pending=settings.usage_max_pending,
+        )
+        await stack.enter_async_context(app.state.usage_recorder.serve())
+        app.state.valkey = create_valkey(settings)
+        if app.state.valkey is not None:
+            stack.push_async_callback(app.state.valkey.aclose)
+        await stack.enter_async_context(key_cache.serve(settings, app.state.valkey))
+        app.state.response_cache = ResponseCache.from_settings(
+            settings, app.state.valkey
+        )
+        app.state.rate_limiter = RateLimiter.from_settings(settings, app.state.valkey)
+        app.state.registry = ModelRegistry(settings)
+        await stack.enter_async_context(app.state.registry.serve())
+        app.state.openai = AsyncOpenAI(
+            registry=app.state.registry,
+            load_balancing=settings.load_balancing,
+            model_load_balancing=settings.model_load_balancing,
+            retry_policy=RetryPolicy(
+                max_attempts=settings.upstream_max_attempts,
+                deadline=settings.upstream_deadline,
+                backoff=settings.upstream_backoff,
+            ),
+            single_flight_models=settings.single_flight_models,
+        )
+        stack.push_async_callback(app.state.openai.close)
+        app.state.embedding_batcher = EmbeddingBatcher(
+            app.state.openai,
+            max_batch_size=settings.embeddings_batch_size,
+            window=settings.embeddings_batch_window,
+        )
+        app.state.run_executor = RunExecutor(
+            app.state.engine,
+            app.state.openai,
+            app.state.usage_recorder,
+            RunQueue(app.state.engine, lease_duration=settings.run_lease_duration),
+            RunEvents.from_settings(settings, app.state.valkey),
+            concurrency=settings.run_workers,
+            max_attempts=settings.run_max_attempts,
+            checkpoint_tokens=settings.run_checkpoint_tokens,
+        )
+        await stack.enter_async_context(app.state.run_executor.serve())
+        yield
 
 
 app = FastAPI(title="FastOAI", version=__version__, lifespan=lifespan)
@@ -29,4 +95,35 @@ async def no_result_found_exception_handler(_, exc: NoResultFound):
     )
 
 
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_exceeded_handler(_, exc: RateLimitExceeded):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exc)},
+        headers={"Retry-After": retry_after(exc)},
+    )
+
+
+@app.exception_handler(EndpointBusy)
+async def endpoint_busy_handler(_, exc: EndpointBusy):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Upstream endpoints are saturated, try again later."},
+        headers={"Retry-After": "1"},
+    )
+
+
+@app.exception_handler(APIStatusError)
+async def upstream_status_error_handler(_, exc: APIStatusError):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content=exc.body if isinstance(exc.body, dict) else {"detail": exc.message},
+    )
+
+
+@app.get("/metrics", include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(registry.render())
+
+
 app.include_router(router)
@@ -1,42 +1,115 @@
-from typing import Literal, Type, overload
+import asyncio
+import hashlib
+import json
+from collections.abc import Awaitable, Callable, Collection, Iterator, Mapping
+from time import perf_counter
+from typing import TYPE_CHECKING, Literal, Type, overload
 
+import httpx
 from loguru import logger
+from openai import AsyncClient, AsyncStream
 from openai import AsyncOpenAI as _AsyncOpenAI
 from openai._base_client import _AsyncStreamT
 from openai._models import FinalRequestOptions
 from openai._types import ResponseT
 from openai.types.model import Model
-from pydantic import BaseModel, Field
-from tenacity import retry, stop_after_attempt, wait_random_exponential
+from pydantic import BaseModel, ConfigDict, Field
+
+from .balancing import Strategy, StrategyName, create_strategy
+from .circuit import CircuitBreaker
+from .queueing import EndpointBusy, PriorityQueue, current_priority
+from .retry import RETRIES, RETRY_EXHAUSTED, RetryPolicy, is_idempotent
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from .registry import ModelRegistry
 
 
 class Endpoint(BaseModel):
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     base_url: str
     api_key: str
+    http_client: httpx.AsyncClient
+    """Connection pool of the endpoint, shared by every request."""
+    client: AsyncClient
+    """SDK client sharing the endpoint's connection pool, without retries."""
     models: list[Model] = Field(default_factory=list)
+    weight: float = 1.0
+    breaker: CircuitBreaker = Field(default_factory=CircuitBreaker)
+    queue: PriorityQueue = Field(default_factory=PriorityQueue)
     count: int = 0
-    failure_count: int = 0
+    outstanding: int = 0
+    """Requests sent to this endpoint that have not completed yet, streamed
+    responses count until they are closed."""
+    latency: float | None = None
+    """Exponentially weighted moving average of the response time in seconds."""
+
+    def observe_latency(self, seconds: float, alpha: float = 0.3) -> None:
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency = alpha * seconds + (1 - alpha) * self.latency
+
+    def complete(self) -> None:
+        """Account the end of a request, freeing its slot in the queue."""
+        self.outstanding -= 1
+        self.queue.release()
 
 
 class AsyncOpenAI(_AsyncOpenAI):
     """Load-balanced OpenAI client."""
 
-    failure_threshold: int
-
     def __init__(
         self,
         *,
-        endpoints: dict[tuple[str, str], list[Model]],
-        failure_threshold: int = 10,
+        registry: "ModelRegistry",
+        load_balancing: StrategyName = "round_robin",
+        model_load_balancing: dict[str, StrategyName] | None = None,
+        retry_policy: RetryPolicy | None = None,
+        single_flight_models: Collection[str] = (),
         **kwargs,
     ):
-        self.endpoints = [
-            Endpoint(base_url=base_url, api_key=api_key, models=models)
-            for (base_url, api_key), models in endpoints.items()
-        ]
-        self.failure_threshold = failure_threshold
+        self.registry = registry
+        self.load_balancing = load_balancing
+        self.model_load_balancing = model_load_balancing or {}
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.single_flight_models = frozenset(single_flight_models)
+        self._single_flight = SingleFlight[str, object]()
+        self._strategies: dict[str | None, Strategy] = {}
+        # Credentials and base URL are taken from the endpoint picked per request.
+        kwargs.setdefault("api_key", "fastoai")
+        # Retries and failover are handled by `dispatch`, not by the SDK.
+        kwargs.setdefault("max_retries", 0)
         super().__init__(**kwargs)
 
+    @property
+    def endpoints(self) -> list[Endpoint]:
+        return self.registry.endpoints
+
+    def strategy(self, model: str | None) -> Strategy:
+        """The strategy balancing `model`, each model keeps its own state."""
+        if (strategy := self._strategies.get(model)) is None:
+            name = self.model_load_balancing.get(model or "", self.load_balancing)
+            strategy = self._strategies[model] = create_strategy(name)
+        return strategy
+
+    def coalesces(self, model: str | None) -> bool:
+        return model is not None and (
+            model in self.single_flight_models or "*" in self.single_flight_models
+        )
+
+    async def coalesce[T](
+        self, model: str | None, key: str, call: Callable[[], Awaitable[T]]
+    ) -> T:
+        """Share `call` with identical concurrent ones when `model` opted in.
+
+        Models opt in with `single_flight_models`, `*` opts in every model.
+        """
+        if not self.coalesces(model):
+            return await call()
+        return await self._single_flight.do(key, call)  # type: ignore[return-value]
+
     @overload
     async def request(
         self,
@@ -69,7 +142,117 @@ class AsyncOpenAI(_AsyncOpenAI):
         remaining_retries: int | None = None,
     ) -> ResponseT | _AsyncStreamT: ...
 
-    @retry(wait=wait_random_exponential(max=10), stop=stop_after_attempt(3))
+    async def dispatch[T](
+        self,
+        model: str | None,
+        call: Callable[[Endpoint], Awaitable[T]],
+        *,
+        idempotent: bool = False,
+    ) -> T:
+        """Run `call` against the endpoints serving `model` until one succeeds.
+
+        Endpoints are tried in the order of the model's balancing strategy,
+        skipping open circuits, within the budget of the retry policy.
+        """
+        policy = self.retry_policy
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + policy.deadline
+        endpoints = self.strategy(model).order(self.registry.candidates(model))
+        exc: Exception | None = None
+        for attempt, endpoint in enumerate(self._attempts(endpoints)):
+            if exc is not None:
+                delay = policy.delay(attempt - 1)
+                if loop.time() + delay >= deadline:
+                    endpoint.breaker.release()
+                    break
+                RETRIES.inc(endpoint=endpoint.base_url, reason=type(exc).__name__)
+                await asyncio.sleep(delay)
+            try:
+                await endpoint.queue.acquire(current_priority.get(), deadline)
+            except EndpointBusy as e:
+                exc = e
+                endpoint.breaker.release()
+                continue
+            except BaseException:
+                endpoint.breaker.release()
+                raise
+            endpoint.count += 1
+            endpoint.outstanding += 1
+            start = perf_counter()
+            held = False
+            try:
+                async with asyncio.timeout_at(deadline):
+                    result = await call(endpoint)
+            except Exception as e:
+                exc = e
+                logger.error(f"Error from endpoint={endpoint.base_url}: {exc}")
+                if isinstance(exc, TimeoutError):
+                    endpoint.breaker.record_failure()
+                    break
+                if not policy.is_retryable(exc, idempotent=idempotent):
+                    # The endpoint answered, the request itself is at fault.
+                    endpoint.breaker.record_success()
+                    raise
+                endpoint.breaker.record_failure()
+            except BaseException:
+                endpoint.breaker.release()
+                raise
+            else:
+                endpoint.observe_latency(perf_counter() - start)
+                endpoint.breaker.record_success()
+                held = _release_on_close(result, endpoint.complete)
+                return result
+            finally:
+                if not held:
+                    endpoint.complete()
+        if exc is None:
+            raise RuntimeError("No endpoints available")
+        RETRY_EXHAUSTED.inc()
+        raise exc
+
+    def _attempts(self, endpoints: list[Endpoint]) -> Iterator[Endpoint]:
+        """Cycle through `endpoints` whose circuit allows a request."""
+        attempts = 0
+        while attempts < self.retry_policy.max_attempts:
+            allowed = False
+            for endpoint in endpoints:
+                if attempts >= self.retry_policy.max_attempts:
+                    return
+                if endpoint.breaker.allow():
+                    allowed = True
+                    attempts += 1
+                    yield endpoint
+            if not allowed:
+                return
+
+    async def forward(
+        self, path: str, content: bytes, *, model: str | None
+    ) -> httpx.Response:
+        """POST `content` as is to the endpoints serving `model`.
+
+        The response is returned as soon as its headers arrived, the caller
+        reads the body and has to close it.
+        """
+
+        async def call(endpoint: Endpoint) -> httpx.Response:
+            request = endpoint.http_client.build_request(
+                "POST",
+                endpoint.base_url.rstrip("/") + path,
+                content=content,
+                headers={
+                    "Authorization": f"Bearer {endpoint.api_key}",
+                    "Content-Type": "application/json",
+                },
+            )
+            response = await endpoint.http_client.send(request, stream=True)
+            if response.is_error:
+                await response.aread()
+                await response.aclose()
+                raise self._make_status_error_from_response(response)
+            return response
+
+        return await self.dispatch(model, call)
+
     async def request(
         self,
         cast_to: Type[ResponseT],
@@ -79,37 +262,64 @@ class AsyncOpenAI(_AsyncOpenAI):
         stream_cls: type[_AsyncStreamT] | None = None,
         remaining_retries: int | None = None,
     ) -> ResponseT | _AsyncStreamT:
-        exceptions = []
-        model = (
+        model = _target_model(
+            options,
             options.json_data.get("model")
             if isinstance(options.json_data, dict)
-            else None
+            else None,
         )
-        endpoints = [
-            p
-            for p in sorted(self.endpoints, key=lambda x: x.failure_count)
-            if p.failure_count < self.failure_threshold
-            if model is None or any(m.id == model for m in p.models)
-        ]
-
-        for endpoint in endpoints:
-            try:
-                endpoint.count += 1
-                return (
-                    await super()
-                    .with_options(api_key=endpoint.api_key, base_url=endpoint.base_url)
-                    .request(
-                        cast_to,
-                        options,
-                        stream=stream,
-                        stream_cls=stream_cls,
-                        remaining_retries=remaining_retries,
-                    )
-                )
-            except Exception as exc:
-                logger.error(
-                    f"Error from endpoint={endpoint.base_url} api_key={endpoint.api_key}: {exc}"
-                )
-                exceptions.append(exc)
-                endpoint.failure_count += 1
-        raise exceptions[-1] if exceptions else RuntimeError("No endpoints available")
+        headers = options.headers if isinstance(options.headers, Mapping) else {}
+
+        async def call(endpoint: Endpoint):
+            return await endpoint.client.request(
+                cast_to, options, stream=stream, stream_cls=stream_cls
+            )
+
+        async def send():
+            return await self.dispatch(
+                model, call, idempotent=is_idempotent(options.method, headers)
+            )
+
+        if stream:
+            return await send()
+        return await self.coalesce(model, _key(options), send)
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release: Callable[[], None] | None = release
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self) -> None:
+        try:
+            await self._stream.aclose()
+        finally:
+            if self._release is not None:
+                self._release()
+                self._release = None
+
+
+def _release_on_close(result: object, release: Callable[[], None]) -> bool:
+    """Keep a streamed response outstanding on its endpoint until it is closed."""
+    response = result.response if isinstance(result, AsyncStream) else result
+    if not isinstance(response, httpx.Response) or response.is_closed:
+        return False
+    response.stream = _ReleasingStream(response.stream, release)  # type: ignore[arg-type]
+    return True
+
+
+def _target_model(options: FinalRequestOptions, model: str | None) -> str | None:
+    """The model a request is about, from its body or a `/models/{model}` URL."""
+    if model is None and options.url.startswith("/models/"):
+        return options.url.removeprefix("/models/")
+    return model
+
+
+def _key(options: FinalRequestOptions) -> str:
+    request = [options.method, options.url, options.params, options.json_data]
+    canonical = json.dumps(request, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(canonical.encode()).hexdigest()
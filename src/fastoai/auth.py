@@ -0,0 +1,192 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from typing import Literal
+
+from loguru import logger
+from pydantic import BaseModel, ConfigDict
+from sqlalchemy import event, inspect
+from sqlalchemy.orm import Session
+from valkey.asyncio import Valkey
+
+from .cache import VALKEY_ERRORS, TTLCache
+from .models._utils import hash_api_key
+from .models.key import Key, Permissions
+from .queueing import Priority
+from .settings import Settings, get_settings
+
+UNPEPPERED_WARNING = (
+    "FASTOAI_API_KEY_PEPPER is not set, API keys are hashed without a secret"
+)
+
+INVALIDATION_CHANNEL = "fastoai:auth:invalidate"
+_PENDING_INVALIDATIONS = "fastoai_invalidated_keys"
+
+
+class Principal(BaseModel):
+    """The resolved owner of an API key."""
+
+    model_config = ConfigDict(frozen=True)
+
+    key_id: str
+    owner_type: Literal["user", "service_account"]
+    owner_id: str
+    project_id: str | None = None
+    permissions: Permissions | Literal["all", "read_only"] = "all"
+    priority: Priority = "interactive"
+    role: Literal["owner", "member"] = "member"
+    """Role of the owner in its project, owners may administer the proxy."""
+
+    @classmethod
+    def from_key(cls, key: Key) -> "Principal":
+        if key.user is not None:
+            return cls(
+                key_id=key.id,
+                owner_type="user",
+                owner_id=key.user.id,
+                project_id=key.user.project_id,
+                permissions=key.permissions,
+                priority=key.priority,
+                role=key.user.role,
+            )
+        if key.service_account is not None:
+            return cls(
+                key_id=key.id,
+                owner_type="service_account",
+                owner_id=key.service_account.id,
+                permissions=key.permissions,
+                priority=key.priority,
+                role=key.service_account.role,
+            )
+        raise ValueError("API key does not have an owner")
+
+
+def token_digest(token: str) -> str:
+    """Hash of a bearer token, matching `Key.value_hash`."""
+    return hash_api_key(token, get_settings().api_key_pepper)
+
+
+class KeyCache:
+    """LRU+TTL cache of principals keyed by token digest, optionally shared.
+
+    The in-process tier answers without any I/O. When a Valkey client is
+    configured it is used as a second tier shared by every node, and
+    invalidations are broadcast so other nodes drop their local copies.
+    """
+
+    def __init__(self, maxsize: int = 10_000, ttl: float = 60):
+        self.local = TTLCache[str, Principal](maxsize, ttl)
+        self.valkey: Valkey | None = None
+
+    def configure(self, settings: Settings, valkey: Valkey | None = None) -> None:
+        self.local = TTLCache(settings.auth_cache_size, settings.auth_cache_ttl)
+        self.valkey = valkey
+
+    def _valkey_key(self, digest: str) -> str:
+        return f"fastoai:auth:{digest}"
+
+    async def get(self, digest: str) -> Principal | None:
+        if (principal := self.local.get(digest)) is not None:
+            return principal
+        if self.valkey is None:
+            return None
+        try:
+            value = await self.valkey.get(self._valkey_key(digest))
+        except VALKEY_ERRORS as exc:
+            logger.warning(f"Failed to read a cached API key from Valkey: {exc}")
+            return None
+        if value is None:
+            return None
+        principal = Principal.model_validate_json(value)
+        self.local.set(digest, principal)
+        return principal
+
+    async def set(self, digest: str, principal: Principal) -> None:
+        self.local.set(digest, principal)
+        if self.valkey is None:
+            return
+        try:
+            await self.valkey.set(
+                self._valkey_key(digest),
+                principal.model_dump_json(),
+                ex=max(int(self.local.ttl), 1),
+            )
+        except VALKEY_ERRORS as exc:
+            logger.warning(f"Failed to cache an API key in Valkey: {exc}")
+
+    async def invalidate(self, digest: str) -> None:
+        self.local.pop(digest)
+        if self.valkey is None:
+            return
+        try:
+            await self.valkey.delete(self._valkey_key(digest))
+            await self.valkey.publish(INVALIDATION_CHANNEL, digest)
+        except VALKEY_ERRORS as exc:
+            # Other nodes drop their copy once it expires.
+            logger.warning(f"Failed to invalidate an API key in Valkey: {exc}")
+
+    def invalidate_soon(self, digest: str) -> None:
+        """Drop the local entry now and the shared one from a background task."""
+        self.local.pop(digest)
+        if self.valkey is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        task = loop.create_task(self.invalidate(digest))
+        task.add_done_callback(_log_task_exception)
+
+    async def _listen(self, valkey: Valkey):
+        async with valkey.pubsub() as pubsub:
+            await pubsub.subscribe(INVALIDATION_CHANNEL)
+            async for message in pubsub.listen():
+                if message["type"] == "message":
+                    data = message["data"]
+                    self.local.pop(data.decode() if isinstance(data, bytes) else data)
+
+    @asynccontextmanager
+    async def serve(self, settings: Settings, valkey: Valkey | None = None):
+        """Configure the cache and follow invalidations from other nodes."""
+        if not settings.api_key_pepper:
+            logger.warning(UNPEPPERED_WARNING)
+        self.configure(settings, valkey)
+        if valkey is None:
+            yield self
+            return
+        listener = asyncio.create_task(self._listen(valkey))
+        try:
+            yield self
+        finally:
+            listener.cancel()
+            with suppress(asyncio.CancelledError):
+                await listener
+
+
+def _log_task_exception(task: asyncio.Task):
+    if not task.cancelled() and (exc := task.exception()) is not None:
+        logger.error(f"Failed to invalidate cached API key: {exc}")
+
+
+key_cache = KeyCache()
+
+
+@event.listens_for(Key, "after_update")
+@event.listens_for(Key, "after_delete")
+def _collect_changed_key(mapper, connection, target: Key):
+    if (session := Session.object_session(target)) is None:
+        return
+    history = inspect(target).attrs.value_hash.history
+    session.info.setdefault(_PENDING_INVALIDATIONS, set()).update(
+        [target.value_hash, *(history.deleted or ())]
+    )
+
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_changed_keys(session: Session):
+    for digest in session.info.pop(_PENDING_INVALIDATIONS, ()):
+        key_cache.invalidate_soon(digest)
+
+
+@event.listens_for(Session, "after_rollback")
+def _discard_changed_keys(session: Session):
+    session.info.pop(_PENDING_INVALIDATIONS, None)
@@ -0,0 +1,90 @@
+"""Strategies ordering the candidate endpoints of an upstream request.
+
+A strategy returns every candidate, most preferred first, the remaining ones
+are used in order to fail over.
+"""
+
+import random
+from collections.abc import Sequence
+from itertools import count
+from typing import TYPE_CHECKING, Literal, Protocol
+
+if TYPE_CHECKING:
+    from ._client import Endpoint
+
+StrategyName = Literal[
+    "round_robin",
+    "weighted_random",
+    "least_outstanding",
+    "power_of_two",
+    "ewma",
+]
+
+
+class Strategy(Protocol):
+    def order(self, endpoints: Sequence["Endpoint"]) -> list["Endpoint"]: ...
+
+
+class RoundRobin:
+    def __init__(self):
+        self._counter = count()
+
+    def order(self, endpoints: Sequence["Endpoint"]) -> list["Endpoint"]:
+        if not endpoints:
+            return []
+        start = next(self._counter) % len(endpoints)
+        return [*endpoints[start:], *endpoints[:start]]
+
+
+class WeightedRandom:
+    """Sample without replacement, proportionally to `Endpoint.weight`."""
+
+    def order(self, endpoints: Sequence["Endpoint"]) -> list["Endpoint"]:
+        # Efraimidis-Spirakis: sorting by u ** (1 / w) is a weighted shuffle.
+        return sorted(
+            endpoints,
+            key=lambda e: random.random() ** (1 / e.weight) if e.weight > 0 else 0,
+            reverse=True,
+        )
+
+
+class LeastOutstanding:
+    def order(self, endpoints: Sequence["Endpoint"]) -> list["Endpoint"]:
+        return sorted(endpoints, key=lambda e: e.outstanding / max(e.weight, 1e-9))
+
+
+class PowerOfTwoChoices:
+    """Pick two endpoints at random and prefer the one with lower latency."""
+
+    def order(self, endpoints: Sequence["Endpoint"]) -> list["Endpoint"]:
+        if len(endpoints) <= 2:
+            return sorted(endpoints, key=_latency)
+        first, second = random.sample(range(len(endpoints)), 2)
+        pair = sorted([endpoints[first], endpoints[second]], key=_latency)
+        rest = [e for i, e in enumerate(endpoints) if i not in (first, second)]
+        return [*pair, *sorted(rest, key=_latency)]
+
+
+class EWMA:
+    """Prefer the lowest latency average, penalized by requests in flight."""
+
+    def order(self, endpoints: Sequence["Endpoint"]) -> list["Endpoint"]:
+        return sorted(endpoints, key=lambda e: _latency(e) * (e.outstanding + 1))
+
+
+def _latency(endpoint: "Endpoint") -> float:
+    # Endpoints without samples yet go first so that they get some.
+    return endpoint.latency or 0.0
+
+
+STRATEGIES: dict[StrategyName, type[Strategy]] = {
+    "round_robin": RoundRobin,
+    "weighted_random": WeightedRandom,
+    "least_outstanding": LeastOutstanding,
+    "power_of_two": PowerOfTwoChoices,
+    "ewma": EWMA,
+}
+
+
+def create_strategy(name: StrategyName) -> Strategy:
+    return STRATEGIES[name]()
@@ -0,0 +1,174 @@
+"""Micro-batching of concurrent embedding requests."""
+
+import asyncio
+import json
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, Any
+
+from openai import APIStatusError
+
+from .metrics import registry
+from .queueing import current_priority
+
+if TYPE_CHECKING:
+    from ._client import AsyncOpenAI
+
+BATCH_SIZE = registry.histogram(
+    "fastoai_embedding_batch_size",
+    "Inputs sent in one upstream embeddings call.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024, 2048),
+)
+BATCH_REQUESTS = registry.histogram(
+    "fastoai_embedding_batch_requests",
+    "Client requests merged into one upstream embeddings call.",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128),
+)
+
+Input = str | list[int]
+
+INPUT_ERROR_STATUS = frozenset({400, 413, 422})
+"""Statuses blaming the inputs, for which a batch is retried input by input."""
+
+
+def _inputs(value: Any) -> list[Input]:
+    """The input of an embeddings request as a list of strings or token arrays."""
+    if isinstance(value, str) or (value and isinstance(value[0], int)):
+        return [value]
+    return list(value)
+
+
+@dataclass
+class _Item:
+    inputs: list[Input]
+    future: asyncio.Future[dict[str, Any]]
+
+
+@dataclass
+class _Batch:
+    params: dict[str, Any]
+    """The parameters of every request in the batch, but their inputs."""
+    items: list[_Item] = field(default_factory=list)
+    size: int = 0
+    timer: asyncio.TimerHandle | None = None
+
+
+class EmbeddingBatcher:
+    """Merge concurrent embeddings requests into one upstream call.
+
+    Requests of the same priority class with the same parameters but their
+    input are collected for at most `window` seconds, or until `max_batch_size`
+    inputs are pending, then sent as one call whose results are split back
+    between the callers.
+    """
+
+    def __init__(
+        self,
+        client: "AsyncOpenAI",
+        *,
+        max_batch_size: int = 256,
+        window: float = 0.005,
+    ):
+        self.client = client
+        self.max_batch_size = max_batch_size
+        self.window = window
+        self._batches: dict[str, _Batch] = {}
+        self._tasks: set[asyncio.Task] = set()
+
+    async def embed(self, params: dict[str, Any]) -> dict[str, Any]:
+        """Create the embeddings of one request, possibly within a batch."""
+        inputs = _inputs(params["input"])
+        params = {k: v for k, v in params.items() if k != "input"}
+        if not inputs or len(inputs) >= self.max_batch_size:
+            return await self._request(params, inputs)
+        kind = "str" if isinstance(inputs[0], str) else "tokens"
+        key = json.dumps([kind, current_priority.get(), params], sort_keys=True)
+        batch = self._batches.get(key)
+        if batch is not None and batch.size + len(inputs) > self.max_batch_size:
+            self._flush(key, batch)
+            batch = None
+        if batch is None:
+            batch = self._batches[key] = _Batch(params)
+            loop = asyncio.get_running_loop()
+            batch.timer = loop.call_later(self.window, self._flush, key, batch)
+        item = _Item(inputs, asyncio.get_running_loop().create_future())
+        batch.items.append(item)
+        batch.size += len(inputs)
+        if batch.size >= self.max_batch_size:
+            self._flush(key, batch)
+        return await item.future
+
+    def _flush(self, key: str, batch: _Batch) -> None:
+        if self._batches.get(key) is not batch:
+            return
+        del self._batches[key]
+        if batch.timer is not None:
+            batch.timer.cancel()
+        task = asyncio.create_task(self._send(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, batch: _Batch) -> None:
+        items = [item for item in batch.items if not item.future.done()]
+        if not items:
+            return
+        BATCH_REQUESTS.observe(len(items))
+        try:
+            result = await self._request(
+                batch.params, [i for item in items for i in item.inputs]
+            )
+        except APIStatusError as exc:
+            if len(items) > 1 and exc.status_code in INPUT_ERROR_STATUS:
+                # One bad input should not fail the requests batched with it.
+                for item in items:
+                    await self._send(_Batch(batch.params, [item], len(item.inputs)))
+                return
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(exc)
+            return
+        except Exception as exc:
+            for item in items:
+                if not item.future.done():
+                    item.future.set_exception(exc)
+            return
+        for item, part in zip(items, _split(result, [i.inputs for i in items])):
+            if not item.future.done():
+                item.future.set_result(part)
+
+    async def _request(
+        self, params: dict[str, Any], inputs: list[Input]
+    ) -> dict[str, Any]:
+        BATCH_SIZE.observe(len(inputs))
+        body = json.dumps({**params, "input": inputs}).encode()
+        response = await self.client.forward("/embeddings", body, model=params["model"])
+        try:
+            return json.loads(await response.aread())
+        finally:
+            await response.aclose()
+
+
+def _split(result: dict[str, Any], inputs: list[list[Input]]) -> list[dict[str, Any]]:
+    """Split a batched embeddings response between the requests it served.
+
+    Usage is shared out in proportion to the length of the inputs, strings in
+    characters and token arrays in tokens.
+    """
+    data = sorted(result["data"], key=lambda d: d["index"])
+    usage = result.get("usage") or {}
+    lengths = [sum(len(i) for i in item) for item in inputs]
+    total = sum(lengths) or 1
+    parts, start = [], 0
+    for item, length in zip(inputs, lengths):
+        share = length / total
+        parts.append(
+            {
+                **result,
+                "data": [
+                    {**d, "index": i}
+                    for i, d in enumerate(data[start : start + len(item)])
+                ],
+                "usage": {k: round(v * share) for k, v in usage.items()},
+            }
+        )
+        start += len(item)
+    return parts
@@ -0,0 +1,59 @@
+from collections import OrderedDict
+from time import monotonic
+
+from valkey.asyncio import Valkey
+from valkey.exceptions import ValkeyError
+
+from .settings import Settings
+
+VALKEY_ERRORS = (ValkeyError, OSError)
+"""Failures of Valkey calls, after which caches fall back to their local tier."""
+
+
+class TTLCache[K, V]:
+    """In-memory LRU cache whose entries also expire after a time-to-live."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[K, tuple[float, V]] = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def __contains__(self, key: K) -> bool:
+        return self.get(key) is not None
+
+    def get(self, key: K) -> V | None:
+        try:
+            expires_at, value = self._data[key]
+        except KeyError:
+            return None
+        if expires_at <= monotonic():
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: K, value: V, ttl: float | None = None) -> None:
+        if self.maxsize <= 0:
+            return
+        expires_at = monotonic() + (self.ttl if ttl is None else ttl)
+        self._data[key] = (expires_at, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key: K) -> V | None:
+        item = self._data.pop(key, None)
+        return None if item is None else item[1]
+
+    def clear(self) -> None:
+        self._data.clear()
+
+
+def create_valkey(settings: Settings) -> Valkey | None:
+    """Create the shared Valkey client, None when no URL is configured."""
+    if not settings.valkey_url:
+        return None
+    return Valkey.from_url(settings.valkey_url)
@@ -0,0 +1,99 @@
+from collections.abc import Callable
+from enum import IntEnum
+from time import monotonic
+
+from .metrics import registry
+
+CIRCUIT_STATE = registry.gauge(
+    "fastoai_endpoint_circuit_state",
+    "Circuit breaker state of an endpoint, 0 closed, 1 half-open, 2 open.",
+    ["endpoint"],
+)
+CIRCUIT_TRANSITIONS = registry.counter(
+    "fastoai_endpoint_circuit_transitions_total",
+    "Circuit breaker state changes of an endpoint.",
+    ["endpoint", "state"],
+)
+
+
+class CircuitState(IntEnum):
+    CLOSED = 0
+    HALF_OPEN = 1
+    OPEN = 2
+
+
+class CircuitBreaker:
+    """Stop sending traffic to an endpoint after consecutive failures.
+
+    Once `failure_threshold` requests in a row failed the circuit opens and the
+    endpoint is skipped. After `cooldown` seconds it becomes half-open and lets
+    up to `probes` requests through, `success_threshold` successful probes
+    close it again while a failed probe reopens it for another cooldown.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        *,
+        failure_threshold: int = 5,
+        cooldown: float = 30,
+        probes: int = 1,
+        success_threshold: int = 1,
+        clock: Callable[[], float] = monotonic,
+    ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.probes = probes
+        self.success_threshold = success_threshold
+        self.clock = clock
+        self.state = CircuitState.CLOSED
+        self.failures = 0
+        self.successes = 0
+        self.probes_in_flight = 0
+        self.opened_at = 0.0
+        CIRCUIT_STATE.set(self.state, endpoint=name)
+
+    def _transition(self, state: CircuitState) -> None:
+        self.state = state
+        self.failures = 0
+        self.successes = 0
+        self.probes_in_flight = 0
+        if state is CircuitState.OPEN:
+            self.opened_at = self.clock()
+        CIRCUIT_STATE.set(state, endpoint=self.name)
+        CIRCUIT_TRANSITIONS.inc(endpoint=self.name, state=state.name.lower())
+
+    def allow(self) -> bool:
+        """Whether a request may be sent now, call right before sending it."""
+        if self.state is CircuitState.OPEN:
+            if self.clock() - self.opened_at < self.cooldown:
+                return False
+            self._transition(CircuitState.HALF_OPEN)
+        if self.state is CircuitState.HALF_OPEN:
+            if self.probes_in_flight >= self.probes:
+                return False
+            self.probes_in_flight += 1
+        return True
+
+    def record_success(self) -> None:
+        if self.state is CircuitState.HALF_OPEN:
+            self.probes_in_flight -= 1
+            self.successes += 1
+            if self.successes >= self.success_threshold:
+                self._transition(CircuitState.CLOSED)
+        else:
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        if self.state is CircuitState.HALF_OPEN:
+            self._transition(CircuitState.OPEN)
+        elif self.state is CircuitState.CLOSED:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self._transition(CircuitState.OPEN)
+
+    def release(self) -> None:
+        """Give back the probe slot of a request that neither failed nor succeeded."""
+        if self.state is CircuitState.HALF_OPEN and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
@@ -1,3 +1,4 @@
+import asyncio
 from typing import Annotated
 from urllib.parse import urlparse
 
@@ -5,9 +6,13 @@ import typer
 import uvicorn
 
 from . import __version__
+from .auth import UNPEPPERED_WARNING
+from .database import SCHEMA_VERSION, create_engine, upgrade_schema
 from .dependencies import get_settings
 
 app = typer.Typer()
+db = typer.Typer(help="Manage the database schema.")
+app.add_typer(db, name="db")
 
 
 result = urlparse(get_settings().base_url)
@@ -40,3 +45,26 @@ def serve(
 def version():
     """Show the version of the package."""
     typer.echo(f"fastoai v{__version__}")
+
+
+@db.command()
+def upgrade():
+    """Create missing tables and migrate the schema to the current version."""
+    if not get_settings().api_key_pepper:
+        typer.echo(f"Warning: {UNPEPPERED_WARNING}", err=True)
+
+    async def _upgrade():
+        engine = create_engine(get_settings())
+        try:
+            async with engine.begin() as conn:
+                return await conn.run_sync(upgrade_schema)
+        finally:
+            await engine.dispose()
+
+    previous = asyncio.run(_upgrade())
+    if previous is None:
+        typer.echo(f"Database schema created at version {SCHEMA_VERSION}")
+    elif previous == SCHEMA_VERSION:
+        typer.echo(f"Database schema is already at version {SCHEMA_VERSION}")
+    else:
+        typer.echo(f"Database schema upgraded from {previous} to {SCHEMA_VERSION}")
@@ -0,0 +1,249 @@
+from collections.abc import Callable
+from time import perf_counter
+
+from sqlalchemy import (
+    Column,
+    Connection,
+    column,
+    delete,
+    event,
+    insert,
+    inspect,
+    text,
+    update,
+)
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, StaticPool
+from sqlmodel import Field, SQLModel, select
+
+from . import models as models
+from .metrics import registry
+from .models import Run, RunLease
+from .models._utils import hash_api_key, redact_api_key
+from .models.key import Key
+from .models.usage import UsageRecord
+from .settings import Settings, get_settings
+
+POOL_CHECKOUTS = registry.counter(
+    "fastoai_db_pool_checkouts_total", "Connections checked out from the pool."
+)
+POOL_TIMEOUTS = registry.counter(
+    "fastoai_db_pool_timeouts_total", "Checkouts that gave up waiting for the pool."
+)
+POOL_WAIT = registry.histogram(
+    "fastoai_db_pool_wait_seconds", "Time spent waiting for a pooled connection."
+)
+POOL_CHECKED_OUT = registry.gauge(
+    "fastoai_db_pool_checked_out", "Connections currently checked out."
+)
+POOL_SATURATION = registry.gauge(
+    "fastoai_db_pool_saturation",
+    "Checked out connections divided by pool_size + max_overflow.",
+)
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """Queue pool recording how long callers wait for a connection."""
+
+    def _do_get(self):
+        start = perf_counter()
+        try:
+            return super()._do_get()
+        except PoolTimeoutError:
+            POOL_TIMEOUTS.inc()
+            raise
+        finally:
+            POOL_WAIT.observe(perf_counter() - start)
+
+
+def _is_memory_sqlite(database_url: str) -> bool:
+    url = make_url(database_url)
+    return url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:")
+
+
+def create_engine(settings: Settings) -> AsyncEngine:
+    """Create the process-wide engine, sized and instrumented from settings."""
+    if _is_memory_sqlite(settings.database_url):
+        # Every connection to an in-memory database is a new, empty database,
+        # so all sessions have to share a single connection.
+        engine = create_async_engine(
+            settings.database_url,
+            connect_args={"check_same_thread": False},
+            poolclass=StaticPool,
+        )
+        capacity = 1
+    else:
+        engine = create_async_engine(
+            settings.database_url,
+            poolclass=InstrumentedQueuePool,
+            pool_size=settings.database_pool_size,
+            max_overflow=settings.database_max_overflow,
+            pool_timeout=settings.database_pool_timeout,
+            pool_recycle=settings.database_pool_recycle,
+            pool_pre_ping=settings.database_pool_pre_ping,
+        )
+        capacity = settings.database_pool_size + max(settings.database_max_overflow, 0)
+
+    checked_out = 0
+
+    @event.listens_for(engine.sync_engine, "checkout")
+    def on_checkout(*_):
+        nonlocal checked_out
+        checked_out += 1
+        POOL_CHECKOUTS.inc()
+
+    @event.listens_for(engine.sync_engine, "checkin")
+    def on_checkin(*_):
+        nonlocal checked_out
+        checked_out -= 1
+
+    POOL_CHECKED_OUT.set_function(lambda: checked_out)
+    POOL_SATURATION.set_function(lambda: checked_out / capacity)
+    return engine
+
+
+class SchemaVersion(SQLModel, table=True):
+    __tablename__ = "fastoai_schema"  # type: ignore
+
+    version: int = Field(primary_key=True)
+
+
+def _add_column(conn: Connection, column: Column, default: str) -> None:
+    preparer = conn.dialect.identifier_preparer
+    conn.execute(
+        text(
+            f"ALTER TABLE {preparer.format_table(column.table)} "
+            f"ADD COLUMN {preparer.format_column(column)} "
+            f"{column.type.compile(conn.dialect)} NOT NULL DEFAULT {default}"
+        )
+    )
+
+
+def _create_indexes(conn: Connection, column: Column) -> None:
+    for index in column.table.indexes:
+        if column.name in index.columns:
+            index.create(conn)
+
+
+_PLAINTEXT_VALUE = column("value")
+"""Column of the plaintext API keys, dropped by schema version 6."""
+
+
+def _hash_api_keys(conn: Connection) -> None:
+    table = Key.__table__  # type: ignore
+    _add_column(conn, table.c.value_hash, "''")
+    pepper = get_settings().api_key_pepper
+    statement = select(table.c.id, _PLAINTEXT_VALUE).select_from(table)
+    for key_id, value in conn.execute(statement).all():
+        conn.execute(
+            update(table)
+            .where(table.c.id == key_id)
+            .values(value_hash=hash_api_key(value, pepper))
+        )
+    _create_indexes(conn, table.c.value_hash)
+
+
+def _drop_plaintext_api_keys(conn: Connection) -> None:
+    table = Key.__table__  # type: ignore
+    _add_column(conn, table.c.redacted_value, "''")
+    statement = select(table.c.id, _PLAINTEXT_VALUE).select_from(table)
+    for key_id, value in conn.execute(statement).all():
+        conn.execute(
+            update(table)
+            .where(table.c.id == key_id)
+            .values(redacted_value=redact_api_key(value))
+        )
+    # Dropped rather than cleared, new keys leave out this NOT NULL column.
+    preparer = conn.dialect.identifier_preparer
+    conn.execute(
+        text(
+            f"ALTER TABLE {preparer.format_table(table)} "
+            f"DROP COLUMN {preparer.quote(_PLAINTEXT_VALUE.name)}"
+        )
+    )
+
+
+def _add_key_priority(conn: Connection) -> None:
+    _add_column(conn, Key.__table__.c.priority, "'interactive'")  # type: ignore
+
+
+def _create_usage_table(conn: Connection) -> None:
+    UsageRecord.__table__.create(conn, checkfirst=True)  # type: ignore
+
+
+def _create_run_queue(conn: Connection) -> None:
+    RunLease.__table__.create(conn, checkfirst=True)  # type: ignore
+    # Runs queued by a release that kept its queue in memory.
+    pending = select(Run.id, Run.created_at).where(
+        Run.status.in_(["queued", "in_progress"])  # type: ignore[attr-defined]
+    )
+    conn.execute(insert(RunLease).from_select(["run_id", "created_at"], pending))
+
+
+MIGRATIONS: dict[int, Callable[[Connection], None]] = {
+    2: _hash_api_keys,
+    3: _add_key_priority,
+    4: _create_usage_table,
+    5: _create_run_queue,
+    6: _drop_plaintext_api_keys,
+}
+"""Steps upgrading an existing database to the version they are keyed by.
+
+Brand new tables are also created by `create_all`, their step mostly bumps the
+version so that `check_schema` asks for the upgrade creating them.
+"""
+
+SCHEMA_VERSION = max(MIGRATIONS, default=1)
+
+
+class SchemaVersionError(RuntimeError):
+    pass
+
+
+def get_schema_version(conn: Connection) -> int | None:
+    """Return the version recorded in the database, None if it was never stamped."""
+    if not inspect(conn).has_table(SchemaVersion.__tablename__):
+        return None
+    return conn.execute(select(SchemaVersion.version)).scalar()
+
+
+def upgrade_schema(conn: Connection) -> int | None:
+    """Bring the schema up to `SCHEMA_VERSION`, returning the previous version."""
+    version = get_schema_version(conn)
+    existing = set(inspect(conn).get_table_names())
+    if version is None and existing & set(SQLModel.metadata.tables):
+        # Created by a release that ran `create_all` without recording a version.
+        version = 1
+    if version is not None and version > SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"Database schema version {version} is newer than {SCHEMA_VERSION}."
+        )
+    SQLModel.metadata.create_all(conn)
+    for step in range(version or SCHEMA_VERSION, SCHEMA_VERSION):
+        MIGRATIONS[step + 1](conn)
+    conn.execute(delete(SchemaVersion))
+    conn.execute(insert(SchemaVersion).values(version=SCHEMA_VERSION))
+    return version
+
+
+def check_schema(conn: Connection) -> None:
+    """Raise unless the database schema is exactly `SCHEMA_VERSION`."""
+    version = get_schema_version(conn)
+    if version != SCHEMA_VERSION:
+        raise SchemaVersionError(
+            f"Database schema version is {version}, expected {SCHEMA_VERSION}. "
+            "Run `fastoai db upgrade` to migrate it."
+        )
+
+
+async def prepare_schema(engine: AsyncEngine, settings: Settings) -> None:
+    """Run the startup schema step selected by `settings.database_migration`."""
+    if settings.database_migration == "skip":
+        return
+    async with engine.begin() as conn:
+        if settings.database_migration == "upgrade":
+            await conn.run_sync(upgrade_schema)
+        else:
+            await conn.run_sync(check_schema)
@@ -1,27 +1,38 @@
 from typing import Annotated
 
-import asyncstdlib as a
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, Header, HTTPException, Request, status
 from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
-from sqlalchemy.ext.asyncio import create_async_engine
-from sqlmodel import SQLModel
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.orm import joinedload
+from sqlmodel import select
 from sqlmodel.ext.asyncio.session import AsyncSession
 
 from ._client import AsyncOpenAI
-from .models import User
+from .auth import Principal, key_cache, token_digest
+from .batching import EmbeddingBatcher
+from .executor import RunExecutor
 from .models.key import Key
-from .models.project_user import ProjectUser
-from .models.service_account import ServiceAccount
+from .queueing import PRIORITIES, Priority, current_priority
+from .ratelimit import RateLimiter
+from .registry import ModelRegistry
+from .response_cache import ResponseCache
 from .settings import Settings, get_settings
+from .streaming import ChunkTransform
+from .usage import UsageRecorder
 
 SettingsDependency = Annotated[Settings, Depends(get_settings)]
 
 
-async def get_session(settings: SettingsDependency):
+def get_engine(request: Request) -> AsyncEngine:
+    """Get the process-wide engine created in the application lifespan."""
+    return request.app.state.engine
+
+
+EngineDependency = Annotated[AsyncEngine, Depends(get_engine)]
+
+
+async def get_session(engine: EngineDependency):
     """Get session."""
-    engine = create_async_engine(settings.database_url)
-    async with engine.begin() as conn:
-        await conn.run_sync(SQLModel.metadata.create_all)
     async with AsyncSession(engine) as session:
         yield session
 
@@ -29,14 +40,75 @@ async def get_session(settings: SettingsDependency):
 SessionDependency = Annotated[AsyncSession, Depends(get_session)]
 
 
-@a.lru_cache
-async def get_openai(settings: SettingsDependency):
+def get_registry(request: Request) -> ModelRegistry:
+    """Get the model registry refreshed in the application lifespan."""
+    return request.app.state.registry
+
+
+RegistryDependency = Annotated[ModelRegistry, Depends(get_registry)]
+
+
+def get_openai(request: Request) -> AsyncOpenAI:
     """Get OpenAI client."""
-    return await settings.get_openai_client()
+    return request.app.state.openai
 
 
 ClientDependency = Annotated[AsyncOpenAI, Depends(get_openai)]
 
+
+def get_embedding_batcher(request: Request) -> EmbeddingBatcher:
+    """Get the batcher merging concurrent embeddings requests."""
+    return request.app.state.embedding_batcher
+
+
+EmbeddingBatcherDependency = Annotated[EmbeddingBatcher, Depends(get_embedding_batcher)]
+
+
+def get_rate_limiter(request: Request) -> RateLimiter:
+    """Get the rate limiter shared by the routes calling the upstream."""
+    return request.app.state.rate_limiter
+
+
+RateLimiterDependency = Annotated[RateLimiter, Depends(get_rate_limiter)]
+
+
+def get_usage_recorder(request: Request) -> UsageRecorder:
+    """Get the recorder accounting the tokens consumed upstream."""
+    return request.app.state.usage_recorder
+
+
+UsageRecorderDependency = Annotated[UsageRecorder, Depends(get_usage_recorder)]
+
+
+def get_run_executor(request: Request) -> RunExecutor:
+    """Get the executor running the assistant runs in the background."""
+    return request.app.state.run_executor
+
+
+RunExecutorDependency = Annotated[RunExecutor, Depends(get_run_executor)]
+
+
+def get_response_cache(request: Request) -> ResponseCache | None:
+    """Get the chat completion response cache, None when it is disabled."""
+    return request.app.state.response_cache
+
+
+ResponseCacheDependency = Annotated[ResponseCache | None, Depends(get_response_cache)]
+
+
+def get_chunk_transform() -> ChunkTransform | None:
+    """Hook rewriting streamed chat completion chunks, none by default.
+
+    Override it with `app.dependency_overrides` to alter the chunks, streams are
+    only parsed when a transform is set.
+    """
+    return None
+
+
+ChunkTransformDependency = Annotated[
+    ChunkTransform | None, Depends(get_chunk_transform)
+]
+
 security = HTTPBearer()
 
 
@@ -44,15 +116,56 @@ async def get_user(
     *,
     credentials: Annotated[HTTPAuthorizationCredentials, Depends(security)],
     session: SessionDependency,
-) -> ProjectUser | ServiceAccount | None:
+) -> Principal:
     """Get the current user."""
-    api_key = await session.get(Key, credentials.credentials)
+    digest = token_digest(credentials.credentials)
+    if (principal := await key_cache.get(digest)) is not None:
+        return principal
+    statement = (
+        select(Key)
+        .where(Key.value_hash == digest)
+        .options(joinedload(Key.user), joinedload(Key.service_account))  # type: ignore
+    )
+    api_key = (await session.exec(statement)).first()
     if api_key is None:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED, detail="Invalid API key"
         )
-    await session.refresh(api_key, ["user"])
-    return api_key.user or api_key.service_account
+    principal = Principal.from_key(api_key)
+    await key_cache.set(digest, principal)
+    return principal
+
+
+UserDependency = Annotated[Principal, Depends(get_user)]
+
+
+async def get_priority(
+    user: UserDependency,
+    x_fastoai_priority: Annotated[Priority | None, Header()] = None,
+) -> Priority:
+    """Priority class of the request, a header can lower the one of the key.
 
+    It is also set as the priority of the upstream requests made while
+    handling the request, which is why it is async: a sync dependency runs in
+    a worker thread, whose context is lost when it returns.
+    """
+    priority = user.priority
+    if (
+        x_fastoai_priority is not None
+        and PRIORITIES[x_fastoai_priority] > PRIORITIES[priority]
+    ):
+        priority = x_fastoai_priority
+    current_priority.set(priority)
+    return priority
 
-UserDependency = Annotated[User, Depends(get_user)]
+
+PriorityDependency = Annotated[Priority, Depends(get_priority)]
+
+
+async def require_owner(user: UserDependency) -> None:
+    """Reject keys whose owner is not an owner of its project."""
+    if user.role != "owner":
+        raise HTTPException(
+            status_code=status.HTTP_403_FORBIDDEN,
+            detail="Only project owners can perform this operation",
+        )
@@ -0,0 +1,449 @@
+"""Background execution of assistant runs."""
+
+import asyncio
+import json
+import os
+import socket
+from collections.abc import Callable
+from contextlib import aclosing, asynccontextmanager, suppress
+from typing import Any
+from uuid import uuid4
+
+import anyio
+from loguru import logger
+from openai.types.beta.assistant_stream_event import (
+    AssistantStreamEvent,
+    ErrorEvent,
+)
+from openai.types.beta.threads import Text, TextContentBlock
+from openai.types.beta.threads.message import IncompleteDetails
+from openai.types.beta.threads.run import LastError
+from openai.types.beta.threads.run import Usage as RunUsage
+from openai.types.beta.threads.runs.message_creation_step_details import (
+    MessageCreation,
+    MessageCreationStepDetails,
+)
+from openai.types.beta.threads.runs.run_step import Usage as RunStepUsage
+from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
+from openai.types.shared import ErrorObject
+from sqlalchemy import or_, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ._client import AsyncOpenAI
+from .auth import Principal
+from .metrics import registry
+from .models import Message, Run, RunStep
+from .models._utils import now
+from .queueing import current_priority
+from .response_cache import CompletionAssembler
+from .run_events import RunEvents
+from .run_queue import Claim, RunQueue
+from .streaming import relay_sse
+from .usage import UsageRecorder
+
+RUNS_ACTIVE = registry.gauge(
+    "fastoai_runs_active", "Runs being executed by this process."
+)
+RUNS_FINISHED = registry.counter(
+    "fastoai_runs_finished_total",
+    "Runs executed to a final status.",
+    ["status"],
+)
+
+DONE_EVENT = "event: done\ndata: [DONE]\n\n"
+
+
+def format_run_event(event: AssistantStreamEvent) -> str:
+    return f"event: {event.event}\ndata: {event.data.model_dump_json()}\n\n"
+
+
+def format_row_event(event: str, row: Run | RunStep | Message) -> str:
+    """Format the event of a run, step or message straight from its row.
+
+    Unlike `to_openai_model()`, the row is not validated again as an OpenAI
+    model on every event. Its object is named after the event.
+    """
+    data = row.model_dump(by_alias=True, mode="json")
+    data["object"] = event.rpartition(".")[0]
+    return f"event: {event}\ndata: {json.dumps(data, separators=(',', ':'))}\n\n"
+
+
+def _chat_message(message: Message) -> ChatCompletionMessageParam:
+    text = "".join(c.text.value for c in message.content if c.type == "text")
+    return {"role": message.role, "content": text}  # type: ignore[return-value]
+
+
+class RunExecutor:
+    """Execute the runs of a `RunQueue` on a bounded pool of workers.
+
+    Runs are executed apart from the requests creating them, so that they go
+    on when the client disconnects, and their events are published on
+    `events`. At most `concurrency` runs execute at once in this process,
+    however many HTTP requests are in flight.
+
+    A run whose lease is lost is abandoned to the worker taking it over. A run
+    interrupted too many times, by crashes or lost leases, fails.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        client: AsyncOpenAI,
+        usage: UsageRecorder,
+        queue: RunQueue,
+        events: RunEvents,
+        *,
+        concurrency: int = 4,
+        max_attempts: int = 3,
+        poll_interval: float = 1,
+        checkpoint_tokens: int = 0,
+    ):
+        self.engine = engine
+        self.client = client
+        self.usage = usage
+        self.queue = queue
+        self.concurrency = concurrency
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        """Seconds between two looks for runs queued by other processes."""
+        self.checkpoint_tokens = checkpoint_tokens
+        """Streamed tokens after which the partial message is saved, 0 to only
+        save it once the run ends."""
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid4().hex[:8]}"
+        self.events = events
+        self._wakeup = asyncio.Event()
+        self._running: dict[str, asyncio.Task[None]] = {}
+        self._interrupted: set[str] = set()
+        """Runs stopped without being ended, to be resumed by another worker."""
+        RUNS_ACTIVE.set_function(lambda: len(self._running))
+
+    def notify(self) -> None:
+        """Wake the idle workers up, a run was just queued."""
+        self._wakeup.set()
+
+    def cancel(self, run_id: str) -> bool:
+        """Cancel a run executed by this process, False if it is not."""
+        if (task := self._running.get(run_id)) is None:
+            return False
+        task.cancel()
+        return True
+
+    async def _work(self):
+        while True:
+            self._wakeup.clear()
+            claim = await self.queue.claim(self.owner)
+            if claim is None:
+                with suppress(TimeoutError):
+                    async with asyncio.timeout(self.poll_interval):
+                        await self._wakeup.wait()
+                continue
+            await self._hold(claim)
+
+    async def _hold(self, claim: Claim) -> None:
+        run_id = claim.run_id
+        task = asyncio.create_task(self._execute(claim))
+        self._running[run_id] = task
+        heartbeat = asyncio.create_task(self._heartbeat(run_id, task))
+        try:
+            # Waiting rather than awaiting, a cancelled run must not stop the
+            # worker.
+            await asyncio.wait([task])
+        finally:
+            heartbeat.cancel()
+            self._running.pop(run_id, None)
+            with anyio.CancelScope(shield=True):
+                if not task.done():
+                    # The worker is stopping, another one resumes the run.
+                    self._interrupted.add(run_id)
+                    task.cancel()
+                    await asyncio.wait([task])
+                    await self.queue.release(run_id, self.owner)
+                elif run_id not in self._interrupted:
+                    await self.queue.complete(run_id, self.owner)
+                self._interrupted.discard(run_id)
+
+    async def _heartbeat(self, run_id: str, task: asyncio.Task[None]) -> None:
+        while True:
+            await asyncio.sleep(self.queue.lease_duration / 3)
+            try:
+                status = await self.queue.renew(run_id, self.owner)
+            except Exception as exc:
+                logger.warning(f"Failed to renew the lease of run {run_id}: {exc}")
+                continue
+            if status is None:
+                logger.warning(f"Lost the lease of run {run_id} to another worker")
+                self._interrupted.add(run_id)
+                task.cancel()
+                return
+            if status == "cancelling":
+                # Cancelled through another process.
+                task.cancel()
+                return
+
+    @asynccontextmanager
+    async def serve(self):
+        """Run the workers, giving the runs in progress back on exit."""
+        workers = [asyncio.create_task(self._work()) for _ in range(self.concurrency)]
+        try:
+            yield self
+        finally:
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+
+    async def _execute(self, claim: Claim) -> None:
+        if claim.principal is not None:
+            current_priority.set(claim.principal.priority)
+        try:
+            async with AsyncSession(self.engine, expire_on_commit=False) as session:
+                run = await session.get(Run, claim.run_id)
+                if run is None or not await self._resume(session, run, claim):
+                    return
+                await self._run(session, run, claim.principal)
+        except Exception as exc:
+            logger.exception(f"Run {claim.run_id} could not be executed: {exc}")
+        finally:
+            if claim.run_id not in self._interrupted:
+                self.events.close(claim.run_id)
+
+    async def _resume(self, session: AsyncSession, run: Run, claim: Claim) -> bool:
+        """Prepare a claimed run to be executed, False if it already ended."""
+        if run.status == "queued":
+            return True
+        if run.status not in ("in_progress", "cancelling"):
+            # Cancelled while it was waiting for a worker.
+            return False
+        # Taken over from a worker that stopped, its partial output is kept as
+        # incomplete but left out of the prompt of the new attempt.
+        await session.exec(
+            update(Message)
+            .where(col(Message.run_id) == run.id, col(Message.status) == "in_progress")
+            .values(status="incomplete", incomplete_at=now())
+        )
+        await session.exec(
+            update(RunStep)
+            .where(col(RunStep.run_id) == run.id, col(RunStep.status) == "in_progress")
+            .values(status="failed", failed_at=now())
+        )
+        if run.status == "cancelling":
+            run.status = "cancelled"
+            run.cancelled_at = now()
+        elif claim.attempts > self.max_attempts:
+            run.status = "failed"
+            run.failed_at = now()
+            run.last_error = LastError(
+                code="server_error",
+                message=f"Run was interrupted {claim.attempts - 1} times",
+            )
+        session.add(run)
+        await session.commit()
+        if run.status != "in_progress":
+            RUNS_FINISHED.inc(status=run.status)
+            return False
+        return True
+
+    async def _run(
+        self, session: AsyncSession, run: Run, principal: Principal | None
+    ) -> None:
+        def emit(event: str, row: Run | RunStep | Message):
+            self.events.publish(run.id, format_row_event(event, row))
+
+        try:
+            async with asyncio.timeout(
+                None
+                if run.expires_at is None
+                else (run.expires_at - now()).total_seconds()
+            ):
+                history, message, step = await self._start(session, run, emit)
+                await self._message_creation_step(
+                    session, run, history, message, step, principal, emit
+                )
+            run.status = "completed"
+            run.completed_at = now()
+            session.add(run)
+            await session.commit()
+            emit("thread.message.completed", message)
+            emit("thread.run.step.completed", step)
+            emit("thread.run.completed", run)
+        except asyncio.CancelledError:
+            if run.id in self._interrupted:
+                raise
+            with anyio.CancelScope(shield=True):
+                run.status = "cancelled"
+                run.cancelled_at = now()
+                session.add(run)
+                await session.commit()
+                emit("thread.run.cancelled", run)
+            RUNS_FINISHED.inc(status=run.status)
+            raise
+        except TimeoutError:
+            run.status = "expired"
+            session.add(run)
+            await session.commit()
+            emit("thread.run.expired", run)
+            self.events.publish(
+                run.id,
+                format_run_event(
+                    ErrorEvent(
+                        data=ErrorObject(message="Run expired", type="TimeoutError"),
+                        event="error",
+                    )
+                ),
+            )
+        except Exception as e:
+            run.status = "failed"
+            run.failed_at = now()
+            run.last_error = LastError(code="server_error", message=str(e))
+            session.add(run)
+            await session.commit()
+            emit("thread.run.failed", run)
+        RUNS_FINISHED.inc(status=run.status)
+        self.events.publish(run.id, DONE_EVENT)
+
+    async def _start(
+        self,
+        session: AsyncSession,
+        run: Run,
+        emit: Callable[[str, Run | RunStep | Message], None],
+    ) -> tuple[list[ChatCompletionMessageParam], Message, RunStep]:
+        """Start a run with the step creating its message, in one transaction."""
+        history = await session.exec(
+            select(Message)
+            .where(
+                col(Message.thread_id) == run.thread_id,
+                # Left behind by an interrupted attempt of the run.
+                or_(col(Message.run_id).is_(None), col(Message.run_id) != run.id),
+            )
+            .order_by(col(Message.created_at))
+        )
+        messages: list[ChatCompletionMessageParam] = [
+            {"role": "system", "content": run.instructions},
+            *[_chat_message(m) for m in history],
+        ]
+        message = Message(  # type: ignore
+            thread_id=run.thread_id,
+            assistant_id=run.assistant_id,
+            run_id=run.id,
+            content=[],
+            role="assistant",
+            status="in_progress",
+        )
+        step = RunStep(  # type: ignore
+            run_id=run.id,
+            thread_id=run.thread_id,
+            assistant_id=run.assistant_id,
+            status="in_progress",
+            type="message_creation",
+            step_details=MessageCreationStepDetails(
+                message_creation=MessageCreation(message_id=message.id),
+                type="message_creation",
+            ),
+        )
+        run.status = "in_progress"
+        run.started_at = now()
+        session.add_all([run, message, step])
+        await session.commit()
+        emit("thread.run.in_progress", run)
+        emit("thread.run.step.created", step)
+        emit("thread.run.step.in_progress", step)
+        emit("thread.message.created", message)
+        emit("thread.message.in_progress", message)
+        return messages, message, step
+
+    async def _message_creation_step(
+        self,
+        session: AsyncSession,
+        run: Run,
+        messages: list[ChatCompletionMessageParam],
+        message: Message,
+        step: RunStep,
+        principal: Principal | None,
+        emit: Callable[[str, Run | RunStep | Message], None],
+    ) -> None:
+        assembler = CompletionAssembler()
+        unsaved = 0
+        # Deltas only differ by their content, which goes in between.
+        delta_start = (
+            "event: thread.message.delta\ndata: "
+            f'{{"id":{json.dumps(message.id)},"object":"thread.message.delta",'
+            '"delta":{"role":"assistant","content":[{"index":0,"type":"text",'
+            '"text":{"value":'
+        )
+        delta_end = ',"annotations":[]}}]}}\n\n'
+
+        def observe(chunk: dict[str, Any]) -> None:
+            nonlocal unsaved
+            assembler(chunk)
+            if usage := chunk.get("usage"):
+                tokens = {k: usage.get(k, 0) for k in RunUsage.model_fields}
+                run.usage = RunUsage(**tokens)
+                step.usage = RunStepUsage(**tokens)
+                if principal is not None:
+                    self.usage.record(
+                        principal, model=run.model, kind="run", usage=tokens
+                    )
+            for choice in chunk.get("choices") or ():
+                if not (content := (choice.get("delta") or {}).get("content")):
+                    continue
+                unsaved += 1
+                self.events.publish(
+                    run.id, delta_start + json.dumps(content) + delta_end
+                )
+
+        def save_content() -> None:
+            message.content = [
+                TextContentBlock(
+                    type="text", text=Text(value=assembler.content(), annotations=[])
+                )
+            ]
+            session.add(message)
+
+        body = json.dumps(
+            {
+                "model": run.model,
+                "messages": messages,
+                "stream": True,
+                "stream_options": {"include_usage": True},
+            }
+        ).encode()
+        try:
+            response = await self.client.forward(
+                "/chat/completions", body, model=run.model
+            )
+            async with aclosing(relay_sse(response, observe=observe)) as events:
+                async for _ in events:
+                    if self.checkpoint_tokens and unsaved >= self.checkpoint_tokens:
+                        save_content()
+                        await session.commit()
+                        unsaved = 0
+        except BaseException as exc:
+            if run.id in self._interrupted:
+                raise
+            # Saved with the status of the run.
+            save_content()
+            message.status = "incomplete"
+            message.incomplete_at = now()
+            if not isinstance(exc, asyncio.CancelledError):
+                message.incomplete_details = IncompleteDetails(reason="run_failed")
+                step.status = "failed"
+                step.failed_at = now()
+            elif run.expires_at is not None and run.expires_at <= now():
+                # Cancelled by the timeout of the run, raised as a TimeoutError
+                # only once it leaves the timeout block.
+                message.incomplete_details = IncompleteDetails(reason="run_expired")
+                step.status = "expired"
+                step.expired_at = now()
+            else:
+                message.incomplete_details = IncompleteDetails(reason="run_cancelled")
+                step.status = "cancelled"
+                step.cancelled_at = now()
+            session.add_all([message, step])
+            raise
+        save_content()
+        message.status = "completed"
+        message.completed_at = now()
+        step.status = "completed"
+        step.completed_at = now()
+        session.add_all([message, step])
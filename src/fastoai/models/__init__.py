@@ -30,6 +30,8 @@ from .generated.run import Run
 from .generated.run_step import RunStep
 from .generated.thread import Thread
 from .project import Project
+from .run_lease import RunLease
+from .usage import UsageRecord
 
 __all__ = [
     "User",
@@ -40,4 +42,6 @@ __all__ = [
     "Thread",
     "FileObject",
     "Project",
+    "RunLease",
+    "UsageRecord",
 ]
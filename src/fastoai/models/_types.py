@@ -1,3 +1,4 @@
+import json
 from typing import (
     Annotated,
     Any,
@@ -9,7 +10,7 @@ from typing import (
 )
 
 import sqlalchemy as sa
-from pydantic import BaseModel, RootModel
+from pydantic import BaseModel, RootModel, ValidationError
 from sqlalchemy.ext.mutable import Mutable, MutableList
 from sqlmodel import JSON, Enum, String
 
@@ -66,19 +67,21 @@ class UnionModelType(sa.types.TypeDecorator[RootModel]):
             case None:
                 return None
             case list():
-                return [v.model_dump(mode="json") for v in value]
+                return json.dumps([v.model_dump(mode="json") for v in value])
             case BaseModel():
-                return value.model_dump(mode="json")
+                return value.model_dump_json()
             case _:
                 return value
 
     def process_result_value(self, value: Any, _):  # type: ignore
         """Convert JSON string back to Python object after retrieving from the database"""
-        return (
-            None
-            if value is None
-            else self.pydantic_model_class.model_validate(value).root
-        )
+        if value is None:
+            return None
+        try:
+            return self.pydantic_model_class.model_validate_json(value).root
+        except ValidationError:
+            # Plain strings, such as "auto", are stored as is.
+            return self.pydantic_model_class.model_validate(value).root
 
 
 class MutableBaseModel(Mutable, BaseModel):
@@ -101,6 +104,9 @@ class MutableBaseModel(Mutable, BaseModel):
         if isinstance(value, dict):
             return cls.model_validate(value)
 
+        if isinstance(value, BaseModel):
+            return cls.model_validate(value.model_dump())
+
         return super().coerce(key, value)
 
 
@@ -1,3 +1,4 @@
+import hmac
 import secrets
 from datetime import UTC, datetime
 from string import ascii_letters, digits
@@ -25,3 +26,13 @@ def random_id_with_prefix(prefix: str, length: int = 24):
 
 def now():
     return datetime.now(UTC)
+
+
+def hash_api_key(value: str, pepper: str) -> str:
+    """Keyed hash of an API key, the only form in which keys are looked up."""
+    return hmac.new(pepper.encode(), value.encode(), "sha256").hexdigest()
+
+
+def redact_api_key(value: str) -> str:
+    """Form in which an API key is displayed once created."""
+    return value[:8] + "*" * (len(value) - 12) + value[-4:]
@@ -2,11 +2,14 @@ from datetime import datetime
 from secrets import token_urlsafe
 from typing import Annotated, Literal, TypedDict
 
-from pydantic import computed_field, field_serializer
+from pydantic import PrivateAttr, computed_field, field_serializer
+from sqlalchemy import String
 from sqlmodel import Field, Relationship, SQLModel
 
+from ..queueing import Priority
+from ..settings import get_settings
 from ._types import MutableBaseModel, as_sa_type
-from ._utils import now, random_id_with_prefix
+from ._utils import hash_api_key, now, random_id_with_prefix, redact_api_key
 from .organization_user import OrganizationUser, OrganizationUserPublic
 from .project_user import ProjectUser, ProjectUserPublic
 from .service_account import (
@@ -53,11 +56,14 @@ class ServiceAccountOwner(TypedDict):
 
 class Key(KeyBase, table=True):
     id: str = Field(primary_key=True, default_factory=random_id_with_prefix("key_", 16))
-    value: str = ""
+    value_hash: str = Field(default="", unique=True, index=True)
+    redacted_value: str = ""
     permissions: Annotated[
         Permissions | Literal["all", "read_only"],
         Field(sa_type=as_sa_type(Permissions | Literal["all", "read_only"])),
     ] = "all"
+    priority: Priority = Field(default="interactive", sa_type=String)
+    """Priority class of the upstream requests made with this key."""
     admin_id: str | None = Field(default=None, foreign_key="organization_user.id")
     admin: OrganizationUser | None = Relationship(back_populates="admin_api_keys")
     user_id: str | None = Field(default=None, foreign_key="project_user.id")
@@ -67,20 +73,29 @@ class Key(KeyBase, table=True):
     )
     service_account: ServiceAccount | None = Relationship(back_populates="api_key")
 
+    _value: str | None = PrivateAttr(default=None)
+
     def model_post_init(self, __context):
         if self.user_id is not None:
-            self.value = "sk-proj-" + token_urlsafe(117)
+            value = "sk-proj-" + token_urlsafe(117)
         elif self.admin_id is not None:
-            self.value = "sk-admin-" + token_urlsafe(93)
-        elif self.user_id is not None:
-            self.value = "sk-svcacct-" + token_urlsafe(94)
+            value = "sk-admin-" + token_urlsafe(93)
+        elif self.service_account_id is not None:
+            value = "sk-svcacct-" + token_urlsafe(94)
         else:
-            self.value = "sk-" + token_urlsafe(128)
+            value = "sk-" + token_urlsafe(128)
+        self._value = value
+        self.value_hash = hash_api_key(value, get_settings().api_key_pepper)
+        self.redacted_value = redact_api_key(value)
 
-    @computed_field
     @property
-    def redacted_value(self) -> str:
-        return self.value[:8] + "*" * (len(self.value) - 12) + self.value[-4:]
+    def value(self) -> str | None:
+        """The secret, only known to the instance that generated it.
+
+        It is never stored, keys are looked up by `value_hash`. Keys loaded
+        from the database do not even have private attributes.
+        """
+        return (getattr(self, "__pydantic_private__", None) or {}).get("_value")
 
     @computed_field
     @property
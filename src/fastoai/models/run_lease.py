@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from sqlmodel import Field, SQLModel
+
+from ._utils import now
+
+
+class RunLease(SQLModel, table=True):
+    """Entry of a run in the durable run queue.
+
+    A worker executes a run only while it holds its lease, and renews it
+    until the run ends. A lease that expired is taken over by another worker.
+    """
+
+    __tablename__ = "run_lease"  # type: ignore
+
+    run_id: str = Field(primary_key=True, foreign_key="run.id")
+    principal: str | None = None
+    """The owner of the key that created the run, as JSON."""
+    owner: str | None = None
+    """The worker holding the lease, None while the run waits for one."""
+    expires_at: datetime | None = Field(default=None, index=True)
+    attempts: int = 0
+    created_at: datetime = Field(default_factory=now, index=True)
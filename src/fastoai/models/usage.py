@@ -0,0 +1,24 @@
+from datetime import datetime
+
+from sqlmodel import Field, SQLModel
+
+
+class UsageRecord(SQLModel, table=True):
+    """Tokens consumed upstream by one API key and model during one period.
+
+    Records are aggregated in memory and written in batches, the same period
+    can therefore appear in several records which add up.
+    """
+
+    __tablename__ = "usage"  # type: ignore
+
+    id: int | None = Field(default=None, primary_key=True)
+    period_start: datetime = Field(index=True)
+    key_id: str = Field(index=True)
+    project_id: str | None = Field(default=None, index=True)
+    model: str
+    kind: str
+    """The kind of upstream call, e.g. `chat.completion`, `embedding` or `run`."""
+    requests: int = 0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
@@ -0,0 +1,120 @@
+"""Per-endpoint admission queues ordered by priority class."""
+
+import asyncio
+import heapq
+from contextvars import ContextVar
+from itertools import count
+from time import perf_counter
+from typing import Literal
+
+from .metrics import registry
+
+Priority = Literal["interactive", "batch"]
+PRIORITIES: dict[Priority, int] = {"interactive": 0, "batch": 1}
+"""Rank of each priority class, lower ranks are served first."""
+
+current_priority: ContextVar[Priority] = ContextVar(
+    "fastoai_priority", default="interactive"
+)
+"""Priority class of the upstream requests made in the current context."""
+
+QUEUE_DEPTH = registry.gauge(
+    "fastoai_upstream_queue_depth",
+    "Requests waiting for a free slot on an endpoint.",
+    ["endpoint", "priority"],
+)
+QUEUE_WAIT = registry.histogram(
+    "fastoai_upstream_queue_wait_seconds",
+    "Time spent waiting for a free slot on an endpoint.",
+    ["priority"],
+)
+QUEUE_REJECTED = registry.counter(
+    "fastoai_upstream_queue_rejected_total",
+    "Requests turned away by an endpoint whose queue was full or too slow.",
+    ["endpoint", "reason"],
+)
+
+
+class EndpointBusy(Exception):
+    def __init__(self, endpoint: str, reason: Literal["full", "timeout"]):
+        super().__init__(f"Endpoint {endpoint} is saturated ({reason})")
+        self.endpoint = endpoint
+        self.reason = reason
+
+
+class PriorityQueue:
+    """Bound the requests in flight on an endpoint, queueing the others.
+
+    At most `max_concurrency` requests run at once, 0 for no limit. Waiting
+    requests are served by priority class, then in arrival order, and give up
+    with `EndpointBusy` when `max_size` are already waiting or after `timeout`
+    seconds in the queue.
+    """
+
+    def __init__(
+        self,
+        name: str = "",
+        *,
+        max_concurrency: int = 0,
+        max_size: int = 1000,
+        timeout: float = 30,
+    ):
+        self.name = name
+        self.max_concurrency = max_concurrency
+        self.max_size = max_size
+        self.timeout = timeout
+        self.active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future[None]]] = []
+        self._queued = 0
+        self._sequence = count()
+
+    def __len__(self) -> int:
+        return self._queued
+
+    async def acquire(self, priority: Priority, deadline: float | None = None) -> None:
+        """Wait for a slot, until `deadline` in event loop time at the latest."""
+        start = perf_counter()
+        if self.max_concurrency <= 0 or (
+            self.active < self.max_concurrency and not self._queued
+        ):
+            self.active += 1
+            QUEUE_WAIT.observe(0, priority=priority)
+            return
+        if self._queued >= self.max_size:
+            QUEUE_REJECTED.inc(endpoint=self.name, reason="full")
+            raise EndpointBusy(self.name, "full")
+        loop = asyncio.get_running_loop()
+        timeout = self.timeout
+        if deadline is not None:
+            timeout = min(timeout, deadline - loop.time())
+        future = loop.create_future()
+        heapq.heappush(
+            self._waiters, (PRIORITIES[priority], next(self._sequence), future)
+        )
+        self._queued += 1
+        QUEUE_DEPTH.inc(endpoint=self.name, priority=priority)
+        try:
+            async with asyncio.timeout(timeout):
+                await future
+        except BaseException as exc:
+            if future.done() and not future.cancelled():
+                # The slot was handed over just as the wait ended.
+                self.release()
+            future.cancel()
+            if isinstance(exc, TimeoutError):
+                QUEUE_REJECTED.inc(endpoint=self.name, reason="timeout")
+                raise EndpointBusy(self.name, "timeout") from exc
+            raise
+        finally:
+            self._queued -= 1
+            QUEUE_DEPTH.dec(endpoint=self.name, priority=priority)
+            QUEUE_WAIT.observe(perf_counter() - start, priority=priority)
+
+    def release(self) -> None:
+        """Give a slot back, handing it to the first waiter if there is one."""
+        while self._waiters:
+            *_, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.active -= 1
@@ -0,0 +1,315 @@
+"""Per-key and per-project admission control."""
+
+import math
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import aclosing
+from dataclasses import dataclass
+from time import monotonic
+from uuid import uuid4
+
+import anyio
+from valkey.asyncio import Valkey
+
+from .auth import Principal
+from .cache import TTLCache
+from .metrics import registry
+from .settings import RateLimits, Settings
+
+RATE_LIMITED = registry.counter(
+    "fastoai_rate_limited_total",
+    "Requests rejected because a rate or concurrency limit was reached.",
+    ["scope", "limit"],
+)
+
+CHARS_PER_TOKEN = 4
+"""Rough size of a token, used to estimate prompts without tokenizing them."""
+
+_TAKE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local wait, worst, tokens = 0, 0, {}
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 2])
+    local rate = tonumber(ARGV[i * 3 - 1])
+    local cost = tonumber(ARGV[i * 3])
+    local state = redis.call('HMGET', key, 'tokens', 'updated')
+    local level = tonumber(state[1]) or capacity
+    local updated = tonumber(state[2]) or now
+    level = math.min(capacity, level + math.max(0, now - updated) * rate)
+    tokens[i] = level
+    if level < cost and (cost - level) / rate > wait then
+        wait, worst = (cost - level) / rate, i
+    end
+end
+if wait > 0 then
+    return {tostring(wait), worst}
+end
+for i, key in ipairs(KEYS) do
+    local capacity = tonumber(ARGV[i * 3 - 2])
+    local rate = tonumber(ARGV[i * 3 - 1])
+    redis.call('HSET', key, 'tokens', tokens[i] - tonumber(ARGV[i * 3]), 'updated', now)
+    redis.call('PEXPIRE', key, math.ceil(capacity / rate * 1000))
+end
+return {'0', 0}
+"""
+
+_OPEN_STREAM_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local ttl = tonumber(ARGV[1])
+for i, key in ipairs(KEYS) do
+    redis.call('ZREMRANGEBYSCORE', key, '-inf', now - ttl)
+    if redis.call('ZCARD', key) >= tonumber(ARGV[i + 2]) then
+        return i
+    end
+end
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[2])
+    redis.call('EXPIRE', key, math.ceil(ttl))
+end
+return 0
+"""
+
+_REFRESH_STREAM_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+for i, key in ipairs(KEYS) do
+    redis.call('ZADD', key, now, ARGV[2])
+    redis.call('EXPIRE', key, math.ceil(tonumber(ARGV[1])))
+end
+"""
+
+
+class RateLimitExceeded(Exception):
+    def __init__(self, scope: str, limit: str, retry_after: float):
+        super().__init__(f"Rate limit reached for {limit} per {scope}")
+        self.scope = scope
+        self.limit = limit
+        self.retry_after = retry_after
+
+
+@dataclass(frozen=True)
+class Bucket:
+    scope: str
+    limit: str
+    key: str
+    capacity: float
+    rate: float
+    """Tokens added back per second."""
+    cost: float
+
+
+def estimate_tokens(body_size: int, completion_tokens: int) -> int:
+    """Tokens a request may consume, from its size and its completion budget."""
+    return body_size // CHARS_PER_TOKEN + completion_tokens
+
+
+class MemoryBackend:
+    """Limits enforced by this process only."""
+
+    def __init__(self, maxsize: int = 100_000):
+        self._buckets = TTLCache[str, tuple[float, float]](maxsize, 60)
+        self._streams: dict[str, dict[str, float]] = {}
+
+    async def take(self, buckets: list[Bucket]) -> tuple[float, Bucket | None]:
+        now = monotonic()
+        levels, wait, worst = [], 0.0, None
+        for bucket in buckets:
+            level, updated = self._buckets.get(bucket.key) or (bucket.capacity, now)
+            level = min(bucket.capacity, level + (now - updated) * bucket.rate)
+            levels.append(level)
+            if level < bucket.cost and (bucket.cost - level) / bucket.rate > wait:
+                wait, worst = (bucket.cost - level) / bucket.rate, bucket
+        if worst is not None:
+            return wait, worst
+        for bucket, level in zip(buckets, levels):
+            self._buckets.set(
+                bucket.key,
+                (level - bucket.cost, now),
+                ttl=bucket.capacity / bucket.rate,
+            )
+        return 0, None
+
+    async def open_stream(
+        self, slots: list[tuple[str, int]], stream_id: str, ttl: float
+    ) -> int:
+        now = monotonic()
+        for i, (key, limit) in enumerate(slots, 1):
+            streams = self._streams.setdefault(key, {})
+            for expired in [s for s, t in streams.items() if t <= now - ttl]:
+                del streams[expired]
+            if len(streams) >= limit:
+                return i
+        for key, _ in slots:
+            self._streams[key][stream_id] = now
+        return 0
+
+    async def refresh_stream(self, keys: list[str], stream_id: str, ttl: float) -> None:
+        now = monotonic()
+        for key in keys:
+            self._streams.setdefault(key, {})[stream_id] = now
+
+    async def close_stream(self, keys: list[str], stream_id: str) -> None:
+        for key in keys:
+            streams = self._streams.get(key, {})
+            streams.pop(stream_id, None)
+            if not streams:
+                self._streams.pop(key, None)
+
+
+class ValkeyBackend:
+    """Limits shared by every node through Valkey, enforced by atomic scripts."""
+
+    def __init__(self, valkey: Valkey):
+        self.valkey = valkey
+        self._take = valkey.register_script(_TAKE_SCRIPT)
+        self._open_stream = valkey.register_script(_OPEN_STREAM_SCRIPT)
+        self._refresh_stream = valkey.register_script(_REFRESH_STREAM_SCRIPT)
+
+    async def take(self, buckets: list[Bucket]) -> tuple[float, Bucket | None]:
+        args = [v for b in buckets for v in (b.capacity, b.rate, b.cost)]
+        wait, worst = await self._take(keys=[b.key for b in buckets], args=args)
+        if not int(worst):
+            return 0, None
+        return float(wait), buckets[int(worst) - 1]
+
+    async def open_stream(
+        self, slots: list[tuple[str, int]], stream_id: str, ttl: float
+    ) -> int:
+        args = [ttl, stream_id, *(limit for _, limit in slots)]
+        return int(await self._open_stream(keys=[k for k, _ in slots], args=args))
+
+    async def refresh_stream(self, keys: list[str], stream_id: str, ttl: float) -> None:
+        await self._refresh_stream(keys=keys, args=[ttl, stream_id])
+
+    async def close_stream(self, keys: list[str], stream_id: str) -> None:
+        async with self.valkey.pipeline(transaction=False) as pipe:
+            for key in keys:
+                pipe.zrem(key, stream_id)
+            await pipe.execute()
+
+
+class RateLimiter:
+    """Token buckets for requests and tokens per minute, and stream slots.
+
+    Every limit applies both per API key and per project, a limit of 0 is no
+    limit. A request is admitted only when every bucket it draws from can pay
+    for it, and is otherwise rejected right away with the time to wait.
+    """
+
+    def __init__(
+        self,
+        key_limits: RateLimits,
+        project_limits: RateLimits,
+        *,
+        valkey: Valkey | None = None,
+        stream_ttl: float = 600,
+    ):
+        self.limits = {"key": key_limits, "project": project_limits}
+        self.backend = MemoryBackend() if valkey is None else ValkeyBackend(valkey)
+        self.stream_ttl = stream_ttl
+        """Seconds after which a stream slot is reclaimed if it was never closed.
+
+        The slot is refreshed while events are relayed, so only a stream that
+        was left without being closed, or that stalls for that long, loses it.
+        """
+
+    @classmethod
+    def from_settings(
+        cls, settings: Settings, valkey: Valkey | None = None
+    ) -> "RateLimiter":
+        return cls(
+            settings.key_rate_limits,
+            settings.project_rate_limits,
+            valkey=valkey,
+            stream_ttl=settings.upstream_deadline,
+        )
+
+    def _scopes(self, principal: Principal) -> list[tuple[str, str, RateLimits]]:
+        scopes = [("key", principal.key_id, self.limits["key"])]
+        if principal.project_id is not None:
+            scopes.append(("project", principal.project_id, self.limits["project"]))
+        return scopes
+
+    def _stream_keys(self, principal: Principal) -> list[tuple[str, str, int]]:
+        return [
+            (scope, f"fastoai:streams:{scope}:{id}", limits.streams)
+            for scope, id, limits in self._scopes(principal)
+            if limits.streams > 0
+        ]
+
+    async def admit(self, principal: Principal, *, tokens: int = 0) -> None:
+        """Draw one request and `tokens` from the buckets of `principal`."""
+        buckets = []
+        for scope, id, limits in self._scopes(principal):
+            for limit, capacity, cost in [
+                ("rpm", limits.rpm, 1),
+                ("tpm", limits.tpm, tokens),
+            ]:
+                if capacity > 0 and cost > 0:
+                    buckets.append(
+                        Bucket(
+                            scope,
+                            limit,
+                            f"fastoai:ratelimit:{scope}:{id}:{limit}",
+                            capacity,
+                            capacity / 60,
+                            # A request larger than a bucket waits for it to be full.
+                            min(cost, capacity),
+                        )
+                    )
+        if not buckets:
+            return
+        wait, bucket = await self.backend.take(buckets)
+        if bucket is not None:
+            RATE_LIMITED.inc(scope=bucket.scope, limit=bucket.limit)
+            raise RateLimitExceeded(bucket.scope, bucket.limit, wait)
+
+    async def stream[T](
+        self, principal: Principal, open: Callable[[], Awaitable[AsyncIterator[T]]]
+    ) -> AsyncIterator[T]:
+        """Open a stream within the concurrent streams allowed to `principal`.
+
+        The slot is taken before `open` is called and given back once the
+        returned iterator is exhausted or closed.
+        """
+        slots = self._stream_keys(principal)
+        if not slots:
+            return await open()
+        stream_id = uuid4().hex
+        rejected = await self.backend.open_stream(
+            [(key, limit) for _, key, limit in slots], stream_id, self.stream_ttl
+        )
+        if rejected:
+            scope = slots[rejected - 1][0]
+            RATE_LIMITED.inc(scope=scope, limit="streams")
+            raise RateLimitExceeded(scope, "streams", 1)
+        keys = [key for _, key, _ in slots]
+        try:
+            events = await open()
+        except BaseException:
+            await self.backend.close_stream(keys, stream_id)
+            raise
+        return self._hold(events, keys, stream_id)
+
+    async def _hold[T](
+        self, events: AsyncIterator[T], keys: list[str], stream_id: str
+    ) -> AsyncIterator[T]:
+        refreshed = monotonic()
+        try:
+            async with aclosing(events):  # type: ignore[type-var]
+                async for event in events:
+                    if monotonic() - refreshed >= self.stream_ttl / 2:
+                        refreshed = monotonic()
+                        await self.backend.refresh_stream(
+                            keys, stream_id, self.stream_ttl
+                        )
+                    yield event
+        finally:
+            with anyio.CancelScope(shield=True):
+                await self.backend.close_stream(keys, stream_id)
+
+
+def retry_after(exc: RateLimitExceeded) -> str:
+    """The `Retry-After` header value, in whole seconds."""
+    return str(max(math.ceil(exc.retry_after), 1))
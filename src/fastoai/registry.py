@@ -0,0 +1,127 @@
+import asyncio
+from contextlib import asynccontextmanager, suppress
+
+from loguru import logger
+from openai import AsyncClient
+from openai.types import Model
+
+from ._client import Endpoint
+from .circuit import CircuitBreaker
+from .metrics import registry as metrics
+from .queueing import PriorityQueue
+from .settings import OpenAISettings, Settings
+
+REFRESH_FAILURES = metrics.counter(
+    "fastoai_model_refresh_failures_total",
+    "Model list refreshes that failed, keeping the last known good list.",
+    ["endpoint"],
+)
+ENDPOINT_MODELS = metrics.gauge(
+    "fastoai_endpoint_models", "Models currently served by an endpoint.", ["endpoint"]
+)
+
+
+class ModelRegistry:
+    """Models served by every upstream endpoint, refreshed in the background.
+
+    Requests are answered from memory. An endpoint that fails to list its models
+    keeps the list from its last successful refresh.
+    """
+
+    def __init__(self, settings: Settings):
+        self.interval = settings.models_refresh_interval
+        self.timeout = settings.models_refresh_timeout
+        self.endpoints = [
+            self._create_endpoint(endpoint, settings) for endpoint in settings.endpoints
+        ]
+        self._index: dict[str, list[Endpoint]] = {}
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _create_endpoint(endpoint: OpenAISettings, settings: Settings) -> Endpoint:
+        http_client = endpoint.create_http_client()
+        return Endpoint(
+            base_url=endpoint.base_url,
+            api_key=endpoint.api_key,
+            weight=endpoint.weight,
+            breaker=CircuitBreaker(
+                endpoint.base_url,
+                failure_threshold=settings.circuit_failure_threshold,
+                cooldown=settings.circuit_cooldown,
+                probes=settings.circuit_half_open_probes,
+            ),
+            queue=PriorityQueue(
+                endpoint.base_url,
+                max_concurrency=endpoint.max_concurrent_requests,
+                max_size=endpoint.max_queue_size,
+                timeout=settings.upstream_queue_timeout,
+            ),
+            http_client=http_client,
+            client=AsyncClient(
+                api_key=endpoint.api_key,
+                base_url=endpoint.base_url,
+                max_retries=0,
+                http_client=http_client,
+            ),
+        )
+
+    def models(self) -> list[Model]:
+        """All known models, the first endpoint serving an id wins."""
+        models: dict[str, Model] = {}
+        for endpoint in self.endpoints:
+            for model in endpoint.models:
+                models.setdefault(model.id, model)
+        return list(models.values())
+
+    def candidates(self, model: str | None) -> list[Endpoint]:
+        """Endpoints serving `model`, every endpoint when no model is given."""
+        if model is None:
+            return self.endpoints
+        return self._index.get(model, [])
+
+    def _build_index(self) -> None:
+        index: dict[str, list[Endpoint]] = {}
+        for endpoint in self.endpoints:
+            for model in endpoint.models:
+                index.setdefault(model.id, []).append(endpoint)
+        self._index = index
+
+    async def _refresh_endpoint(self, endpoint: Endpoint) -> None:
+        try:
+            async with asyncio.timeout(self.timeout):
+                page = await endpoint.client.models.list()
+        except Exception as exc:
+            REFRESH_FAILURES.inc(endpoint=endpoint.base_url)
+            logger.error(f"Failed to list models of {endpoint.base_url}: {exc}")
+            return
+        endpoint.models = page.data
+        ENDPOINT_MODELS.set(len(page.data), endpoint=endpoint.base_url)
+
+    async def refresh(self) -> None:
+        """List the models of every endpoint concurrently."""
+        async with self._lock:
+            await asyncio.gather(*map(self._refresh_endpoint, self.endpoints))
+            self._build_index()
+
+    async def _refresh_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.refresh()
+
+    async def aclose(self) -> None:
+        """Close the connection pool of every endpoint."""
+        for endpoint in self.endpoints:
+            await endpoint.client.close()
+
+    @asynccontextmanager
+    async def serve(self):
+        """Refresh once, then keep refreshing until the context exits."""
+        await self.refresh()
+        task = asyncio.create_task(self._refresh_periodically())
+        try:
+            yield self
+        finally:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+            await self.aclose()
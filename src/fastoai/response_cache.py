@@ -0,0 +1,286 @@
+import asyncio
+import hashlib
+import json
+from collections.abc import AsyncIterator, Iterator, Mapping
+from contextlib import aclosing
+from typing import Any
+
+from loguru import logger
+from valkey.asyncio import Valkey
+
+from .cache import VALKEY_ERRORS, TTLCache
+from .metrics import registry
+from .settings import Settings
+from .streaming import ChunkTransform, format_event
+
+CACHE_HITS = registry.counter(
+    "fastoai_response_cache_hits_total",
+    "Chat completions answered from the response cache.",
+    ["tier"],
+)
+CACHE_MISSES = registry.counter(
+    "fastoai_response_cache_misses_total",
+    "Cacheable chat completions that had to be sent upstream.",
+)
+CACHE_ENTRIES = registry.gauge(
+    "fastoai_response_cache_entries",
+    "Responses held in the in-process tier of the response cache.",
+)
+
+BYPASS_DIRECTIVES = frozenset({"no-cache", "no-store"})
+STREAM_PARAMS = ("stream", "stream_options")
+"""Request fields that only change how a completion is delivered."""
+
+
+def request_key(body: bytes, *, model: str, scope: str) -> str:
+    """Canonical hash of a chat completion request, however it is delivered.
+
+    The order of the keys and the whitespace of the body do not matter, the
+    scope of the caller keeps requests of different projects apart.
+    """
+    params = json.loads(body)
+    for name in STREAM_PARAMS:
+        params.pop(name, None)
+    canonical = json.dumps(
+        params, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    )
+    digest = hashlib.sha256()
+    for part in (scope, model, canonical):
+        digest.update(part.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def bypasses_cache(headers: Mapping[str, str]) -> bool:
+    """Whether the caller opted out with `Cache-Control: no-cache` or `no-store`."""
+    directives = headers.get("cache-control", "").lower().split(",")
+    return any(d.strip() in BYPASS_DIRECTIVES for d in directives)
+
+
+class ResponseCache:
+    """Exact-match cache of chat completions.
+
+    Entries are keyed on `request_key`, so responses never cross projects. The
+    in-process tier is an LRU bounded by `maxsize` entries, the optional Valkey
+    tier is shared by every node. Responses larger than `max_entry_size` bytes
+    are never stored.
+
+    Streamed and non-streamed requests share entries, a cached completion is
+    replayed as a stream of `replay_chunk_size` characters per chunk, sent
+    every `replay_interval` seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        maxsize: int = 1000,
+        ttl: float = 3600,
+        max_entry_size: int = 1 << 20,
+        replay_chunk_size: int = 16,
+        replay_interval: float = 0,
+        valkey: Valkey | None = None,
+    ):
+        self.local = TTLCache[str, bytes](maxsize, ttl)
+        self.max_entry_size = max_entry_size
+        self.replay_chunk_size = replay_chunk_size
+        self.replay_interval = replay_interval
+        self.valkey = valkey
+        CACHE_ENTRIES.set_function(lambda: len(self.local))
+
+    @classmethod
+    def from_settings(
+        cls, settings: Settings, valkey: Valkey | None = None
+    ) -> "ResponseCache | None":
+        """The cache configured by `settings`, None when it is disabled."""
+        if not settings.response_cache:
+            return None
+        return cls(
+            maxsize=settings.response_cache_size,
+            ttl=settings.response_cache_ttl,
+            max_entry_size=settings.response_cache_max_entry_size,
+            replay_chunk_size=settings.response_cache_replay_chunk_size,
+            replay_interval=settings.response_cache_replay_interval,
+            valkey=valkey,
+        )
+
+    def _valkey_key(self, key: str) -> str:
+        return f"fastoai:response:{key}"
+
+    async def get(self, key: str) -> bytes | None:
+        if (content := self.local.get(key)) is not None:
+            CACHE_HITS.inc(tier="memory")
+            return content
+        if self.valkey is not None:
+            try:
+                content = await self.valkey.get(self._valkey_key(key))
+            except VALKEY_ERRORS as exc:
+                logger.warning(f"Failed to read a cached response from Valkey: {exc}")
+                content = None
+            if content is not None:
+                CACHE_HITS.inc(tier="valkey")
+                self.local.set(key, content)
+                return content
+        CACHE_MISSES.inc()
+        return None
+
+    async def set(self, key: str, content: bytes) -> None:
+        if len(content) > self.max_entry_size:
+            return
+        self.local.set(key, content)
+        if self.valkey is None:
+            return
+        try:
+            await self.valkey.set(
+                self._valkey_key(key), content, ex=max(int(self.local.ttl), 1)
+            )
+        except VALKEY_ERRORS as exc:
+            logger.warning(f"Failed to cache a response in Valkey: {exc}")
+
+    async def replay(
+        self,
+        content: bytes,
+        *,
+        include_usage: bool = False,
+        transform: ChunkTransform | None = None,
+    ) -> AsyncIterator[bytes]:
+        """Send a cached completion as the event stream it would have been."""
+        completion = json.loads(content)
+        for i, chunk in enumerate(
+            completion_chunks(completion, self.replay_chunk_size, include_usage)
+        ):
+            if i and self.replay_interval:
+                await asyncio.sleep(self.replay_interval)
+            if transform is not None and (chunk := transform(chunk)) is None:
+                continue
+            yield format_event(chunk)
+        yield b"data: [DONE]\n\n"
+
+    async def store_stream(
+        self, key: str, events: AsyncIterator[bytes], assembler: "CompletionAssembler"
+    ) -> AsyncIterator[bytes]:
+        """Forward `events` and cache the completion once they all went through."""
+        async with aclosing(events):
+            async for event in events:
+                yield event
+        if (completion := assembler.completion()) is not None:
+            await self.set(key, json.dumps(completion).encode())
+
+
+class CompletionAssembler:
+    """Rebuild the chat completion that the chunks of a stream add up to.
+
+    Pass it as the `observe` hook of `relay_sse`, `completion()` is None until
+    every choice received its finish reason.
+    """
+
+    def __init__(self):
+        self._head: dict[str, Any] = {}
+        self._choices: dict[int, dict[str, Any]] = {}
+        self._usage: dict[str, Any] | None = None
+
+    def __call__(self, chunk: dict[str, Any]) -> None:
+        if not self._head:
+            self._head = {
+                k: chunk.get(k)
+                for k in ("id", "created", "model", "system_fingerprint")
+            }
+        if chunk.get("usage"):
+            self._usage = chunk["usage"]
+        for choice in chunk.get("choices") or ():
+            state = self._choices.setdefault(
+                choice["index"],
+                {"role": "assistant", "content": [], "refusal": [], "tool_calls": {}},
+            )
+            delta = choice.get("delta") or {}
+            if delta.get("role"):
+                state["role"] = delta["role"]
+            for field in ("content", "refusal"):
+                if delta.get(field):
+                    state[field].append(delta[field])
+            for call in delta.get("tool_calls") or ():
+                tool_call = state["tool_calls"].setdefault(
+                    call["index"],
+                    {"id": None, "type": "function", "name": "", "arguments": []},
+                )
+                function = call.get("function") or {}
+                tool_call["id"] = call.get("id") or tool_call["id"]
+                tool_call["type"] = call.get("type") or tool_call["type"]
+                tool_call["name"] += function.get("name") or ""
+                tool_call["arguments"].append(function.get("arguments") or "")
+            if choice.get("finish_reason"):
+                state["finish_reason"] = choice["finish_reason"]
+
+    def content(self, index: int = 0) -> str:
+        """The text received so far for the choice `index`."""
+        state = self._choices.get(index)
+        return "" if state is None else "".join(state["content"])
+
+    def completion(self) -> dict[str, Any] | None:
+        if not self._choices or any(
+            "finish_reason" not in s for s in self._choices.values()
+        ):
+            return None
+        choices = []
+        for index, state in sorted(self._choices.items()):
+            message: dict[str, Any] = {
+                "role": state["role"],
+                "content": "".join(state["content"]) or None,
+                "refusal": "".join(state["refusal"]) or None,
+            }
+            if state["tool_calls"]:
+                message["tool_calls"] = [
+                    {
+                        "id": call["id"],
+                        "type": call["type"],
+                        "function": {
+                            "name": call["name"],
+                            "arguments": "".join(call["arguments"]),
+                        },
+                    }
+                    for _, call in sorted(state["tool_calls"].items())
+                ]
+            choices.append(
+                {
+                    "index": index,
+                    "message": message,
+                    "finish_reason": state["finish_reason"],
+                    "logprobs": None,
+                }
+            )
+        return {
+            **self._head,
+            "object": "chat.completion",
+            "choices": choices,
+            "usage": self._usage,
+        }
+
+
+def completion_chunks(
+    completion: dict[str, Any], chunk_size: int, include_usage: bool = False
+) -> Iterator[dict[str, Any]]:
+    """Split a chat completion into the chunks a stream would have carried."""
+    head = {
+        "id": completion.get("id"),
+        "object": "chat.completion.chunk",
+        "created": completion.get("created"),
+        "model": completion.get("model"),
+        "system_fingerprint": completion.get("system_fingerprint"),
+    }
+
+    def chunk(index: int, delta: dict[str, Any], finish_reason=None):
+        choice = {"index": index, "delta": delta, "finish_reason": finish_reason}
+        return {**head, "choices": [choice]}
+
+    size = max(chunk_size, 1)
+    for choice in completion.get("choices") or ():
+        index, message = choice["index"], choice.get("message") or {}
+        yield chunk(index, {"role": message.get("role", "assistant"), "content": ""})
+        for field in ("content", "refusal"):
+            text = message.get(field) or ""
+            for start in range(0, len(text), size):
+                yield chunk(index, {field: text[start : start + size]})
+        for i, call in enumerate(message.get("tool_calls") or ()):
+            yield chunk(index, {"tool_calls": [{"index": i, **call}]})
+        yield chunk(index, {}, choice.get("finish_reason"))
+    if include_usage and completion.get("usage"):
+        yield {**head, "choices": [], "usage": completion["usage"]}
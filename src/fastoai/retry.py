@@ -0,0 +1,71 @@
+import random
+from collections.abc import Mapping
+
+import httpx
+from openai import APIConnectionError, APIStatusError, APITimeoutError
+
+from .metrics import registry
+
+RETRIES = registry.counter(
+    "fastoai_upstream_retries_total",
+    "Upstream requests attempted again after a retryable failure.",
+    ["endpoint", "reason"],
+)
+RETRY_EXHAUSTED = registry.counter(
+    "fastoai_upstream_retry_exhausted_total",
+    "Upstream requests that failed after running out of attempts or deadline.",
+)
+
+IDEMPOTENT_METHODS = frozenset({"get", "head", "options", "put", "delete"})
+NOT_PROCESSED_STATUS = frozenset({429, 502, 503, 504})
+"""Statuses guaranteeing the upstream did not act on the request."""
+TRANSIENT_STATUS = NOT_PROCESSED_STATUS | {408, 409, 500}
+
+
+class RetryPolicy:
+    """One budget for retries and failover across endpoints.
+
+    The SDK's own retries are disabled so that an upstream call is attempted at
+    most `max_attempts` times in total, and never after `deadline` seconds since
+    the first attempt started.
+    """
+
+    def __init__(
+        self,
+        *,
+        max_attempts: int = 3,
+        deadline: float = 600,
+        backoff: float = 0.25,
+        max_backoff: float = 4,
+    ):
+        self.max_attempts = max_attempts
+        self.deadline = deadline
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def delay(self, attempt: int) -> float:
+        """Full jitter exponential backoff before the `attempt`-th retry."""
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2**attempt))
+
+    def is_retryable(self, exc: Exception, *, idempotent: bool) -> bool:
+        """Whether `exc` is worth another attempt.
+
+        Client errors are not, apart from 408, 409 and 429 which may succeed
+        later. Requests that are not idempotent are only retried when the
+        upstream cannot have processed them, a timeout could mean it is still
+        working.
+        """
+        if isinstance(exc, APITimeoutError | httpx.TimeoutException):
+            return idempotent
+        if isinstance(exc, APIConnectionError | httpx.TransportError):
+            return True
+        if isinstance(exc, APIStatusError):
+            statuses = TRANSIENT_STATUS if idempotent else NOT_PROCESSED_STATUS
+            return exc.status_code in statuses
+        return False
+
+
+def is_idempotent(method: str, headers: Mapping[str, str]) -> bool:
+    if method.lower() in IDEMPOTENT_METHODS:
+        return True
+    return any(k.lower() == "idempotency-key" for k in headers)
@@ -1,14 +1,32 @@
-from typing import AsyncIterable, cast
+from typing import Any
 
-from fastapi import APIRouter, Depends
-from fastapi.responses import StreamingResponse
-from openai.types.chat.chat_completion import ChatCompletion
-from openai.types.chat.chat_completion_chunk import ChatCompletionChunk
+from fastapi import APIRouter, Depends, Request
+from fastapi.exceptions import RequestValidationError
+from fastapi.responses import Response
 from openai.types.chat.completion_create_params import CompletionCreateParams
-from pydantic import RootModel
+from pydantic import BaseModel, TypeAdapter, ValidationError
 
-from ..dependencies import ClientDependency, get_user
+from ..dependencies import (
+    ChunkTransformDependency,
+    ClientDependency,
+    RateLimiterDependency,
+    ResponseCacheDependency,
+    SettingsDependency,
+    UsageRecorderDependency,
+    UserDependency,
+    get_priority,
+    get_user,
+)
+from ..ratelimit import estimate_tokens
+from ..response_cache import (
+    CompletionAssembler,
+    ResponseCache,
+    bypasses_cache,
+    request_key,
+)
+from ..streaming import ChunkTransform, EventStreamResponse, relay_sse
 from .beta import router as beta_router
+from .embeddings import router as embeddings_router
 from .files import router as files_router
 from .models import router as models_router
 
@@ -17,27 +35,127 @@ router = APIRouter(dependencies=[Depends(get_user)])
 chat_router = APIRouter(tags=["Chat"])
 
 
-@chat_router.post("/chat/completions")
+class _Routing(BaseModel):
+    """The only fields of a chat completion the proxy needs to route it."""
+
+    model: str
+    stream: bool | None = False
+    stream_options: dict[str, Any] | None = None
+    max_tokens: int | None = None
+    max_completion_tokens: int | None = None
+
+
+class _Usage(BaseModel):
+    usage: dict[str, Any] | None = None
+
+
+_completion_create_params = TypeAdapter(CompletionCreateParams)
+
+
+@chat_router.post("/chat/completions", dependencies=[Depends(get_priority)])
 async def create_chat_completions(
-    params: RootModel[CompletionCreateParams],
+    request: Request,
     client: ClientDependency,
+    transform: ChunkTransformDependency,
+    settings: SettingsDependency,
+    cache: ResponseCacheDependency,
+    limiter: RateLimiterDependency,
+    usage: UsageRecorderDependency,
+    user: UserDependency,
 ):
-    response = await client.chat.completions.create(**params.model_dump())
-    if params.root.get("stream", False):
-        response = cast(AsyncIterable[ChatCompletionChunk], response)
+    body = await request.body()
+    try:
+        if settings.chat_completions_validation == "strict":
+            params = _completion_create_params.validate_json(body)
+            list(params["messages"])  # iterables are only validated when consumed
+        routing = _Routing.model_validate_json(body)
+    except ValidationError as exc:
+        raise RequestValidationError(exc.errors(include_url=False), body=body)
+    if cache is not None and bypasses_cache(request.headers):
+        cache = None
+    coalesce = not routing.stream and client.coalesces(routing.model)
+    key = None
+    if cache is not None or coalesce:
+        key = request_key(
+            body, model=routing.model, scope=user.project_id or user.owner_id
+        )
+    if cache is not None and key is not None:
+        if (content := await cache.get(key)) is not None:
+            return _cached_response(cache, content, routing, transform)
+    completion_tokens = (
+        routing.max_completion_tokens
+        or routing.max_tokens
+        or settings.rate_limit_completion_tokens
+    )
+    await limiter.admit(user, tokens=estimate_tokens(len(body), completion_tokens))
+
+    def account(reported: dict[str, Any] | None):
+        usage.record(user, model=routing.model, kind="chat.completion", usage=reported)
+
+    if routing.stream:
+
+        def account_chunk(chunk: dict[str, Any] | None):
+            account(None if chunk is None else chunk.get("usage"))
+
+        async def open_stream():
+            response = await client.forward(
+                "/chat/completions", body, model=routing.model
+            )
+            if cache is None or key is None:
+                return relay_sse(response, transform=transform, last=account_chunk)
+            assembler = CompletionAssembler()
+            events = relay_sse(
+                response, transform=transform, observe=assembler, last=account_chunk
+            )
+            return cache.store_stream(key, events, assembler)
+
+        return EventStreamResponse(
+            await limiter.stream(user, open_stream),
+            headers={} if cache is None else {"X-Cache": "miss"},
+        )
+
+    async def read() -> bytes:
+        response = await client.forward("/chat/completions", body, model=routing.model)
+        try:
+            return await response.aread()
+        finally:
+            await response.aclose()
 
-        async def _stream(chunks: AsyncIterable[ChatCompletionChunk]):
-            async for chunk in chunks:
-                yield f"data: {chunk.model_dump_json(exclude_none=True)}\n\n"
+    if key is None:
+        content = await read()
+    else:
+        content = await client.coalesce(routing.model, key, read)
+    # Every caller sharing a coalesced call is charged for the completion.
+    try:
+        account(_Usage.model_validate_json(content).usage)
+    except ValidationError:
+        account(None)
+    if cache is None or key is None:
+        return Response(content, media_type="application/json")
+    await cache.set(key, content)
+    return Response(content, media_type="application/json", headers={"X-Cache": "miss"})
 
-            yield "data: [DONE]\n\n"
 
-        return StreamingResponse(_stream(response))
-    return cast(ChatCompletion, response)
+def _cached_response(
+    cache: ResponseCache,
+    content: bytes,
+    routing: _Routing,
+    transform: ChunkTransform | None,
+) -> Response:
+    if not routing.stream:
+        return Response(
+            content, media_type="application/json", headers={"X-Cache": "hit"}
+        )
+    include_usage = bool((routing.stream_options or {}).get("include_usage"))
+    return EventStreamResponse(
+        cache.replay(content, include_usage=include_usage, transform=transform),
+        headers={"X-Cache": "hit"},
+    )
 
 
 for subrouter in [
     chat_router,
+    embeddings_router,
     models_router,
     files_router,
     beta_router,
@@ -1,127 +1,61 @@
-from asyncio import timeout
-from datetime import datetime
-from functools import wraps
-from typing import cast
-
-from fastapi import APIRouter
-from fastapi.responses import StreamingResponse
-from openai.types.beta.assistant_stream_event import (
-    AssistantStreamEvent,
-    ErrorEvent,
-    ThreadMessageCreated,
-    ThreadMessageDelta,
-    ThreadMessageInProgress,
-    ThreadRunCompleted,
-    ThreadRunCreated,
-    ThreadRunExpired,
-    ThreadRunFailed,
-    ThreadRunInProgress,
-    ThreadRunQueued,
-    ThreadRunStepCreated,
-    ThreadRunStepInProgress,
-)
-from openai.types.beta.threads.run import LastError
-from openai.types.beta.threads.run_create_params import (
-    RunCreateParams,
-    RunCreateParamsStreaming,
-)
-from openai.types.beta.threads.runs.message_creation_step_details import (
-    MessageCreation,
-    MessageCreationStepDetails,
-)
-from openai.types.chat.chat_completion_message_param import ChatCompletionMessageParam
-from openai.types.shared import ErrorObject
+import json
+from collections.abc import AsyncIterator
+from contextlib import aclosing
+from typing import Annotated, Any
+
+from fastapi import APIRouter, Header, HTTPException, status
+from openai.types.beta.threads.run import Run as OpenAIRun
+from openai.types.beta.threads.run_create_params import RunCreateParams
 from pydantic import RootModel
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
 
-from ...dependencies import ClientDependency, SessionDependency
-from ...models import (
-    Assistant,
-    Message,
-    Run,
-    RunStep,
-    Thread,
-)
-
-
-def _(event: AssistantStreamEvent):
-    return f"event: {event.event}\ndata: {event.data.model_dump_json()}\n"
-
-
-def run_decorator(run_model: Run, session: SessionDependency):
-    def event_decorator(generator_func):
-        @wraps(generator_func)
-        async def wrapper(*args, **kwargs):
-            yield _(
-                ThreadRunCreated(
-                    data=await run_model.to_openai_model(),
-                    event="thread.run.created",
-                )
-            )
-            try:
-                async with timeout(
-                    None
-                    if run_model.expires_at is None
-                    else (run_model.expires_at - datetime.now()).total_seconds()
-                ):
-                    async for value in generator_func(*args, **kwargs):
-                        yield value
-
-                    run_model.status = "completed"
-                    session.add(run_model)
-                    await session.commit()
-                    yield _(
-                        ThreadRunCompleted(
-                            data=await run_model.to_openai_model(),
-                            event="thread.run.completed",
-                        )
-                    )
-                yield "event: done\ndata: [DONE]\n"
-            except TimeoutError:
-                run_model.status = "expired"
-                session.add(run_model)
-                await session.commit()
-                yield _(
-                    ThreadRunExpired(
-                        data=await run_model.to_openai_model(),
-                        event="thread.run.expired",
-                    )
-                )
-                yield _(
-                    ErrorEvent(
-                        data=ErrorObject(message="Run expired", type="TimeoutError"),
-                        event="error",
-                    )
-                )
-            except Exception as e:
-                run_model.status = "failed"
-                run_model.last_error = LastError(code="server_error", message=str(e))
-                session.add(run_model)
-                await session.commit()
-                yield _(
-                    ThreadRunFailed(
-                        data=await run_model.to_openai_model(),
-                        event="thread.run.failed",
-                    )
-                )
-
-        return wrapper
-
-    return event_decorator
-
+from ...dependencies import RunExecutorDependency, SessionDependency, UserDependency
+from ...executor import DONE_EVENT, RunExecutor, format_row_event
+from ...models import Assistant, Run, Thread
+from ...models._utils import now
+from ...streaming import EventStreamResponse
 
 router = APIRouter()
 
+ENDED_STATUSES = {"cancelled", "failed", "completed", "incomplete", "expired"}
+
+
+def _outcome_events(run: Run) -> list[str]:
+    return [format_row_event(f"thread.run.{run.status}", run), DONE_EVENT]
+
+
+def _outcome(executor: RunExecutor, run_id: str):
+    """Look up the outcome of a run, in case its events are not delivered here."""
+
+    async def outcome() -> list[str] | None:
+        async with AsyncSession(executor.engine) as session:
+            run = await session.get(Run, run_id)
+            if run is None or run.status not in ENDED_STATUSES:
+                return None
+            return _outcome_events(run)
+
+    return outcome
+
+
+async def _stream(run: dict[str, Any], events: AsyncIterator[str]):
+    data = json.dumps(run, separators=(",", ":"))
+    yield f"event: thread.run.created\ndata: {data}\n\n"
+    yield f"event: thread.run.queued\ndata: {data}\n\n"
+    async with aclosing(events):  # type: ignore[type-var]
+        async for event in events:
+            yield event
+
 
 @router.post("/threads/{thread_id}/runs")
 async def create_run(
     thread_id: str,
     params: RootModel[RunCreateParams],
     session: SessionDependency,
-    client: ClientDependency,
+    executor: RunExecutorDependency,
+    user: UserDependency,
 ):
-    if not params.root.get("stream", False):
-        raise NotImplementedError("Non-streaming is not yet supported")
-    run_params = cast(RunCreateParamsStreaming, params.model_dump())
+    run_params = params.root
     assistant = await session.get_one(Assistant, run_params["assistant_id"])
     thread = await session.get_one(Thread, thread_id)
     run = Run(  # type: ignore
@@ -133,109 +67,81 @@ async def create_run(
         parallel_tool_calls=run_params.get("parallel_tool_calls", True),
         tools=run_params.get("tools") or assistant.tools,
     )
-    messages: list[ChatCompletionMessageParam] = [
-        {"role": "system", "content": run.instructions},
-        *[m.model_dump() for m in thread.messages],  # type: ignore
-    ]
-
-    async def message_creation_step():
-        message = Message(  # type: ignore
-            thread=thread,
-            assistant=assistant,
-            run=run,
-            content=[],
-            role="assistant",
-            status="in_progress",
-        )
-        session.add(message)
-        step = RunStep(  # type: ignore
-            run=run,
-            thread=thread,
-            assistant=assistant,
-            status="in_progress",
-            type="message_creation",
-            step_details=MessageCreationStepDetails(
-                message_creation=MessageCreation(message_id=message.id),
-                type="message_creation",
-            ),
-        )
-        yield _(
-            ThreadRunStepCreated(
-                data=await step.to_openai_model(),
-                event="thread.run.step.created",
-            )
-        )
-        session.add(step)
-        await session.commit()
-        await session.refresh(step)
-        yield _(
-            ThreadRunStepInProgress(
-                data=await step.to_openai_model(),
-                event="thread.run.step.in_progress",
-            )
-        )
-        yield _(
-            ThreadMessageCreated(
-                data=await message.to_openai_model(),
-                event="thread.message.created",
-            )
-        )
-        await session.commit()
-        await session.refresh(message)
-        yield _(
-            ThreadMessageInProgress(
-                data=await message.to_openai_model(), event="thread.message.in_progress"
-            )
-        )
-        async for part in await client.chat.completions.create(
-            model=assistant.model,
-            messages=messages,
-            stream=True,
-        ):
-            yield _(
-                ThreadMessageDelta.model_validate(
-                    dict(
-                        event="thread.message.delta",
-                        data=dict(
-                            id=message.id,
-                            delta=dict(
-                                content=[
-                                    dict(
-                                        index=0,
-                                        type="text",
-                                        text=dict(
-                                            value=part.choices[0].delta.content,
-                                            annotations=[],
-                                        ),
-                                    )
-                                ],
-                                role="assistant",
-                            ),
-                            object="thread.message.delta",
-                        ),
-                    )
-                )
-            )
+    session.add(run)
+    await session.flush()
+    executor.queue.enqueue(session, run.id, user)
+    # Dumped before it expires on commit, rather than refreshed after.
+    data = run.model_dump(by_alias=True, mode="json") | {"object": "thread.run"}
+    await session.commit()
+    executor.notify()
+    if not run_params.get("stream", False):
+        return data
+    events = executor.events.subscribe(
+        data["id"], outcome=_outcome(executor, data["id"])
+    )
+    return EventStreamResponse(_stream(data, events))
+
+
+async def _get_run(session: SessionDependency, thread_id: str, run_id: str) -> Run:
+    statement = select(Run).where(Run.id == run_id, Run.thread_id == thread_id)
+    return (await session.exec(statement)).one()
 
-    @run_decorator(run, session)
-    async def xrun():
-        session.add(run)
-        await session.commit()
-        await session.refresh(run)
-        yield _(
-            ThreadRunQueued(
-                event="thread.run.queued",
-                data=await run.to_openai_model(),
-            )
-        )
 
-        yield _(
-            ThreadRunInProgress(
-                event="thread.run.in_progress",
-                data=await run.to_openai_model(),
+@router.get("/threads/{thread_id}/runs/{run_id}")
+async def retrieve_run(
+    thread_id: str, run_id: str, session: SessionDependency
+) -> OpenAIRun:
+    return await (await _get_run(session, thread_id, run_id)).to_openai_model()
+
+
+@router.get("/threads/{thread_id}/runs/{run_id}/events")
+async def stream_run(
+    thread_id: str,
+    run_id: str,
+    session: SessionDependency,
+    executor: RunExecutorDependency,
+    last_event_id: Annotated[int, Header()] = 0,
+):
+    """Stream the events of a run following `Last-Event-ID`.
+
+    Clients joining late or reconnecting get the events still buffered
+    instead of executing the run again.
+    """
+    run = await _get_run(session, thread_id, run_id)
+    if run.status not in ENDED_STATUSES:
+        return EventStreamResponse(
+            executor.events.subscribe(
+                run.id, last_event_id, outcome=_outcome(executor, run.id)
             )
         )
-        async for message in message_creation_step():
-            yield message
+    events = await executor.events.replay(run.id, last_event_id)
+    if events is None:
+        # Its events are no longer buffered, only its outcome is left.
+        events = _outcome_events(run)
+    return EventStreamResponse(iter(events))
 
-    return StreamingResponse(xrun())
+
+@router.post("/threads/{thread_id}/runs/{run_id}/cancel")
+async def cancel_run(
+    thread_id: str,
+    run_id: str,
+    session: SessionDependency,
+    executor: RunExecutorDependency,
+) -> OpenAIRun:
+    run = await _get_run(session, thread_id, run_id)
+    if run.status == "queued":
+        # Skipped by the worker that picks it up.
+        run.status = "cancelled"
+        run.cancelled_at = now()
+    elif run.status == "in_progress":
+        run.status = "cancelling"
+    else:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"Cannot cancel run with status '{run.status}'.",
+        )
+    session.add(run)
+    data = await run.to_openai_model()
+    await session.commit()
+    executor.cancel(data.id)
+    return data
@@ -0,0 +1,45 @@
+import json
+
+from fastapi import APIRouter, Depends
+from fastapi.responses import Response
+from pydantic import BaseModel, ConfigDict
+
+from ..dependencies import (
+    EmbeddingBatcherDependency,
+    RateLimiterDependency,
+    UsageRecorderDependency,
+    UserDependency,
+    get_priority,
+)
+from ..ratelimit import estimate_tokens
+
+router = APIRouter(tags=["Embeddings"])
+
+
+class EmbeddingCreateParams(BaseModel):
+    model_config = ConfigDict(extra="allow")
+
+    model: str
+    input: str | list[str] | list[int] | list[list[int]]
+
+
+def _input_tokens(input: str | list) -> int:
+    if isinstance(input, str):
+        return estimate_tokens(len(input), 0)
+    if input and isinstance(input[0], int):
+        return len(input)
+    return sum(map(_input_tokens, input))
+
+
+@router.post("/embeddings", dependencies=[Depends(get_priority)])
+async def create_embeddings(
+    params: EmbeddingCreateParams,
+    batcher: EmbeddingBatcherDependency,
+    limiter: RateLimiterDependency,
+    usage: UsageRecorderDependency,
+    user: UserDependency,
+):
+    await limiter.admit(user, tokens=_input_tokens(params.input))
+    result = await batcher.embed(params.model_dump())
+    usage.record(user, model=params.model, kind="embedding", usage=result.get("usage"))
+    return Response(json.dumps(result), media_type="application/json")
@@ -1,20 +1,30 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends
 from openai.pagination import AsyncPage
 from openai.types import Model
 from openai.types.model_deleted import ModelDeleted
 
-from ..dependencies import ClientDependency, SettingsDependency
+from ..dependencies import ClientDependency, RegistryDependency, require_owner
 
 router = APIRouter(tags=["Models"])
 
 
 @router.get("/models", response_model=AsyncPage[Model])
-async def get_models(*, settings: SettingsDependency) -> AsyncPage[Model]:
-    client = await settings.get_openai_client()
-    return AsyncPage(
-        data=[model for endpoint in client.endpoints for model in endpoint.models],
-        object="list",
-    )
+async def get_models(*, registry: RegistryDependency) -> AsyncPage[Model]:
+    return AsyncPage(data=registry.models(), object="list")
+
+
+@router.post(
+    "/models/refresh",
+    response_model=AsyncPage[Model],
+    dependencies=[Depends(require_owner)],
+)
+async def refresh_models(*, registry: RegistryDependency) -> AsyncPage[Model]:
+    """Refresh the models of every endpoint now instead of at the next interval.
+
+    Only project owners may call it, since every refresh queries each endpoint.
+    """
+    await registry.refresh()
+    return AsyncPage(data=registry.models(), object="list")
 
 
 @router.get("/models/{model:path}", response_model=Model)
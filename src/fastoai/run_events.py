@@ -0,0 +1,263 @@
+"""Event bus of the runs, replaying recent events to late subscribers."""
+
+import asyncio
+from collections import deque
+from collections.abc import AsyncIterator, Awaitable, Callable
+from contextlib import aclosing, suppress
+from itertools import islice
+
+from loguru import logger
+from valkey.asyncio import Valkey
+
+from .settings import Settings
+
+_PUBLISH_SCRIPT = """
+local size, ttl, channel = tonumber(ARGV[1]), tonumber(ARGV[2]), ARGV[3]
+for i = 4, #ARGV do
+    local entry = redis.call('INCR', KEYS[2]) .. '\\n' .. ARGV[i]
+    redis.call('RPUSH', KEYS[1], entry)
+    redis.call('PUBLISH', channel, entry)
+end
+redis.call('LTRIM', KEYS[1], -size, -1)
+redis.call('EXPIRE', KEYS[1], ttl)
+redis.call('EXPIRE', KEYS[2], ttl)
+"""
+
+_END = ""
+"""Event marking the end of the events of a run."""
+
+
+def _parse(entry: bytes | str) -> tuple[int, str]:
+    if isinstance(entry, bytes):
+        entry = entry.decode()
+    sequence, _, event = entry.partition("\n")
+    return int(sequence), event
+
+
+class _Log:
+    def __init__(self, size: int):
+        self.events = deque[tuple[int, str]](maxlen=size)
+        self.sequence = 0
+        self.subscribers = 0
+        self.changed = asyncio.Event()
+
+    def append(self, event: str) -> None:
+        self.sequence += 1
+        self.events.append((self.sequence, event))
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def since(self, after: int) -> list[tuple[int, str]]:
+        if not self.events:
+            return []
+        start = max(after + 1 - self.events[0][0], 0)
+        return list(islice(self.events, start, None))
+
+
+class MemoryBackend:
+    """Events delivered to the subscribers in this process only."""
+
+    def __init__(self, size: int, retention: float):
+        self.size = size
+        self.retention = retention
+        self._logs: dict[str, _Log] = {}
+
+    def publish(self, run_id: str, event: str) -> None:
+        log = self._logs.setdefault(run_id, _Log(self.size))
+        log.append(event)
+        if event == _END:
+            asyncio.get_running_loop().call_later(
+                self.retention, self._forget, run_id, log
+            )
+
+    def _forget(self, run_id: str, log: _Log) -> None:
+        if self._logs.get(run_id) is log:
+            del self._logs[run_id]
+
+    async def replay(self, run_id: str, after: int) -> list[tuple[int, str]] | None:
+        log = self._logs.get(run_id)
+        return None if log is None else log.since(after)
+
+    async def subscribe(
+        self, run_id: str, after: int
+    ) -> AsyncIterator[tuple[int, str]]:
+        log = self._logs.setdefault(run_id, _Log(self.size))
+        log.subscribers += 1
+        try:
+            while True:
+                changed = log.changed
+                for sequence, event in log.since(after):
+                    if event == _END:
+                        return
+                    yield sequence, event
+                    after = sequence
+                await changed.wait()
+        finally:
+            log.subscribers -= 1
+            if not log.subscribers and not log.sequence:
+                # Nothing was published, the run is executed elsewhere.
+                self._forget(run_id, log)
+
+
+class ValkeyBackend:
+    """Events shared by every node through Valkey lists and channels.
+
+    Events are sent in order by one task per run, so that publishing never
+    waits for Valkey.
+    """
+
+    def __init__(self, valkey: Valkey, size: int, retention: float):
+        self.valkey = valkey
+        self.size = size
+        self.retention = retention
+        self._publish = valkey.register_script(_PUBLISH_SCRIPT)
+        self._pending: dict[str, list[str]] = {}
+        self._senders: dict[str, asyncio.Task[None]] = {}
+
+    @staticmethod
+    def _keys(run_id: str) -> tuple[str, str, str]:
+        key = f"fastoai:run:{run_id}"
+        return f"{key}:events", f"{key}:sequence", key
+
+    def publish(self, run_id: str, event: str) -> None:
+        self._pending.setdefault(run_id, []).append(event)
+        if run_id not in self._senders:
+            self._senders[run_id] = asyncio.create_task(self._send(run_id))
+
+    async def _send(self, run_id: str) -> None:
+        events_key, sequence_key, channel = self._keys(run_id)
+        while events := self._pending.pop(run_id, None):
+            try:
+                await self._publish(
+                    keys=[events_key, sequence_key],
+                    args=[self.size, max(int(self.retention), 1), channel, *events],
+                )
+            except Exception as exc:
+                logger.warning(f"Failed to publish {len(events)} run events: {exc}")
+        del self._senders[run_id]
+
+    async def replay(self, run_id: str, after: int) -> list[tuple[int, str]] | None:
+        entries = await self.valkey.lrange(self._keys(run_id)[0], 0, -1)  # type: ignore[misc]
+        if not entries:
+            return None
+        return [e for e in map(_parse, entries) if e[0] > after]
+
+    async def subscribe(
+        self, run_id: str, after: int
+    ) -> AsyncIterator[tuple[int, str]]:
+        async with self.valkey.pubsub() as pubsub:
+            # Subscribed before replaying, so that no event falls in between.
+            await pubsub.subscribe(self._keys(run_id)[2])
+            for sequence, event in await self.replay(run_id, after) or []:
+                if event == _END:
+                    return
+                yield sequence, event
+                after = sequence
+            async for message in pubsub.listen():
+                if message["type"] != "message":
+                    continue
+                sequence, event = _parse(message["data"])
+                if sequence <= after:
+                    continue
+                if event == _END:
+                    return
+                yield sequence, event
+                after = sequence
+
+
+class RunEvents:
+    """Publish the server-sent events of runs to any number of subscribers.
+
+    The last `buffer_size` events of every run are kept for `retention`
+    seconds after it ends, so that subscribers joining late or reconnecting
+    with the id of the last event they received miss nothing still buffered.
+
+    Without Valkey, events only reach the subscribers of the process executing
+    the run. Subscribers waiting `idle_timeout` seconds for an event therefore
+    look the outcome of the run up elsewhere.
+    """
+
+    def __init__(
+        self,
+        *,
+        valkey: Valkey | None = None,
+        buffer_size: int = 1000,
+        retention: float = 600,
+        idle_timeout: float = 15,
+    ):
+        self.backend = (
+            MemoryBackend(buffer_size, retention)
+            if valkey is None
+            else ValkeyBackend(valkey, buffer_size, retention)
+        )
+        self.idle_timeout = idle_timeout
+
+    @classmethod
+    def from_settings(
+        cls, settings: Settings, valkey: Valkey | None = None
+    ) -> "RunEvents":
+        return cls(
+            valkey=valkey,
+            buffer_size=settings.run_events_buffer_size,
+            retention=settings.run_events_retention,
+            idle_timeout=settings.run_events_idle_timeout,
+        )
+
+    def publish(self, run_id: str, event: str) -> None:
+        self.backend.publish(run_id, event)
+
+    def close(self, run_id: str) -> None:
+        """End the streams of the subscribers of a run."""
+        self.backend.publish(run_id, _END)
+
+    async def replay(self, run_id: str, after: int = 0) -> list[str] | None:
+        """The buffered events of a run following the event `after`.
+
+        None when no event of the run is buffered, or no longer.
+        """
+        events = await self.backend.replay(run_id, after)
+        if events is None:
+            return None
+        return [_format(sequence, event) for sequence, event in events if event != _END]
+
+    async def subscribe(
+        self,
+        run_id: str,
+        after: int = 0,
+        *,
+        outcome: Callable[[], Awaitable[list[str] | None]] | None = None,
+    ) -> AsyncIterator[str]:
+        """Receive the events of a run following the event `after`, until it ends.
+
+        Whenever no event arrived for `idle_timeout` seconds, `outcome` is
+        called, and the events it returns once the run ended end the stream.
+        """
+        async with aclosing(self.backend.subscribe(run_id, after)) as events:
+            while True:
+                # Awaited in a task, so that timing out does not end the stream.
+                received = asyncio.ensure_future(anext(events))
+                ended = None
+                try:
+                    while not (
+                        await asyncio.wait([received], timeout=self.idle_timeout)
+                    )[0]:
+                        if outcome is not None and (ended := await outcome()):
+                            break
+                finally:
+                    if not received.done():
+                        received.cancel()
+                        with suppress(asyncio.CancelledError):
+                            await received
+                if ended:
+                    for event in ended:
+                        yield event
+                    return
+                try:
+                    sequence, event = received.result()
+                except StopAsyncIteration:
+                    return
+                yield _format(sequence, event)
+
+
+def _format(sequence: int, event: str) -> str:
+    return f"id: {sequence}\n{event}"
@@ -0,0 +1,123 @@
+"""Durable queue of the runs to execute, shared by every worker and node."""
+
+from datetime import timedelta
+from typing import NamedTuple
+
+from sqlalchemy import delete, or_, update
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import col, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from .auth import Principal
+from .models import Run, RunLease
+from .models._utils import now
+
+
+class Claim(NamedTuple):
+    run_id: str
+    principal: Principal | None
+    attempts: int
+    """Times the run was claimed, this claim included."""
+
+
+class RunQueue:
+    """Runs waiting for a worker, and the leases of the workers executing them.
+
+    A worker holds the lease of at most one run at a time, and the lease
+    expires unless it is renewed, after which any worker can take the run
+    over. Concurrent claims skip each other's rows where the database
+    supports `FOR UPDATE SKIP LOCKED`, and otherwise rely on a conditional
+    update of the claimed row.
+    """
+
+    def __init__(self, engine: AsyncEngine, *, lease_duration: float = 30):
+        self.engine = engine
+        self.lease_duration = lease_duration
+
+    def enqueue(
+        self, session: AsyncSession, run_id: str, principal: Principal | None = None
+    ) -> None:
+        """Queue a run within the transaction of `session`."""
+        session.add(
+            RunLease(
+                run_id=run_id,
+                principal=None if principal is None else principal.model_dump_json(),
+            )
+        )
+
+    async def claim(self, owner: str) -> Claim | None:
+        """Lease the oldest run that is not leased, None if there is none."""
+        while True:
+            async with self.engine.begin() as conn:
+                current = now()
+                claimable = or_(
+                    col(RunLease.owner).is_(None),
+                    col(RunLease.expires_at) < current,
+                )
+                statement = (
+                    select(RunLease.run_id)
+                    .where(claimable)
+                    .order_by(col(RunLease.created_at))
+                    .limit(1)
+                )
+                if conn.dialect.name == "postgresql":
+                    statement = statement.with_for_update(skip_locked=True)
+                run_id = (await conn.execute(statement)).scalar()
+                if run_id is None:
+                    return None
+                claimed = (
+                    await conn.execute(
+                        update(RunLease)
+                        .where(col(RunLease.run_id) == run_id, claimable)
+                        .values(
+                            owner=owner,
+                            expires_at=current + timedelta(seconds=self.lease_duration),
+                            attempts=col(RunLease.attempts) + 1,
+                        )
+                        .returning(col(RunLease.principal), col(RunLease.attempts))
+                    )
+                ).first()
+            if claimed is not None:
+                principal, attempts = claimed
+                return Claim(
+                    run_id,
+                    None
+                    if principal is None
+                    else Principal.model_validate_json(principal),
+                    attempts,
+                )
+            # Claimed by another worker in between, try the next one.
+
+    async def renew(self, run_id: str, owner: str) -> str | None:
+        """Extend a lease, returning the status of its run, None if it was lost."""
+        async with self.engine.begin() as conn:
+            result = await conn.execute(
+                update(RunLease)
+                .where(col(RunLease.run_id) == run_id, col(RunLease.owner) == owner)
+                .values(expires_at=now() + timedelta(seconds=self.lease_duration))
+            )
+            if not result.rowcount:  # type: ignore[attr-defined]
+                return None
+            return (
+                await conn.execute(select(Run.status).where(col(Run.id) == run_id))
+            ).scalar()
+
+    async def release(self, run_id: str, owner: str) -> None:
+        """Give a run back to the queue, without counting the attempt."""
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                update(RunLease)
+                .where(col(RunLease.run_id) == run_id, col(RunLease.owner) == owner)
+                .values(
+                    owner=None, expires_at=None, attempts=col(RunLease.attempts) - 1
+                )
+            )
+
+    async def complete(self, run_id: str, owner: str) -> None:
+        """Remove a run that ended from the queue."""
+        async with self.engine.begin() as conn:
+            await conn.execute(
+                delete(RunLease).where(
+                    col(RunLease.run_id) == run_id, col(RunLease.owner) == owner
+                )
+            )
@@ -1,15 +1,12 @@
-import asyncio
 from functools import lru_cache
 from pathlib import Path
-from typing import Sequence
+from typing import Literal, Sequence
 
-from loguru import logger
-from openai import AsyncClient, OpenAIError
-from openai.types import Model
-from pydantic import Field
+import httpx
+from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 
-from ._client import AsyncOpenAI
+from .balancing import StrategyName
 
 FASTOAI_DIR = Path.home() / ".fastoai"
 
@@ -19,10 +16,45 @@ class OpenAISettings(BaseSettings, env_prefix="openai_"):
 
     api_key: str = ""
     base_url: str = "https://api.openai.com/v1"
+    weight: float = 1.0
+    """Relative share of traffic under the `weighted_random` strategy."""
+    max_connections: int = 100
+    max_keepalive_connections: int = 20
+    keepalive_expiry: float = 30
+    """Seconds an idle connection is kept open for reuse."""
+    http2: bool = False
+    """Multiplex requests over HTTP/2, requires the `http2` extra."""
+    timeout: float = 600
+    """Seconds to wait for the upstream to send data, whole responses excluded."""
+    connect_timeout: float = 5
+    max_concurrent_requests: int = 0
+    """Requests in flight at once, further ones are queued by priority, 0 for no
+    limit."""
+    max_queue_size: int = 1000
+
+    def create_http_client(self) -> httpx.AsyncClient:
+        """Create the long-lived connection pool of this endpoint."""
+        return httpx.AsyncClient(
+            http2=self.http2,
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_keepalive_connections,
+                keepalive_expiry=self.keepalive_expiry,
+            ),
+            timeout=httpx.Timeout(self.timeout, connect=self.connect_timeout),
+            follow_redirects=True,
+        )
+
 
+class RateLimits(BaseModel):
+    """Limits of one API key or project, 0 for no limit."""
 
-async def list_models(client: AsyncClient) -> list[Model]:
-    return (await client.models.list()).data
+    rpm: int = 0
+    """Requests per minute."""
+    tpm: int = 0
+    """Tokens per minute, estimated from the prompt size and `max_tokens`."""
+    streams: int = 0
+    """Concurrent streams."""
 
 
 class Settings(
@@ -34,9 +66,92 @@ class Settings(
 
     base_url: str = "http://127.0.0.1:8000"
     database_url: str = ""
+    database_pool_size: int = 5
+    database_max_overflow: int = 10
+    database_pool_timeout: float = 30
+    database_pool_recycle: int = 1800
+    """Seconds after which a pooled connection is replaced, -1 to disable."""
+    database_pool_pre_ping: bool = True
+    database_migration: Literal["check", "upgrade", "skip"] = "check"
+    """Schema step run at startup, `fastoai db upgrade` migrates explicitly."""
+    valkey_url: str = ""
+    """Shared Valkey instance, e.g. `valkey://localhost:6379/0`, empty to disable."""
+    api_key_pepper: str = ""
+    """Server secret mixed into API key hashes, changing it invalidates all keys.
+
+    Set it before running `fastoai db upgrade`, which hashes existing keys
+    with it. Left empty, the hashes are plain SHA-256 and a warning is logged
+    at startup."""
+    auth_cache_size: int = 10_000
+    auth_cache_ttl: float = 60
+    chat_completions_validation: Literal["fast", "strict"] = "fast"
+    """`fast` only reads `model` and `stream`, `strict` validates the whole body."""
+    response_cache: bool = False
+    """Answer identical chat completions from a cache, streamed or not.
+
+    A streamed completion is stored once assembled, and either kind of request
+    is answered from the same entry, replayed as a stream when it asks for one."""
+    response_cache_size: int = 1000
+    response_cache_ttl: float = 3600
+    response_cache_max_entry_size: int = 1 << 20
+    """Bytes above which a response is not cached."""
+    response_cache_replay_chunk_size: int = 16
+    """Characters per chunk when a cached completion is replayed as a stream."""
+    response_cache_replay_interval: float = 0
+    """Seconds between two chunks of a replayed stream."""
+    single_flight_models: list[str] = Field(default_factory=list)
+    """Models whose identical concurrent requests share one upstream call, `*`
+    for every model."""
+    embeddings_batch_size: int = 256
+    """Inputs above which pending embeddings requests are sent upstream."""
+    embeddings_batch_window: float = 0.005
+    """Seconds an embeddings request waits for others to be batched with."""
+    key_rate_limits: RateLimits = Field(default_factory=RateLimits)
+    project_rate_limits: RateLimits = Field(default_factory=RateLimits)
+    rate_limit_completion_tokens: int = 1024
+    """Completion tokens counted for requests that do not set `max_tokens`."""
+    usage_flush_interval: float = 10
+    """Seconds between two batched writes of the usage records."""
+    usage_max_pending: int = 10_000
+    """Aggregated usage records that trigger a write before the interval."""
+    run_workers: int = 4
+    """Assistant runs executed at once by each process."""
+    run_lease_duration: float = 30
+    """Seconds after which a run whose worker stopped is taken over by another."""
+    run_max_attempts: int = 3
+    """Times a run is executed before it fails, takeovers included."""
+    run_checkpoint_tokens: int = 0
+    """Streamed tokens after which the partial message of a run is saved, 0 to
+    only save it once the run ends."""
+    run_events_buffer_size: int = 1000
+    """Last events of each run replayed to subscribers joining late."""
+    run_events_retention: float = 600
+    """Seconds the events of a run are kept after it ended."""
+    run_events_idle_timeout: float = 15
+    """Seconds without events after which a subscriber checks whether the run
+    ended, in case it is executed by another process without Valkey."""
     upload_dir: Path = FASTOAI_DIR / "uploads"
     generate_models: bool = False
     endpoints: list[OpenAISettings] = Field(default_factory=lambda: [OpenAISettings()])
+    models_refresh_interval: float = 300
+    """Seconds between two refreshes of the models listed by every endpoint."""
+    models_refresh_timeout: float = 10
+    load_balancing: StrategyName = "round_robin"
+    """Strategy spreading requests over the endpoints serving a model."""
+    model_load_balancing: dict[str, StrategyName] = Field(default_factory=dict)
+    """Per model overrides of `load_balancing`."""
+    circuit_failure_threshold: int = 5
+    """Consecutive failures after which an endpoint stops receiving requests."""
+    circuit_cooldown: float = 30
+    """Seconds before an open circuit lets probe requests through again."""
+    circuit_half_open_probes: int = 1
+    upstream_max_attempts: int = 3
+    """Upstream attempts per request, retries and failovers included."""
+    upstream_deadline: float = 600
+    """Seconds after which no further upstream attempt is started."""
+    upstream_backoff: float = 0.25
+    upstream_queue_timeout: float = 30
+    """Seconds a request waits for a free slot on an endpoint before failing over."""
 
     def model_post_init(self, __context):
         self.upload_dir.mkdir(parents=True, exist_ok=True)
@@ -59,25 +174,6 @@ class Settings(
             )
         )
 
-    async def get_openai_client(self) -> AsyncOpenAI:
-        results: dict[tuple[str, str], list[Model]] = {}
-        try:
-            tasks: dict[tuple[str, str], asyncio.Task[list[Model]]] = {}
-            async with asyncio.TaskGroup() as tg:
-                for endpoint in self.endpoints:
-                    client = AsyncClient(**endpoint.model_dump())
-                    tasks[(endpoint.api_key, endpoint.base_url)] = tg.create_task(
-                        list_models(client)
-                    )
-            results |= {
-                (api_key, base_url): task.result()
-                for (api_key, base_url), task in tasks.items()
-            }
-        except* OpenAIError as excgroup:
-            for exc in excgroup.exceptions:
-                logger.error(exc)
-        return AsyncOpenAI(endpoints=results)
-
 
 @lru_cache
 def get_settings() -> Settings:
@@ -0,0 +1,38 @@
+import asyncio
+from collections.abc import Awaitable, Callable, Hashable
+
+from .metrics import registry
+
+COALESCED = registry.counter(
+    "fastoai_singleflight_coalesced_total",
+    "Calls that waited for an identical call in flight instead of making their own.",
+)
+
+
+class SingleFlight[K: Hashable, V]:
+    """Share one in-flight call, and its outcome, between identical callers.
+
+    The call runs in its own task so that a caller giving up does not cancel it
+    for the others still waiting.
+    """
+
+    def __init__(self):
+        self._flights: dict[K, asyncio.Task[V]] = {}
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+    async def do(self, key: K, call: Callable[[], Awaitable[V]]) -> V:
+        if (task := self._flights.get(key)) is not None:
+            COALESCED.inc()
+        else:
+            task = self._flights[key] = asyncio.ensure_future(call())
+            task.add_done_callback(lambda _: self._forget(key, task))
+        return await asyncio.shield(task)
+
+    def _forget(self, key: K, task: asyncio.Task[V]) -> None:
+        if self._flights.get(key) is task:
+            del self._flights[key]
+        if not task.cancelled():
+            # Retrieved so that nobody left waiting does not log it as lost.
+            task.exception()
@@ -0,0 +1,161 @@
+"""Relay of upstream server-sent events to the client."""
+
+import json
+from asyncio import CancelledError
+from collections import deque
+from collections.abc import AsyncGenerator, AsyncIterator, Callable
+from typing import Any
+
+import anyio
+import httpx
+from fastapi.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+from .metrics import registry
+
+STREAMS_ABANDONED = registry.counter(
+    "fastoai_upstream_streams_abandoned_total",
+    "Upstream streams closed early because the client disconnected.",
+)
+
+ChunkTransform = Callable[[dict[str, Any]], dict[str, Any] | None]
+"""Rewrite a parsed chunk before it is sent, or drop it by returning None."""
+ChunkObserver = Callable[[dict[str, Any]], None]
+LastChunkObserver = Callable[[dict[str, Any] | None], None]
+
+DATA_PREFIX = b"data:"
+DONE = b"[DONE]"
+TAIL_SIZE = 1 << 16
+"""Bytes kept from the end of a passed through stream to find its last chunk."""
+
+
+def format_event(chunk: dict[str, Any]) -> bytes:
+    return b"data: " + json.dumps(chunk, separators=(",", ":")).encode() + b"\n\n"
+
+
+def _process_event(
+    event: bytes,
+    transform: ChunkTransform | None,
+    observe: ChunkObserver | None,
+) -> bytes | None:
+    lines = event.splitlines()
+    for i, line in enumerate(lines):
+        if not line.startswith(DATA_PREFIX):
+            continue
+        payload = line[len(DATA_PREFIX) :].strip()
+        if payload == DONE:
+            continue
+        try:
+            chunk = json.loads(payload)
+        except ValueError:
+            continue  # Not a chunk, forwarded as is.
+        if observe is not None:
+            observe(chunk)
+        if transform is None:
+            continue
+        if (chunk := transform(chunk)) is None:
+            return None
+        lines[i] = b"data: " + json.dumps(chunk, separators=(",", ":")).encode()
+    return b"\n".join(lines)
+
+
+def _last_chunk(tail: bytes) -> dict[str, Any] | None:
+    for event in reversed(tail.replace(b"\r\n", b"\n").split(b"\n\n")):
+        for line in reversed(event.splitlines()):
+            if not line.startswith(DATA_PREFIX):
+                continue
+            payload = line[len(DATA_PREFIX) :].strip()
+            if payload == DONE:
+                continue
+            try:
+                return json.loads(payload)
+            except ValueError:
+                return None  # Cut by the start of the tail.
+    return None
+
+
+async def relay_sse(
+    response: httpx.Response,
+    *,
+    transform: ChunkTransform | None = None,
+    observe: ChunkObserver | None = None,
+    last: LastChunkObserver | None = None,
+) -> AsyncIterator[bytes]:
+    """Forward the bytes of an upstream event stream and close it at the end.
+
+    Without a transform or an observer the bytes are passed through untouched,
+    otherwise the stream is split into events and only the `data` lines are
+    parsed, each of them once. `last` is called once the stream ends with its
+    final chunk, where usage is reported, or with None if it had no chunk or
+    the client went away before the end. In pass through mode only that chunk
+    is parsed.
+    """
+    try:
+        if transform is None and observe is None:
+            tail: deque[bytes] = deque()
+            size = 0
+            async for chunk in response.aiter_bytes():
+                if last is not None:
+                    tail.append(chunk)
+                    size += len(chunk)
+                    while size - len(tail[0]) >= TAIL_SIZE:
+                        size -= len(tail.popleft())
+                yield chunk
+            if last is not None:
+                last(_last_chunk(b"".join(tail)))
+            return
+        final: list[dict[str, Any]] = []
+        if last is not None:
+            inner = observe
+
+            def observe(chunk: dict[str, Any]):
+                final[:] = [chunk]
+                if inner is not None:
+                    inner(chunk)
+
+        buffer = b""
+        pending = b""
+        async for chunk in response.aiter_bytes():
+            # A trailing "\r" may be the first half of a "\r\n" split between
+            # chunks, it is held back until the next one arrives.
+            chunk = pending + chunk
+            pending = b"\r" if chunk.endswith(b"\r") else b""
+            buffer += chunk[: len(chunk) - len(pending)].replace(b"\r\n", b"\n")
+            *events, buffer = buffer.split(b"\n\n")
+            for event in events:
+                if (processed := _process_event(event, transform, observe)) is not None:
+                    yield processed + b"\n\n"
+        buffer += pending
+        if buffer.strip():
+            if (processed := _process_event(buffer, transform, observe)) is not None:
+                yield processed + b"\n\n"
+        if last is not None:
+            last(final[0] if final else None)
+    except (GeneratorExit, CancelledError):
+        STREAMS_ABANDONED.inc()
+        if last is not None:
+            last(None)
+        raise
+    finally:
+        with anyio.CancelScope(shield=True):
+            await response.aclose()
+
+
+class EventStreamResponse(StreamingResponse):
+    """Event stream closing its generator as soon as the response ends.
+
+    Starlette stops iterating when the client disconnects but leaves the
+    generator suspended until it is garbage collected, which would keep the
+    upstream stream, and the work behind it, running. Closing it runs the
+    generator's cleanup right away.
+    """
+
+    media_type = "text/event-stream"
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            if isinstance(self.body_iterator, AsyncGenerator):
+                with anyio.CancelScope(shield=True):
+                    await self.body_iterator.aclose()
@@ -0,0 +1,139 @@
+"""Token usage accounting, aggregated in memory and written in batches."""
+
+import asyncio
+from collections import Counter
+from contextlib import asynccontextmanager, suppress
+from datetime import UTC, datetime
+from typing import Any, NamedTuple
+
+from loguru import logger
+from sqlalchemy import insert
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .auth import Principal
+from .metrics import registry
+from .models._utils import now
+from .models.usage import UsageRecord
+
+USAGE_TOKENS = registry.counter(
+    "fastoai_usage_tokens_total",
+    "Tokens consumed upstream, as reported by the endpoints.",
+    ["kind", "type"],
+)
+USAGE_FLUSHES = registry.counter(
+    "fastoai_usage_flushes_total",
+    "Batched writes of usage records to the database.",
+    ["result"],
+)
+USAGE_PENDING = registry.gauge(
+    "fastoai_usage_pending_records",
+    "Aggregated usage records waiting to be written.",
+)
+
+
+COUNTED_FIELDS = ("requests", "prompt_tokens", "completion_tokens")
+
+
+class _Group(NamedTuple):
+    period_start: datetime
+    key_id: str
+    project_id: str | None
+    model: str
+    kind: str
+
+
+class UsageRecorder:
+    """Aggregate usage per key, model and period, and write it in bulk.
+
+    Recording is a dictionary update without any I/O. Every `interval` seconds,
+    or as soon as `max_pending` records are waiting, the aggregated records are
+    inserted in one statement. Records that failed to be written are kept for
+    the next attempt.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        *,
+        interval: float = 10,
+        period: int = 60,
+        max_pending: int = 10_000,
+    ):
+        self.engine = engine
+        self.interval = interval
+        self.period = period
+        """Seconds covered by one record."""
+        self.max_pending = max_pending
+        self._pending: dict[_Group, Counter[str]] = {}
+        self._lock = asyncio.Lock()
+        self._flush_task: asyncio.Task | None = None
+        USAGE_PENDING.set_function(lambda: len(self._pending))
+
+    def record(
+        self,
+        principal: Principal,
+        *,
+        model: str,
+        kind: str,
+        usage: dict[str, Any] | None = None,
+    ) -> None:
+        """Account one upstream request and the usage it reported, if any."""
+        timestamp = now().timestamp()
+        group = _Group(
+            datetime.fromtimestamp(timestamp - timestamp % self.period, UTC),
+            principal.key_id,
+            principal.project_id,
+            model,
+            kind,
+        )
+        counts = self._pending.setdefault(group, Counter())
+        counts["requests"] += 1
+        for field in ("prompt_tokens", "completion_tokens"):
+            if tokens := (usage or {}).get(field):
+                counts[field] += tokens
+                USAGE_TOKENS.inc(tokens, kind=kind, type=field.split("_")[0])
+        if len(self._pending) >= self.max_pending:
+            self.flush_soon()
+
+    def flush_soon(self) -> None:
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.get_running_loop().create_task(self.flush())
+
+    async def flush(self) -> int:
+        """Write the pending records, returning how many were written."""
+        async with self._lock:
+            pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            rows = [
+                {**group._asdict(), **{f: counts[f] for f in COUNTED_FIELDS}}
+                for group, counts in pending.items()
+            ]
+            try:
+                async with self.engine.begin() as conn:
+                    await conn.execute(insert(UsageRecord), rows)
+            except Exception as exc:
+                USAGE_FLUSHES.inc(result="failure")
+                logger.error(f"Failed to write {len(rows)} usage records: {exc}")
+                for group, counts in pending.items():
+                    self._pending.setdefault(group, Counter()).update(counts)
+                return 0
+            USAGE_FLUSHES.inc(result="success")
+            return len(rows)
+
+    async def _flush_periodically(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+    @asynccontextmanager
+    async def serve(self):
+        """Flush periodically, and one last time on exit."""
+        task = asyncio.create_task(self._flush_periodically())
+        try:
+            yield self
+        finally:
+            task.cancel()
+            with suppress(asyncio.CancelledError):
+                await task
+            await self.flush()
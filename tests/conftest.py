@@ -37,7 +37,8 @@ def settings_fixture():
     app.dependency_overrides.clear
 
 
-async def setup_database(session: AsyncSession):
+async def setup_database(session: AsyncSession) -> str:
+    """Create a user with a project and an API key, returning the key."""
     user = User(name="First Last", email="test@example.com", password="password")
     organization = Organization(name="Personal")
     organization_user = OrganizationUser(
@@ -63,6 +64,8 @@ async def setup_database(session: AsyncSession):
     session.add(project_user)
     session.add(api_key)
     await session.commit()
+    assert api_key.value is not None
+    return api_key.value
 
 
 @pytest.fixture(name="session", scope="module")
@@ -87,8 +90,13 @@ async def user_fixture(session: AsyncSession) -> str:
 
 
 @pytest.fixture(name="api_key", scope="module")
-async def api_key_fixture(session: AsyncSession) -> str:
-    return (await session.exec(select(Key))).one().id
+async def api_key_fixture(session: AsyncSession, user_id: str) -> str:
+    # Only the hash of the key is stored, the secret is known once created.
+    api_key = Key(user_id=user_id)
+    session.add(api_key)
+    await session.commit()
+    assert api_key.value is not None
+    return api_key.value
 
 
 @pytest.fixture(name="http_client", scope="module")
@@ -0,0 +1,102 @@
+from types import SimpleNamespace
+
+import pytest
+from conftest import setup_database
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, StaticPool, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastoai.auth import KeyCache, Principal, key_cache, token_digest
+from fastoai.cache import TTLCache
+from fastoai.dependencies import get_user, require_owner
+from fastoai.models.key import Key
+
+
+def test_ttl_cache(monkeypatch):
+    clock = [0.0]
+    monkeypatch.setattr("fastoai.cache.monotonic", lambda: clock[0])
+    cache = TTLCache[str, int](maxsize=2, ttl=10)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1
+    cache.set("c", 3)
+    assert "b" not in cache
+    assert cache.get("a") == 1
+    clock[0] = 11
+    assert cache.get("a") is None
+    assert len(cache) == 1
+
+
+@pytest.mark.anyio
+async def test_key_cache_invalidated_on_delete():
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(engine) as session:
+        token = await setup_database(session)
+        key = (await session.exec(select(Key))).one()
+        principal = Principal(key_id=key.id, owner_type="user", owner_id="user_")
+        digest = token_digest(token)
+        assert digest == key.value_hash
+        session.expunge(key)
+        loaded = (await session.exec(select(Key))).one()
+        assert loaded.value is None and loaded.redacted_value == key.redacted_value
+        key = loaded
+        await key_cache.set(digest, principal)
+        assert await key_cache.get(digest) == principal
+        await session.delete(key)
+        await session.commit()
+        assert key_cache.local.get(digest) is None
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_get_user_cached():
+    engine = create_async_engine(
+        "sqlite+aiosqlite://",
+        connect_args={"check_same_thread": False},
+        poolclass=StaticPool,
+    )
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    async with AsyncSession(engine) as session:
+        token = await setup_database(session)
+        key = (await session.exec(select(Key))).one()
+        credentials = HTTPAuthorizationCredentials(scheme="Bearer", credentials=token)
+        principal = await get_user(credentials=credentials, session=session)
+        assert principal.key_id == key.id and principal.owner_type == "user"
+        assert principal.role == "owner"
+    await engine.dispose()
+    # Answered from the cache, without any session.
+    cached = await get_user(credentials=credentials, session=None)  # type: ignore[arg-type]
+    assert cached == principal
+
+
+@pytest.mark.anyio
+async def test_key_cache_survives_valkey_outage():
+    async def fail(*args, **kwargs):
+        raise ConnectionError("Valkey is down")
+
+    cache = KeyCache()
+    cache.valkey = SimpleNamespace(get=fail, set=fail, delete=fail, publish=fail)  # type: ignore
+    principal = Principal(key_id="key_1", owner_type="user", owner_id="user_1")
+    assert await cache.get("digest") is None
+    await cache.set("digest", principal)
+    assert await cache.get("digest") == principal
+    await cache.invalidate("digest")
+    assert cache.local.get("digest") is None
+
+
+@pytest.mark.anyio
+async def test_require_owner():
+    owner = Principal(key_id="key", owner_type="user", owner_id="u", role="owner")
+    await require_owner(owner)
+    with pytest.raises(HTTPException) as exc_info:
+        await require_owner(owner.model_copy(update={"role": "member"}))
+    assert exc_info.value.status_code == 403
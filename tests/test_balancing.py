@@ -0,0 +1,55 @@
+from collections import Counter
+
+import httpx
+import pytest
+from openai import AsyncClient
+
+from fastoai._client import Endpoint
+from fastoai.balancing import STRATEGIES, create_strategy
+
+
+def endpoint(name: str, **kwargs) -> Endpoint:
+    return Endpoint(
+        base_url=f"http://{name}/v1",
+        api_key=name,
+        http_client=httpx.AsyncClient(),
+        client=AsyncClient(api_key=name, base_url=f"http://{name}/v1"),
+        **kwargs,
+    )
+
+
+@pytest.mark.parametrize("name", STRATEGIES)
+def test_strategies_keep_every_candidate(name):
+    endpoints = [endpoint("a"), endpoint("b"), endpoint("c")]
+    ordered = create_strategy(name).order(endpoints)
+    assert sorted(e.api_key for e in ordered) == ["a", "b", "c"]
+    assert create_strategy(name).order([]) == []
+
+
+def test_round_robin():
+    endpoints = [endpoint("a"), endpoint("b")]
+    strategy = create_strategy("round_robin")
+    firsts = [strategy.order(endpoints)[0].api_key for _ in range(4)]
+    assert firsts == ["a", "b", "a", "b"]
+
+
+def test_weighted_random():
+    endpoints = [endpoint("a", weight=3), endpoint("b", weight=1)]
+    strategy = create_strategy("weighted_random")
+    firsts = Counter(strategy.order(endpoints)[0].api_key for _ in range(2000))
+    assert 1300 < firsts["a"] < 1700
+
+
+def test_least_outstanding_and_ewma():
+    busy = endpoint("busy", outstanding=3, latency=0.1)
+    idle = endpoint("idle", outstanding=0, latency=0.2)
+    assert create_strategy("least_outstanding").order([busy, idle])[0] is idle
+    assert create_strategy("ewma").order([busy, idle])[0] is idle
+    assert create_strategy("power_of_two").order([busy, idle])[0] is busy
+
+
+def test_observe_latency():
+    e = endpoint("a")
+    e.observe_latency(1.0)
+    e.observe_latency(2.0)
+    assert e.latency == pytest.approx(1.3)
@@ -0,0 +1,299 @@
+import json
+from types import SimpleNamespace
+
+import anyio
+import httpx
+import pytest
+from openai import AsyncClient, AsyncOpenAI
+from openai.types import CompletionUsage
+from sqlmodel import select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastoai import _client, app
+from fastoai.dependencies import get_chunk_transform
+from fastoai.models import UsageRecord
+from fastoai.ratelimit import RateLimiter
+from fastoai.response_cache import CACHE_HITS, ResponseCache
+from fastoai.settings import RateLimits
+from fastoai.usage import UsageRecorder
+
+COMPLETION = {
+    "id": "chatcmpl-1",
+    "object": "chat.completion",
+    "created": 0,
+    "model": "llama3",
+    "choices": [
+        {
+            "index": 0,
+            "message": {"role": "assistant", "content": "Hello"},
+            "finish_reason": "stop",
+        }
+    ],
+    "usage": {"prompt_tokens": 3, "completion_tokens": 2, "total_tokens": 5},
+}
+
+
+def chunk(content: str, finish_reason: str | None = None) -> dict:
+    return {
+        "id": "chatcmpl-1",
+        "object": "chat.completion.chunk",
+        "created": 0,
+        "model": "llama3",
+        "choices": [
+            {
+                "index": 0,
+                "delta": {"content": content},
+                "finish_reason": finish_reason,
+            }
+        ],
+    }
+
+
+def upstream(request: httpx.Request) -> httpx.Response:
+    body = json.loads(request.content)
+    if not body.get("stream"):
+        return httpx.Response(200, json=COMPLETION)
+    chunks = [chunk("Hel"), chunk("lo", "stop")]
+    if (body.get("stream_options") or {}).get("include_usage"):
+        chunks.append({**chunk(""), "choices": [], "usage": COMPLETION["usage"]})
+    events = "".join(f"data: {json.dumps(c)}\n\n" for c in chunks)
+    return httpx.Response(
+        200,
+        content=(events + "data: [DONE]\n\n").encode(),
+        headers={"Content-Type": "text/event-stream"},
+    )
+
+
+@pytest.fixture(name="upstream_requests", autouse=True)
+def upstream_fixture(session: AsyncSession):
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request):
+        requests.append(request)
+        return upstream(request)
+
+    endpoint = _client.Endpoint(
+        base_url="http://upstream/v1",
+        api_key="upstream",
+        http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        client=AsyncClient(api_key="upstream", base_url="http://upstream/v1"),
+    )
+    registry = SimpleNamespace(endpoints=[endpoint], candidates=lambda _: [endpoint])
+    app.state.openai = _client.AsyncOpenAI(registry=registry)  # type: ignore
+    app.state.response_cache = None
+    app.state.rate_limiter = RateLimiter(RateLimits(), RateLimits())
+    app.state.usage_recorder = UsageRecorder(session.bind)  # type: ignore
+    yield requests
+    del app.state.openai, app.state.response_cache, app.state.rate_limiter
+    del app.state.usage_recorder
+
+
+@pytest.mark.anyio
+async def test_chat_completions(client: AsyncOpenAI, upstream_requests):
+    completion = await client.chat.completions.create(
+        model="llama3", messages=[{"role": "user", "content": "Hi"}]
+    )
+    assert completion.choices[0].message.content == "Hello"
+    assert upstream_requests[0].headers["Authorization"] == "Bearer upstream"
+
+
+@pytest.mark.anyio
+async def test_chat_completions_priority(client: AsyncOpenAI, monkeypatch):
+    queue = app.state.openai.registry.endpoints[0].queue
+    acquire, priorities = queue.acquire, []
+
+    async def record(priority, deadline=None):
+        priorities.append(priority)
+        await acquire(priority, deadline)
+
+    monkeypatch.setattr(queue, "acquire", record)
+    for headers in ({"X-FastOAI-Priority": "batch"}, {}):
+        await client.chat.completions.create(
+            model="llama3",
+            messages=[{"role": "user", "content": "Hi"}],
+            extra_headers=headers,
+        )
+    assert priorities == ["batch", "interactive"]
+
+
+@pytest.mark.anyio
+async def test_chat_completions_stream(client: AsyncOpenAI):
+    stream = await client.chat.completions.create(
+        model="llama3", messages=[{"role": "user", "content": "Hi"}], stream=True
+    )
+    assert [c.choices[0].delta.content async for c in stream] == ["Hel", "lo"]
+
+
+@pytest.mark.anyio
+async def test_chat_completions_stream_transform(client: AsyncOpenAI):
+    def shout(chunk: dict) -> dict:
+        chunk["choices"][0]["delta"]["content"] = chunk["choices"][0]["delta"][
+            "content"
+        ].upper()
+        return chunk
+
+    app.dependency_overrides[get_chunk_transform] = lambda: shout
+    try:
+        stream = await client.chat.completions.create(
+            model="llama3", messages=[{"role": "user", "content": "Hi"}], stream=True
+        )
+        assert [c.choices[0].delta.content async for c in stream] == ["HEL", "LO"]
+    finally:
+        del app.dependency_overrides[get_chunk_transform]
+
+
+@pytest.mark.anyio
+async def test_chat_completions_forwards_body_unchanged(
+    http_client: httpx.AsyncClient, api_key: str, upstream_requests
+):
+    body = b'{"model":"llama3","messages":[{"role":"user","content":"Hi"}],"x":1}'
+    response = await http_client.post(
+        "/chat/completions",
+        content=body,
+        headers={"Authorization": f"Bearer {api_key}"},
+    )
+    assert response.status_code == 200
+    assert upstream_requests[0].content == body
+
+
+@pytest.mark.anyio
+async def test_chat_completions_validation(
+    http_client: httpx.AsyncClient, api_key: str, settings
+):
+    headers = {"Authorization": f"Bearer {api_key}"}
+    response = await http_client.post(
+        "/chat/completions", json={"messages": []}, headers=headers
+    )
+    assert response.status_code == 422
+    settings.chat_completions_validation = "strict"
+    try:
+        response = await http_client.post(
+            "/chat/completions",
+            json={"model": "llama3", "messages": "Hi"},
+            headers=headers,
+        )
+    finally:
+        settings.chat_completions_validation = "fast"
+    assert response.status_code == 422
+
+
+@pytest.mark.anyio
+async def test_chat_completions_cache(
+    http_client: httpx.AsyncClient, api_key: str, upstream_requests
+):
+    app.state.response_cache = ResponseCache()
+    headers = {"Authorization": f"Bearer {api_key}"}
+    hits = CACHE_HITS.get(tier="memory")
+    for body in [
+        b'{"model":"llama3","messages":[],"temperature":0}',
+        b'{"temperature": 0, "messages": [], "model": "llama3"}',
+    ]:
+        response = await http_client.post(
+            "/chat/completions", content=body, headers=headers
+        )
+        assert response.json() == COMPLETION
+    assert response.headers["X-Cache"] == "hit"
+    assert CACHE_HITS.get(tier="memory") == hits + 1
+    assert len(upstream_requests) == 1
+
+    response = await http_client.post(
+        "/chat/completions",
+        content=body,
+        headers={**headers, "Cache-Control": "no-cache"},
+    )
+    assert "X-Cache" not in response.headers
+    assert len(upstream_requests) == 2
+
+
+@pytest.mark.anyio
+async def test_chat_completions_cache_valkey_outage(client: AsyncOpenAI):
+    async def fail(*args, **kwargs):
+        raise ConnectionError("Valkey is down")
+
+    valkey = SimpleNamespace(get=fail, set=fail)
+    app.state.response_cache = ResponseCache(valkey=valkey)  # type: ignore
+    for _ in range(2):
+        completion = await client.chat.completions.create(
+            model="llama3", messages=[{"role": "user", "content": "Hi"}]
+        )
+        assert completion.choices[0].message.content == "Hello"
+    app.state.response_cache = None
+
+
+@pytest.mark.anyio
+async def test_chat_completions_stream_replay(client: AsyncOpenAI, upstream_requests):
+    app.state.response_cache = ResponseCache(replay_chunk_size=2)
+    messages = [{"role": "user", "content": "Hello?"}]
+    contents = []
+    for _ in range(2):
+        stream = await client.chat.completions.create(
+            model="llama3", messages=messages, stream=True
+        )
+        contents.append([c.choices[0].delta.content async for c in stream])
+    assert contents[1] == ["", "He", "ll", "o", None]
+    completion = await client.chat.completions.create(model="llama3", messages=messages)
+    assert completion.choices[0].message.content == "Hello"
+    assert completion.choices[0].finish_reason == "stop"
+    assert len(upstream_requests) == 1
+
+
+@pytest.mark.anyio
+async def test_chat_completions_rate_limit(
+    http_client: httpx.AsyncClient, api_key: str, upstream_requests
+):
+    app.state.rate_limiter = RateLimiter(RateLimits(rpm=1), RateLimits())
+    headers = {"Authorization": f"Bearer {api_key}"}
+    body = {"model": "llama3", "messages": []}
+    response = await http_client.post("/chat/completions", json=body, headers=headers)
+    assert response.status_code == 200
+    response = await http_client.post("/chat/completions", json=body, headers=headers)
+    assert response.status_code == 429
+    assert response.headers["Retry-After"] == "60"
+    assert len(upstream_requests) == 1
+
+
+@pytest.mark.anyio
+async def test_chat_completions_usage(client: AsyncOpenAI, session: AsyncSession):
+    messages = [{"role": "user", "content": "Count me"}]
+    await client.chat.completions.create(model="llama3", messages=messages)
+    stream = await client.chat.completions.create(
+        model="llama3",
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    assert [c.usage async for c in stream][-1] == CompletionUsage(**COMPLETION["usage"])
+    await app.state.usage_recorder.flush()
+    records = (await session.exec(select(UsageRecord))).all()
+    assert sum(r.requests for r in records) == 2
+    assert sum(r.prompt_tokens for r in records) == 6
+    assert sum(r.completion_tokens for r in records) == 4
+
+
+@pytest.mark.anyio
+async def test_chat_completions_usage_coalesced(
+    client: AsyncOpenAI, session: AsyncSession, upstream_requests, monkeypatch
+):
+    openai = app.state.openai
+    forward = openai.forward
+
+    async def slow_forward(*args, **kwargs):
+        await anyio.sleep(0.05)
+        return await forward(*args, **kwargs)
+
+    monkeypatch.setattr(openai, "single_flight_models", ["*"])
+    monkeypatch.setattr(openai, "forward", slow_forward)
+    await app.state.usage_recorder.flush()
+    before = sum(r.requests for r in (await session.exec(select(UsageRecord))).all())
+    messages = [{"role": "user", "content": "Share me"}]
+    async with anyio.create_task_group() as tg:
+        for _ in range(3):
+            tg.start_soon(
+                lambda: client.chat.completions.create(
+                    model="llama3", messages=messages
+                )
+            )
+    assert len(upstream_requests) == 1
+    await app.state.usage_recorder.flush()
+    records = (await session.exec(select(UsageRecord))).all()
+    assert sum(r.requests for r in records) == before + 3
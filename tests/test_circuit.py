@@ -0,0 +1,33 @@
+from fastoai.circuit import CIRCUIT_STATE, CircuitBreaker, CircuitState
+
+
+def test_circuit_breaker():
+    clock = [0.0]
+    breaker = CircuitBreaker(
+        "http://test/v1", failure_threshold=2, cooldown=10, clock=lambda: clock[0]
+    )
+    assert breaker.allow()
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+    assert breaker.state is CircuitState.CLOSED
+    breaker.record_failure()
+    assert breaker.state is CircuitState.OPEN
+    assert CIRCUIT_STATE.get(endpoint="http://test/v1") == CircuitState.OPEN
+    assert not breaker.allow()
+
+    clock[0] = 10
+    assert breaker.allow()
+    assert breaker.state is CircuitState.HALF_OPEN
+    assert not breaker.allow(), "only one probe at a time"
+    breaker.record_failure()
+    assert breaker.state is CircuitState.OPEN
+    assert not breaker.allow()
+
+    clock[0] = 20
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.allow()
+    breaker.record_success()
+    assert breaker.state is CircuitState.CLOSED
+    assert breaker.allow()
@@ -0,0 +1,151 @@
+import asyncio
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import APIConnectionError, AsyncClient, BadRequestError
+
+from fastoai._client import AsyncOpenAI, Endpoint
+from fastoai.queueing import PriorityQueue
+from fastoai.retry import RETRIES, RetryPolicy
+
+
+def endpoint(name: str) -> Endpoint:
+    return Endpoint(
+        base_url=f"http://{name}/v1",
+        api_key=name,
+        http_client=httpx.AsyncClient(),
+        client=AsyncClient(api_key=name, base_url=f"http://{name}/v1"),
+    )
+
+
+@pytest.fixture(name="client")
+def client_fixture():
+    endpoints = [endpoint("a"), endpoint("b")]
+    registry = SimpleNamespace(endpoints=endpoints, candidates=lambda _: endpoints)
+    return AsyncOpenAI(
+        registry=registry,  # type: ignore
+        retry_policy=RetryPolicy(max_attempts=3, backoff=0),
+    )
+
+
+@pytest.mark.anyio
+async def test_dispatch_fails_over(client: AsyncOpenAI):
+    calls = []
+
+    async def call(endpoint: Endpoint):
+        calls.append(endpoint.api_key)
+        if endpoint.api_key == "a":
+            raise APIConnectionError(request=httpx.Request("POST", endpoint.base_url))
+        return "ok"
+
+    retries = RETRIES.get(endpoint="http://b/v1", reason="APIConnectionError")
+    assert await client.dispatch("m", call) == "ok"
+    assert calls == ["a", "b"]
+    assert RETRIES.get(endpoint="http://b/v1", reason="APIConnectionError") == (
+        retries + 1
+    )
+    assert all(e.outstanding == 0 for e in client.endpoints)
+
+
+@pytest.mark.anyio
+async def test_dispatch_does_not_retry_client_errors(client: AsyncOpenAI):
+    calls = []
+
+    async def call(endpoint: Endpoint):
+        calls.append(endpoint.api_key)
+        request = httpx.Request("POST", endpoint.base_url)
+        raise BadRequestError(
+            "bad", response=httpx.Response(400, request=request), body=None
+        )
+
+    with pytest.raises(BadRequestError):
+        await client.dispatch("m", call)
+    assert len(calls) == 1
+
+
+@pytest.mark.anyio
+async def test_dispatch_stops_after_max_attempts(client: AsyncOpenAI):
+    calls = []
+
+    async def call(endpoint: Endpoint):
+        calls.append(endpoint.api_key)
+        raise APIConnectionError(request=httpx.Request("POST", endpoint.base_url))
+
+    with pytest.raises(APIConnectionError):
+        await client.dispatch("m", call)
+    assert calls == ["a", "b", "a"]
+
+
+@pytest.mark.anyio
+async def test_coalesce_is_opt_in(client: AsyncOpenAI):
+    client.single_flight_models = frozenset({"m"})
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        n = calls
+        await asyncio.sleep(0.01)
+        return n
+
+    assert await asyncio.gather(
+        *[client.coalesce("m", "k", call) for _ in range(3)]
+    ) == [1, 1, 1]
+    assert await asyncio.gather(
+        *[client.coalesce("x", "k", call) for _ in range(2)]
+    ) == [2, 3]
+
+
+@pytest.mark.anyio
+async def test_dispatch_skips_saturated_endpoints(client: AsyncOpenAI):
+    busy = client.endpoints[0]
+    busy.queue = PriorityQueue(max_concurrency=1, max_size=0)
+    await busy.queue.acquire("interactive")
+
+    async def call(endpoint: Endpoint):
+        return endpoint.api_key
+
+    assert await client.dispatch("m", call) == "b"
+    assert client.endpoints[1].queue.active == 0
+
+
+@pytest.mark.anyio
+async def test_dispatch_routes_by_url_model():
+    def serve(name: str):
+        def handler(request: httpx.Request) -> httpx.Response:
+            if name == "a":
+                return httpx.Response(404, json={"error": {"message": "no"}})
+            model = {"id": "m", "object": "model", "created": 0, "owned_by": name}
+            return httpx.Response(200, json=model)
+
+        return AsyncClient(
+            api_key=name,
+            base_url=f"http://{name}/v1",
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(handler)),
+        )
+
+    a, b = endpoint("a"), endpoint("b")
+    a.client, b.client = serve("a"), serve("b")
+    registry = SimpleNamespace(
+        endpoints=[a, b], candidates=lambda model: [b] if model == "m" else [a, b]
+    )
+    client = AsyncOpenAI(registry=registry)  # type: ignore
+    assert (await client.models.retrieve("m")).owned_by == "b"
+    assert a.count == 0
+
+
+@pytest.mark.anyio
+async def test_dispatch_holds_streams_until_closed(client: AsyncOpenAI):
+    async def call(endpoint: Endpoint):
+        async def body():
+            yield b"data: {}\n\n"
+
+        return httpx.Response(200, content=body())
+
+    response = await client.dispatch("m", call)
+    assert [e.outstanding for e in client.endpoints] == [1, 0]
+    assert client.endpoints[0].queue.active == 1
+    await response.aclose()
+    assert [e.outstanding for e in client.endpoints] == [0, 0]
+    assert client.endpoints[0].queue.active == 0
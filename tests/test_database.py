@@ -0,0 +1,93 @@
+import pytest
+from sqlalchemy import inspect, text
+from sqlmodel import SQLModel
+
+from fastoai.database import (
+    POOL_CHECKED_OUT,
+    POOL_CHECKOUTS,
+    SCHEMA_VERSION,
+    InstrumentedQueuePool,
+    SchemaVersionError,
+    create_engine,
+    prepare_schema,
+    upgrade_schema,
+)
+from fastoai.metrics import registry
+from fastoai.models._utils import hash_api_key
+from fastoai.settings import Settings
+
+
+@pytest.mark.anyio
+async def test_create_engine_pool(tmp_path):
+    settings = Settings(  # type: ignore
+        database_url=f"sqlite+aiosqlite:///{tmp_path / 'fastoai.db'}",
+        database_pool_size=2,
+        database_max_overflow=1,
+    )
+    engine = create_engine(settings)
+    pool = engine.sync_engine.pool
+    assert isinstance(pool, InstrumentedQueuePool)
+    assert pool.size() == 2
+    checkouts = POOL_CHECKOUTS.get()
+    async with engine.connect() as conn:
+        await conn.execute(text("SELECT 1"))
+        assert POOL_CHECKED_OUT.get() == 1
+    assert POOL_CHECKED_OUT.get() == 0
+    assert POOL_CHECKOUTS.get() == checkouts + 1
+    assert "fastoai_db_pool_wait_seconds_count" in registry.render()
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_upgrade_schema(tmp_path):
+    settings = Settings(  # type: ignore
+        database_url=f"sqlite+aiosqlite:///{tmp_path / 'fastoai.db'}",
+    )
+    engine = create_engine(settings)
+    with pytest.raises(SchemaVersionError):
+        await prepare_schema(engine, settings)
+    async with engine.begin() as conn:
+        assert await conn.run_sync(upgrade_schema) is None
+        assert await conn.run_sync(upgrade_schema) == SCHEMA_VERSION
+    await prepare_schema(engine, settings)
+    await engine.dispose()
+
+
+@pytest.mark.anyio
+async def test_upgrade_drops_plaintext_api_keys(tmp_path):
+    settings = Settings(  # type: ignore
+        database_url=f"sqlite+aiosqlite:///{tmp_path / 'fastoai.db'}",
+    )
+    engine = create_engine(settings)
+    secret = "sk-proj-" + "x" * 40
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+        # The table of keys as created before schema versions were recorded.
+        await conn.execute(text("DROP TABLE key"))
+        await conn.execute(
+            text(
+                "CREATE TABLE key (id VARCHAR PRIMARY KEY, name VARCHAR NOT NULL, "
+                "created_at DATETIME NOT NULL, value VARCHAR NOT NULL, "
+                "permissions JSON NOT NULL, admin_id VARCHAR, user_id VARCHAR, "
+                "service_account_id VARCHAR)"
+            )
+        )
+        await conn.execute(
+            text(
+                "INSERT INTO key VALUES "
+                "('key_1', 'Secret key', '2024-01-01', :value, '\"all\"', "
+                "NULL, NULL, NULL)"
+            ),
+            {"value": secret},
+        )
+        assert await conn.run_sync(upgrade_schema) == 1
+        columns = await conn.run_sync(
+            lambda conn: {c["name"] for c in inspect(conn).get_columns("key")}
+        )
+        row = (
+            await conn.execute(text("SELECT value_hash, redacted_value FROM key"))
+        ).one()
+    assert "value" not in columns
+    assert row.value_hash == hash_api_key(secret, settings.api_key_pepper)
+    assert row.redacted_value == "sk-proj-" + "*" * 36 + "xxxx"
+    await engine.dispose()
@@ -0,0 +1,82 @@
+import asyncio
+import json
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from openai import BadRequestError, RateLimitError
+
+from fastoai.batching import EmbeddingBatcher
+
+
+def upstream(calls: list[list]):
+    async def forward(path: str, content: bytes, *, model: str):
+        inputs = json.loads(content)["input"]
+        calls.append(inputs)
+        if "limit" in inputs:
+            raise RateLimitError(
+                "slow down",
+                response=httpx.Response(429, request=httpx.Request("POST", path)),
+                body=None,
+            )
+        if "bad" in inputs:
+            raise BadRequestError(
+                "bad input",
+                response=httpx.Response(400, request=httpx.Request("POST", path)),
+                body=None,
+            )
+        data = [
+            {"object": "embedding", "index": i, "embedding": [float(len(x))]}
+            for i, x in enumerate(inputs)
+        ]
+        usage = {"prompt_tokens": 10, "total_tokens": 10}
+        return httpx.Response(
+            200,
+            json={"object": "list", "data": data, "model": model, "usage": usage},
+        )
+
+    return SimpleNamespace(forward=forward)
+
+
+@pytest.mark.anyio
+async def test_embedding_batcher():
+    calls = []
+    batcher = EmbeddingBatcher(upstream(calls), max_batch_size=4)  # type: ignore
+    results = await asyncio.gather(
+        batcher.embed({"model": "m", "input": "a"}),
+        batcher.embed({"model": "m", "input": ["bb", "cc"]}),
+        batcher.embed({"model": "n", "input": "d"}),
+        batcher.embed({"model": "m", "input": ["eeee", "f"]}),
+    )
+    assert sorted(calls) == [["a", "bb", "cc"], ["d"], ["eeee", "f"]]
+    assert [d["embedding"] for d in results[1]["data"]] == [[2.0], [2.0]]
+    assert [d["index"] for d in results[1]["data"]] == [0, 1]
+    assert results[3]["data"][0]["embedding"] == [4.0]
+    assert results[0]["usage"] == {"prompt_tokens": 2, "total_tokens": 2}
+
+
+@pytest.mark.anyio
+async def test_embedding_batcher_isolates_bad_inputs():
+    calls = []
+    batcher = EmbeddingBatcher(upstream(calls))  # type: ignore
+    good, bad = await asyncio.gather(
+        batcher.embed({"model": "m", "input": "good"}),
+        batcher.embed({"model": "m", "input": "bad"}),
+        return_exceptions=True,
+    )
+    assert isinstance(bad, BadRequestError)
+    assert good["data"][0]["embedding"] == [4.0]
+    assert calls == [["good", "bad"], ["good"], ["bad"]]
+
+
+@pytest.mark.anyio
+async def test_embedding_batcher_does_not_split_on_rate_limits():
+    calls = []
+    batcher = EmbeddingBatcher(upstream(calls))  # type: ignore
+    results = await asyncio.gather(
+        batcher.embed({"model": "m", "input": "good"}),
+        batcher.embed({"model": "m", "input": "limit"}),
+        return_exceptions=True,
+    )
+    assert all(isinstance(r, RateLimitError) for r in results)
+    assert calls == [["good", "limit"]]
@@ -0,0 +1,44 @@
+import asyncio
+
+import pytest
+
+from fastoai.queueing import QUEUE_DEPTH, EndpointBusy, PriorityQueue
+
+
+@pytest.mark.anyio
+async def test_priority_queue():
+    queue = PriorityQueue("http://q/v1", max_concurrency=1, max_size=2, timeout=1)
+    await queue.acquire("batch")
+    served = []
+
+    async def wait(priority):
+        await queue.acquire(priority)
+        served.append(priority)
+
+    waiters = [asyncio.create_task(wait(p)) for p in ("batch", "interactive")]
+    await asyncio.sleep(0)
+    assert len(queue) == 2
+    assert QUEUE_DEPTH.get(endpoint="http://q/v1", priority="interactive") == 1
+    with pytest.raises(EndpointBusy, match="full"):
+        await queue.acquire("interactive")
+
+    queue.release()
+    await asyncio.sleep(0)
+    assert served == ["interactive"]
+    queue.release()
+    await asyncio.gather(*waiters)
+    assert served == ["interactive", "batch"]
+    assert queue.active == 1
+    queue.release()
+    assert queue.active == 0
+
+
+@pytest.mark.anyio
+async def test_priority_queue_timeout():
+    queue = PriorityQueue(max_concurrency=1, timeout=0.01)
+    await queue.acquire("interactive")
+    with pytest.raises(EndpointBusy, match="timeout"):
+        await queue.acquire("interactive")
+    assert len(queue) == 0
+    queue.release()
+    assert queue.active == 0
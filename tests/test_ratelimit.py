@@ -0,0 +1,62 @@
+import anyio
+import pytest
+
+from fastoai.auth import Principal
+from fastoai.ratelimit import RATE_LIMITED, RateLimiter, RateLimitExceeded
+from fastoai.settings import RateLimits
+
+alice = Principal(key_id="key_a", owner_type="user", owner_id="a", project_id="p")
+bob = Principal(key_id="key_b", owner_type="user", owner_id="b", project_id="p")
+
+
+@pytest.mark.anyio
+async def test_token_buckets():
+    limiter = RateLimiter(RateLimits(rpm=2), RateLimits(tpm=600))
+    await limiter.admit(alice, tokens=300)
+    with pytest.raises(RateLimitExceeded) as exc_info:
+        await limiter.admit(bob, tokens=400)
+    assert (exc_info.value.scope, exc_info.value.limit) == ("project", "tpm")
+    assert exc_info.value.retry_after == pytest.approx(10, abs=0.1)
+    await limiter.admit(alice, tokens=300)
+    rejected = RATE_LIMITED.get(scope="key", limit="rpm")
+    with pytest.raises(RateLimitExceeded):
+        await limiter.admit(alice)
+    assert RATE_LIMITED.get(scope="key", limit="rpm") == rejected + 1
+
+
+@pytest.mark.anyio
+async def test_concurrent_streams():
+    limiter = RateLimiter(RateLimits(streams=1), RateLimits())
+
+    async def events():
+        yield 1
+        yield 2
+
+    async def open():
+        return events()
+
+    stream = await limiter.stream(alice, open)
+    with pytest.raises(RateLimitExceeded):
+        await limiter.stream(alice, open)
+    await limiter.stream(bob, open)
+    assert [e async for e in stream] == [1, 2]
+    await limiter.stream(alice, open)
+
+
+@pytest.mark.anyio
+async def test_long_stream_keeps_its_slot():
+    limiter = RateLimiter(RateLimits(streams=1), RateLimits(), stream_ttl=0.1)
+
+    async def events():
+        for i in range(4):
+            await anyio.sleep(0.05)
+            yield i
+
+    async def open():
+        return events()
+
+    stream = await limiter.stream(alice, open)
+    assert [await anext(stream) for _ in range(3)] == [0, 1, 2]
+    with pytest.raises(RateLimitExceeded):
+        await limiter.stream(alice, open)
+    assert [e async for e in stream] == [3]
@@ -0,0 +1,58 @@
+from types import SimpleNamespace
+
+import pytest
+from openai import APIConnectionError
+from openai.types import Model
+
+from fastoai.registry import ModelRegistry
+from fastoai.settings import OpenAISettings, Settings
+
+
+class FakeModels:
+    def __init__(self, *ids: str):
+        self.ids = ids
+        self.down = False
+
+    async def list(self):
+        if self.down:
+            raise APIConnectionError(request=None)  # type: ignore
+        return SimpleNamespace(
+            data=[
+                Model(id=i, created=0, object="model", owned_by="fastoai")
+                for i in self.ids
+            ]
+        )
+
+
+@pytest.fixture(name="registry")
+def registry_fixture():
+    settings = Settings(  # type: ignore
+        endpoints=[
+            OpenAISettings(base_url="http://a/v1", api_key="a"),
+            OpenAISettings(base_url="http://b/v1", api_key="b"),
+        ]
+    )
+    registry = ModelRegistry(settings)
+    registry.endpoints[0].client = SimpleNamespace(models=FakeModels("m1", "m2"))  # type: ignore
+    registry.endpoints[1].client = SimpleNamespace(models=FakeModels("m2", "m3"))  # type: ignore
+    return registry
+
+
+@pytest.mark.anyio
+async def test_registry_keeps_last_known_good(registry: ModelRegistry):
+    await registry.refresh()
+    assert [m.id for m in registry.models()] == ["m1", "m2", "m3"]
+    registry.endpoints[1].client.models.down = True
+    await registry.refresh()
+    assert [m.id for m in registry.endpoints[1].models] == ["m2", "m3"]
+
+
+@pytest.mark.anyio
+async def test_registry_candidates(registry: ModelRegistry):
+    a, b = registry.endpoints
+    assert registry.candidates("m2") == []
+    await registry.refresh()
+    assert registry.candidates("m1") == [a]
+    assert registry.candidates("m2") == [a, b]
+    assert registry.candidates("unknown") == []
+    assert registry.candidates(None) == [a, b]
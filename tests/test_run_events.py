@@ -0,0 +1,52 @@
+import asyncio
+
+import pytest
+
+from fastoai.run_events import RunEvents
+
+
+@pytest.mark.anyio
+async def test_run_events_replay_to_late_subscribers():
+    events = RunEvents(buffer_size=3)
+    early = events.subscribe("run")
+    received = asyncio.create_task(anext(early))
+    await asyncio.sleep(0)
+    events.publish("run", "a\n\n")
+    assert await received == "id: 1\na\n\n"
+
+    events.publish("run", "b\n\n")
+    late = [e async for e in _take(events.subscribe("run", after=1), 1)]
+    assert late == ["id: 2\nb\n\n"]
+
+    for event in "cde":
+        events.publish("run", f"{event}\n\n")
+    events.close("run")
+    # The buffer only kept the last events.
+    assert await events.replay("run") == ["id: 4\nd\n\n", "id: 5\ne\n\n"]
+    assert [e async for e in early] == ["id: 4\nd\n\n", "id: 5\ne\n\n"]
+    assert [e async for e in events.subscribe("run", after=4)] == ["id: 5\ne\n\n"]
+    assert await events.replay("unknown") is None
+
+
+@pytest.mark.anyio
+async def test_run_events_outcome_when_idle():
+    events = RunEvents(idle_timeout=0.01)
+    checks = []
+
+    async def outcome():
+        checks.append(None)
+        return ["ended\n\n"] if len(checks) > 1 else None
+
+    subscriber = events.subscribe("run", outcome=outcome)
+    events.publish("run", "a\n\n")
+    # Executed by another process, nothing more is delivered here.
+    assert [e async for e in subscriber] == ["id: 1\na\n\n", "ended\n\n"]
+    assert len(checks) == 2
+
+
+async def _take(events, n):
+    async for event in events:
+        yield event
+        n -= 1
+        if not n:
+            return
@@ -0,0 +1,385 @@
+import asyncio
+import json
+from datetime import timedelta
+from types import SimpleNamespace
+
+import httpx
+import pytest
+from conftest import setup_database
+from openai import AsyncClient, AsyncOpenAI
+from openai.types.beta.threads import Text, TextContentBlock
+from openai.types.beta.threads.run import Run as OpenAIRun
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastoai import _client, app
+from fastoai.dependencies import get_session
+from fastoai.executor import RunExecutor, format_row_event
+from fastoai.models import Message, Run, RunStep
+from fastoai.models._utils import now
+from fastoai.run_events import RunEvents
+from fastoai.run_queue import RunQueue
+from fastoai.settings import Settings
+from fastoai.usage import UsageRecorder
+
+
+def chunk(**fields) -> str:
+    return "data: " + json.dumps(
+        {
+            "id": "chatcmpl-1",
+            "object": "chat.completion.chunk",
+            "created": 0,
+            "model": "llama3",
+            "choices": [],
+            **fields,
+        }
+    )
+
+
+EVENTS = [
+    chunk(choices=[{"index": 0, "delta": {"content": "Hi"}}]),
+    chunk(choices=[{"index": 0, "delta": {"content": "!"}}]),
+    chunk(usage={"prompt_tokens": 4, "completion_tokens": 2, "total_tokens": 6}),
+    "data: [DONE]",
+]
+
+
+@pytest.fixture(name="engine", scope="module")
+async def engine_fixture(tmp_path_factory: pytest.TempPathFactory):
+    # Runs are executed concurrently with the requests, which cannot share the
+    # single connection of an in-memory database.
+    path = tmp_path_factory.mktemp("runs") / "fastoai.db"
+    engine = create_async_engine(f"sqlite+aiosqlite:///{path}")
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    yield engine
+    await engine.dispose()
+
+
+@pytest.fixture(name="session", scope="module")
+async def session_fixture(settings: Settings, engine: AsyncEngine):
+    async def get_request_session():
+        async with AsyncSession(engine) as session:
+            yield session
+
+    async with AsyncSession(engine) as session:
+        await setup_database(session)
+        app.dependency_overrides[get_session] = get_request_session
+        yield session
+        app.dependency_overrides.clear()
+
+
+@pytest.fixture(name="upstream")
+async def upstream_fixture(engine: AsyncEngine):
+    upstream = SimpleNamespace(requests=[], release=asyncio.Event())
+    upstream.release.set()
+
+    async def handler(request: httpx.Request):
+        upstream.requests.append(json.loads(request.content))
+
+        async def stream():
+            yield f"{EVENTS[0]}\n\n".encode()
+            # Held after the first token until the test lets it go.
+            await upstream.release.wait()
+            for event in EVENTS[1:]:
+                yield f"{event}\n\n".encode()
+
+        return httpx.Response(
+            200, content=stream(), headers={"Content-Type": "text/event-stream"}
+        )
+
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    endpoint = _client.Endpoint(
+        base_url="http://upstream/v1",
+        api_key="upstream",
+        http_client=http_client,
+        client=AsyncClient(
+            api_key="upstream",
+            base_url="http://upstream/v1",
+            http_client=http_client,
+        ),
+    )
+    registry = SimpleNamespace(endpoints=[endpoint], candidates=lambda _: [endpoint])
+    openai = _client.AsyncOpenAI(registry=registry)  # type: ignore
+    upstream.executor = lambda events=None, **options: RunExecutor(
+        engine,
+        openai,
+        UsageRecorder(engine),
+        RunQueue(engine),
+        events or RunEvents(),
+        **{"concurrency": 2, "poll_interval": 0.05, **options},
+    )
+    yield upstream
+
+
+@pytest.fixture(name="executor")
+async def executor_fixture(upstream):
+    async with upstream.executor().serve() as executor:
+        app.state.run_executor = executor
+        yield executor
+    del app.state.run_executor
+
+
+@pytest.fixture(name="thread_ids")
+async def thread_fixture(client: AsyncOpenAI, session: AsyncSession):
+    assistant = await client.beta.assistants.create(
+        model="llama3", instructions="Be brief."
+    )
+    thread = await client.beta.threads.create()
+    message = Message(  # type: ignore
+        thread_id=thread.id,
+        role="user",
+        status="completed",
+        content=[
+            TextContentBlock(type="text", text=Text(value="Hello", annotations=[]))
+        ],
+    )
+    session.add(message)
+    await session.commit()
+    return assistant.id, thread.id
+
+
+async def wait_for(client: AsyncOpenAI, thread_id: str, run_id: str, status: str):
+    for _ in range(100):
+        run = await client.beta.threads.runs.retrieve(run_id, thread_id=thread_id)
+        if run.status == status:
+            return run
+        await asyncio.sleep(0.01)
+    raise AssertionError(f"Run {run_id} is still {run.status}")
+
+
+@pytest.mark.anyio
+async def test_run_in_background(client: AsyncOpenAI, upstream, executor, thread_ids):
+    assistant_id, thread_id = thread_ids
+    run = await client.beta.threads.runs.create(thread_id, assistant_id=assistant_id)
+    assert run.status == "queued"
+    run = await wait_for(client, thread_id, run.id, "completed")
+    assert run.usage is not None and run.usage.total_tokens == 6
+    assert upstream.requests[-1]["messages"] == [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hello"},
+    ]
+    messages = await client.beta.threads.messages.list(thread_id)
+    message = next(m for m in messages.data if m.run_id == run.id)
+    assert message.status == "completed"
+    assert message.content[0].text.value == "Hi!"  # type: ignore[union-attr]
+
+
+@pytest.mark.anyio
+async def test_run_stream(client: AsyncOpenAI, executor, thread_ids):
+    assistant_id, thread_id = thread_ids
+    stream = await client.beta.threads.runs.create(
+        thread_id, assistant_id=assistant_id, stream=True
+    )
+    events = [event async for event in stream]
+    assert [e.event for e in events[:3]] == [
+        "thread.run.created",
+        "thread.run.queued",
+        "thread.run.in_progress",
+    ]
+    deltas = [e for e in events if e.event == "thread.message.delta"]
+    assert [d.data.delta.content[0].text.value for d in deltas] == ["Hi", "!"]  # type: ignore
+    assert events[-1].event == "thread.run.completed"
+
+
+@pytest.mark.anyio
+async def test_cancel_run(client: AsyncOpenAI, upstream, executor, thread_ids):
+    assistant_id, thread_id = thread_ids
+    upstream.release.clear()
+    run = await client.beta.threads.runs.create(thread_id, assistant_id=assistant_id)
+    await wait_for(client, thread_id, run.id, "in_progress")
+    run = await client.beta.threads.runs.cancel(run.id, thread_id=thread_id)
+    assert run.status in ("cancelling", "cancelled")
+    await wait_for(client, thread_id, run.id, "cancelled")
+
+
+@pytest.mark.anyio
+async def test_format_row_event():
+    run = Run(  # type: ignore
+        assistant_id="asst_1",
+        thread_id="thread_1",
+        status="queued",
+        model="llama3",
+        instructions="",
+        parallel_tool_calls=True,
+        metadata={"a": "b"},
+    )
+    event, data = format_row_event("thread.run.queued", run).split("\n")[:2]
+    assert event == "event: thread.run.queued"
+    payload = OpenAIRun.model_validate_json(data.removeprefix("data: "))
+    assert payload == await run.to_openai_model()
+
+
+@pytest.mark.anyio
+async def test_run_expired(
+    client: AsyncOpenAI, engine: AsyncEngine, upstream, executor, thread_ids
+):
+    assistant_id, thread_id = thread_ids
+    upstream.release.clear()
+    async with AsyncSession(engine, expire_on_commit=False) as session:
+        run = Run(  # type: ignore
+            assistant_id=assistant_id,
+            thread_id=thread_id,
+            status="queued",
+            model="llama3",
+            instructions="",
+            parallel_tool_calls=True,
+            expires_at=now() + timedelta(seconds=0.3),
+        )
+        session.add(run)
+        await session.flush()
+        executor.queue.enqueue(session, run.id)
+        await session.commit()
+    executor.notify()
+    await wait_for(client, thread_id, run.id, "expired")
+    messages = await client.beta.threads.messages.list(thread_id)
+    message = next(m for m in messages.data if m.run_id == run.id)
+    assert message.status == "incomplete"
+    assert message.incomplete_details is not None
+    assert message.incomplete_details.reason == "run_expired"
+    assert message.content[0].text.value == "Hi"  # type: ignore[union-attr]
+    async with AsyncSession(engine) as session:
+        step = (
+            await session.exec(select(RunStep).where(RunStep.run_id == run.id))
+        ).one()
+        assert step.status == "expired"
+
+
+@pytest.mark.anyio
+async def test_run_queue_leases(engine: AsyncEngine, session: AsyncSession, thread_ids):
+    assistant_id, thread_id = thread_ids
+    queue = RunQueue(engine, lease_duration=60)
+    runs = [
+        Run(  # type: ignore
+            assistant_id=assistant_id,
+            thread_id=thread_id,
+            status="queued",
+            model="llama3",
+            instructions="",
+            parallel_tool_calls=True,
+        )
+        for _ in range(2)
+    ]
+    run_ids = {run.id for run in runs}
+    session.add_all(runs)
+    await session.flush()
+    for run_id in run_ids:
+        queue.enqueue(session, run_id)
+    await session.commit()
+
+    first, second = await queue.claim("a"), await queue.claim("b")
+    assert first is not None and second is not None
+    assert {first.run_id, second.run_id} == run_ids
+    assert await queue.claim("c") is None
+    assert await queue.renew(first.run_id, "a") == "queued"
+    assert await queue.renew(first.run_id, "b") is None
+
+    queue.lease_duration = -1
+    assert await queue.renew(first.run_id, "a") == "queued"
+    taken_over = await queue.claim("c")
+    assert taken_over is not None and taken_over.run_id == first.run_id
+    assert taken_over.attempts == 2
+    assert await queue.renew(first.run_id, "a") is None
+
+    await queue.release(second.run_id, "b")
+    await queue.complete(first.run_id, "c")
+    queue.lease_duration = 60
+    claim = await queue.claim("d")
+    assert claim is not None and claim.run_id == second.run_id
+    assert claim.attempts == 1
+    await queue.complete(second.run_id, "d")
+    assert await queue.claim("d") is None
+
+
+@pytest.mark.anyio
+async def test_run_resumed_after_shutdown(client: AsyncOpenAI, upstream, thread_ids):
+    assistant_id, thread_id = thread_ids
+    upstream.release.clear()
+    sent = len(upstream.requests)
+    async with upstream.executor().serve() as executor:
+        app.state.run_executor = executor
+        run = await client.beta.threads.runs.create(
+            thread_id, assistant_id=assistant_id
+        )
+        await wait_for(client, thread_id, run.id, "in_progress")
+        while len(upstream.requests) == sent:
+            await asyncio.sleep(0.01)
+    upstream.release.set()
+    async with upstream.executor().serve() as executor:
+        app.state.run_executor = executor
+        await wait_for(client, thread_id, run.id, "completed")
+    del app.state.run_executor
+    messages = await client.beta.threads.messages.list(thread_id)
+    statuses = [m.status for m in messages.data if m.run_id == run.id]
+    assert sorted(statuses) == ["completed", "incomplete"]
+    assert upstream.requests[-1]["messages"] == [
+        {"role": "system", "content": "Be brief."},
+        {"role": "user", "content": "Hello"},
+    ]
+
+
+@pytest.mark.anyio
+async def test_run_stream_executed_elsewhere(
+    client: AsyncOpenAI, engine: AsyncEngine, upstream, thread_ids
+):
+    assistant_id, thread_id = thread_ids
+    # This process only serves the stream, without Valkey to share events.
+    app.state.run_executor = upstream.executor(events=RunEvents(idle_timeout=0.05))
+    try:
+        async with upstream.executor().serve():
+            stream = await client.beta.threads.runs.create(
+                thread_id, assistant_id=assistant_id, stream=True
+            )
+            events = [event.event async for event in stream]
+    finally:
+        del app.state.run_executor
+    assert events == ["thread.run.created", "thread.run.queued", "thread.run.completed"]
+
+
+@pytest.mark.anyio
+async def test_resume_run_stream(
+    client: AsyncOpenAI, http_client: httpx.AsyncClient, executor, thread_ids
+):
+    assistant_id, thread_id = thread_ids
+    stream = await client.beta.threads.runs.create(
+        thread_id, assistant_id=assistant_id, stream=True
+    )
+    events = [event async for event in stream]
+    run_id = events[0].data.id
+    headers = {
+        "Authorization": f"Bearer {client.api_key}",
+        "OpenAI-Beta": "assistants=v2",
+        "Last-Event-ID": "1",
+    }
+    url = f"/threads/{thread_id}/runs/{run_id}/events"
+    response = await http_client.get(url, headers=headers)
+    resumed = [
+        line.removeprefix("event: ")
+        for line in response.text.splitlines()
+        if line.startswith("event: ")
+    ]
+    # The run was created and queued before its first numbered event.
+    assert resumed == [e.event for e in events[3:]] + ["done"]
+
+
+@pytest.mark.anyio
+async def test_run_checkpoints(client: AsyncOpenAI, upstream, thread_ids):
+    assistant_id, thread_id = thread_ids
+    upstream.release.clear()
+    async with upstream.executor(checkpoint_tokens=1).serve() as executor:
+        app.state.run_executor = executor
+        run = await client.beta.threads.runs.create(
+            thread_id, assistant_id=assistant_id
+        )
+        for _ in range(100):
+            messages = await client.beta.threads.messages.list(thread_id)
+            message = next((m for m in messages.data if m.run_id == run.id), None)
+            if message is not None and message.content:
+                break
+            await asyncio.sleep(0.01)
+        assert message is not None and message.status == "in_progress"
+        assert message.content[0].text.value == "Hi"  # type: ignore[union-attr]
+        upstream.release.set()
+        await wait_for(client, thread_id, run.id, "completed")
+    del app.state.run_executor
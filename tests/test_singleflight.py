@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+
+from fastoai.singleflight import COALESCED, SingleFlight
+
+
+@pytest.mark.anyio
+async def test_single_flight():
+    flights = SingleFlight[str, int]()
+    started = asyncio.Event()
+    release = asyncio.Event()
+    calls = 0
+
+    async def call():
+        nonlocal calls
+        calls += 1
+        started.set()
+        await release.wait()
+        if calls > 1:
+            raise ValueError("second flight")
+        return calls
+
+    coalesced = COALESCED.get()
+    leader = asyncio.create_task(flights.do("k", call))
+    await started.wait()
+    followers = [asyncio.create_task(flights.do("k", call)) for _ in range(2)]
+    await asyncio.sleep(0)
+    followers[0].cancel()
+    release.set()
+    assert await leader == 1
+    assert await followers[1] == 1
+    assert followers[0].cancelled()
+    assert COALESCED.get() == coalesced + 2
+    assert len(flights) == 0
+
+    with pytest.raises(ValueError):
+        await flights.do("k", call)
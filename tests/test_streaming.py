@@ -0,0 +1,76 @@
+import httpx
+import pytest
+from starlette.requests import ClientDisconnect
+
+from fastoai.streaming import STREAMS_ABANDONED, EventStreamResponse, relay_sse
+
+
+class Upstream(httpx.AsyncByteStream):
+    def __init__(self):
+        self.closed = False
+
+    async def __aiter__(self):
+        while True:
+            yield b'data: {"choices":[]}\n\n'
+
+    async def aclose(self):
+        self.closed = True
+
+
+class Chunks(httpx.AsyncByteStream):
+    def __init__(self, chunks: list[bytes]):
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+@pytest.mark.anyio
+async def test_relay_sse_transform():
+    response = httpx.Response(
+        200, content=b'data: {"n":1}\r\n\r\ndata: {"n":2}\n\ndata: [DONE]\n\n'
+    )
+    seen = []
+    events = relay_sse(
+        response,
+        transform=lambda chunk: None if chunk["n"] == 1 else {"n": 3},
+        observe=seen.append,
+    )
+    assert b"".join([e async for e in events]) == b'data: {"n":3}\n\ndata: [DONE]\n\n'
+    assert seen == [{"n": 1}, {"n": 2}]
+
+
+@pytest.mark.anyio
+async def test_relay_sse_split_crlf():
+    chunks = [b'data: {"n":1}\r', b"\n\r", b"\ndata: keep-alive\r\n\r\n"]
+    response = httpx.Response(200, stream=Chunks(chunks))
+    seen = []
+    events = relay_sse(response, observe=seen.append)
+    assert b"".join([e async for e in events]) == (
+        b'data: {"n":1}\n\ndata: keep-alive\n\n'
+    )
+    assert seen == [{"n": 1}]
+
+
+@pytest.mark.anyio
+async def test_disconnect_closes_upstream():
+    upstream = Upstream()
+    abandoned = STREAMS_ABANDONED.get()
+
+    async def receive():
+        return {"type": "http.request", "body": b""}
+
+    async def send(message):
+        if message["type"] == "http.response.body":
+            raise OSError("client disconnected")
+
+    last = []
+    response = EventStreamResponse(
+        relay_sse(httpx.Response(200, stream=upstream), last=last.append)
+    )
+    with pytest.raises(ClientDisconnect):
+        await response({"type": "http", "asgi": {"spec_version": "2.4"}}, receive, send)
+    assert upstream.closed
+    assert STREAMS_ABANDONED.get() == abandoned + 1
+    assert last == [None]
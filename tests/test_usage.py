@@ -0,0 +1,36 @@
+import pytest
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlmodel import SQLModel, select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from fastoai.auth import Principal
+from fastoai.models import UsageRecord
+from fastoai.usage import UsageRecorder
+
+
+@pytest.mark.anyio
+async def test_usage_recorder():
+    engine = create_async_engine("sqlite+aiosqlite://")
+    recorder = UsageRecorder(engine)
+    principal = Principal(key_id="key", owner_type="user", owner_id="user")
+    usage = {"prompt_tokens": 10, "completion_tokens": 5}
+    recorder.record(principal, model="llama3", kind="chat", usage=usage)
+    recorder.record(principal, model="llama3", kind="chat", usage=usage)
+    recorder.record(principal, model="llama3", kind="chat")
+    recorder.record(principal, model="nomic", kind="embedding", usage=usage)
+
+    # The table does not exist yet, the records are kept for the next attempt.
+    assert await recorder.flush() == 0
+    async with engine.begin() as conn:
+        await conn.run_sync(SQLModel.metadata.create_all)
+    assert await recorder.flush() == 2
+    assert await recorder.flush() == 0
+
+    async with AsyncSession(engine) as session:
+        records = {r.kind: r for r in (await session.exec(select(UsageRecord))).all()}
+    assert records["chat"].requests == 3
+    assert records["chat"].prompt_tokens == 20
+    assert records["chat"].completion_tokens == 10
+    assert records["embedding"].requests == 1
+    assert records["embedding"].period_start.second == 0
+    await engine.dispose()